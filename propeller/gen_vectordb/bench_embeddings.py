@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""This module holds the benchmark that finds the fastest embedding threads x instances setting of a machine."""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from typing import List
+
+from chunkstore import ChunkStore
+from embedding_pool import EmbeddingPool
+
+
+def load_texts(chunk_store_path:str, count:int) -> List[str]:
+    """Returns the first count chunks of a chunk store, or synthetic chunks of a similar size."""
+    if chunk_store_path:
+        texts = []
+        for batch, _ in ChunkStore(chunk_store_path).iter_batches(count):
+            texts.extend(batch)
+            break
+        return texts[:count]
+
+    # about the splitter's chunk size, 400 tokens
+    rng = random.Random(0)
+    words = ["course", "lecture", "assignment", "grade", "exam", "reading", "lab", "project", "deadline", "section", "the", "of", "and", "to", "in"]
+    return [" ".join(rng.choice(words) for _ in range(300)) for _ in range(count)]
+
+
+def default_threads(cpus:int) -> List[int]:
+    threads = []
+    value = 1
+    while value <= cpus:
+        threads.append(value)
+        value *= 2
+    return threads
+
+
+def run(texts:List[str], threads:int, instances:int, batch_size:int) -> dict:
+    start = time.perf_counter()
+    pool = EmbeddingPool(threads=threads, instances=instances, batch_size=batch_size)
+    try:
+        # loads the model of every instance
+        pool.embed_documents(texts[:batch_size * instances])
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pool.embed_documents(texts)
+        seconds = time.perf_counter() - start
+    finally:
+        pool.close()
+
+    return {
+        "threads": threads,
+        "instances": instances,
+        "chunks": len(texts),
+        "seconds": seconds,
+        "chunks_per_second": len(texts) / seconds,
+        "load_seconds": load_seconds,
+    }
+
+
+def main() -> None:
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        prog='bench_embeddings',
+        description='Measure embedding throughput across threads x instances settings')
+    parser.add_argument('--threads', nargs='+', type=int, default=default_threads(cpus), help='CPU threads per model instance')
+    parser.add_argument('--instances', nargs='+', type=int, default=[1, 2, 4], help='model instances')
+    parser.add_argument('--chunks', type=int, default=512, help='chunks embedded per setting')
+    parser.add_argument('--chunk_store', help='embed chunks of this chunk store instead of synthetic ones')
+    parser.add_argument('--batch_size', type=int, default=32, help='chunks per batch sent to an instance')
+    parser.add_argument('--oversubscribe', action='store_true', help='also run settings using more threads than CPUs')
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args()
+
+    texts = load_texts(args.chunk_store, args.chunks)
+    print("%d chunks, %d CPUs" % (len(texts), cpus))
+
+    results = []
+    for threads, instances in itertools.product(args.threads, args.instances):
+        if threads * instances > cpus and not args.oversubscribe:
+            continue
+        result = run(texts, threads, instances, args.batch_size)
+        results.append(result)
+        print(json.dumps(result))
+
+    if not results:
+        print("no setting fits %d CPUs, use --oversubscribe" % cpus)
+        return
+
+    best = max(results, key=lambda result: result["chunks_per_second"])
+    print("best: --embed_threads %d --embed_instances %d (%.1f chunks/s)" % (best["threads"], best["instances"], best["chunks_per_second"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cpus": cpus, "results": results, "best": best}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""This module holds the micro-benchmarks of the ingestion hot paths of vectordb.py, with regression checks against a baseline."""
+
+import argparse
+import copy
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import markdownify
+from langchain.text_splitter import MarkdownHeaderTextSplitter
+from langchain_core.documents import Document
+
+from chunkstore import ChunkStore
+from vectordb import VectorDB
+
+# synthetic corpus sizes, in KB of markdown
+DEFAULT_SIZES = [64, 512, 4096]
+BENCHMARKS = ("html_to_markdown", "markdown_split", "token_split", "clean_doc", "make_doc_safe", "make_meta_safe", "add_docs")
+_HEADERS = [("#", "Header 1"), ("##", "Header 2"), ("###", "Header 3")]
+_WORDS = [
+    "course", "lecture", "assignment", "grade", "exam", "reading", "lab", "project", "deadline", "section",
+    "student", "instructor", "syllabus", "quiz", "homework", "office", "hours", "week", "chapter", "data",
+    "the", "of", "and", "to", "in", "is", "for", "on", "with", "will",
+]
+# peak memory changes below this are noise, not regressions
+_MEMORY_NOISE_MB = 1.0
+
+
+class Corpus:
+    def __init__(self, name:str, markdown:List[str], html:List[str]):
+        self.name = name
+        self.markdown = markdown
+        self.html = html
+        self.bytes = sum(len(text.encode("utf-8")) for text in markdown)
+
+
+def _sentence(rng:random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 24))]
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "?", "!"])
+
+
+def synthetic_corpus(size_kb:int, seed:int=0) -> Corpus:
+    """Returns lecture notes of about size_kb KB, as markdown and as the equivalent html, the same for a seed."""
+    rng = random.Random(seed * 100003 + size_kb)
+    markdown = []
+    html = []
+    size = 0
+    lecture = 0
+    while size < size_kb * 1024:
+        lecture += 1
+        md_lines = ["# Lecture %d" % lecture]
+        html_lines = ["<html><body>", "<h1>Lecture %d</h1>" % lecture]
+        for section in range(rng.randint(2, 5)):
+            md_lines.append("## Section %d.%d" % (lecture, section + 1))
+            html_lines.append("<h2>Section %d.%d</h2>" % (lecture, section + 1))
+            for _ in range(rng.randint(2, 6)):
+                paragraph = " ".join(_sentence(rng) for _ in range(rng.randint(3, 10)))
+                md_lines.append(paragraph)
+                html_lines.append("<p>%s</p>" % paragraph)
+        html_lines.append("</body></html>")
+        text = "\n\n".join(md_lines)
+        markdown.append(text)
+        html.append("\n".join(html_lines))
+        size += len(text)
+    return Corpus("synthetic-%dkb" % size_kb, markdown, html)
+
+
+def sample_corpus(path:str) -> Corpus:
+    """Returns the markdown and html files under path; html files are also converted to markdown for the other steps."""
+    markdown = []
+    html = []
+    for file_path in sorted(pathlib.Path(path).rglob("*")):
+        suffix = file_path.suffix.lower()
+        if suffix == ".md":
+            markdown.append(file_path.read_text(errors="replace"))
+        elif suffix in (".html", ".htm"):
+            text = file_path.read_text(errors="replace")
+            html.append(text)
+            markdown.append(markdownify.markdownify(text))
+    if not markdown:
+        raise ValueError("no .md or .html files in %s" % path)
+    return Corpus("sample-%s" % pathlib.Path(path).name, markdown, html)
+
+
+def _unsafe_metadata(docs:List[Document]) -> List[Document]:
+    # as some loaders return, e.g., unstructured's element metadata
+    out = []
+    for number, doc in enumerate(docs):
+        metadata = dict(doc.metadata)
+        metadata.update({"source": "bench/notes%d.md" % number, "languages": ["eng"], "coordinates": {"points": [[0, 0], [1, 1]], "system": "PixelSpace"}})
+        out.append(Document(page_content=doc.page_content, metadata=metadata))
+    return out
+
+
+def _measure(setup:Callable[[], Any], run:Callable[[Any], int], repeat:int) -> Tuple[float, int, float]:
+    """
+    Returns the best seconds of repeat runs, the chunks of a run and its peak
+    python memory in MB. The input of each run is made by setup, untimed.
+    """
+    best = None
+    chunks = 0
+    for _ in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        chunks = run(data)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    # a separate run, tracing allocations slows the code down
+    data = setup()
+    tracemalloc.start()
+    try:
+        run(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, chunks, peak / (1024 * 1024)
+
+
+def run_benchmarks(corpus:Corpus, benchmarks:List[str], repeat:int, work_path:str) -> List[dict]:
+    vectordb = VectorDB(index=False)
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=_HEADERS)
+
+    # inputs of each step, prepared outside of the timed runs
+    sections = [doc for text in corpus.markdown for doc in markdown_splitter.split_text(text)]
+    chunks = vectordb._clean_doc(copy.deepcopy(sections), False)
+    unsafe_chunks = _unsafe_metadata(chunks)
+
+    def html_to_markdown(_) -> int:
+        return len([markdownify.markdownify(text) for text in corpus.html])
+
+    def markdown_split(_) -> int:
+        return sum(len(markdown_splitter.split_text(text)) for text in corpus.markdown)
+
+    def token_split(_) -> int:
+        return len(vectordb.text_splitter.split_documents(sections))
+
+    def clean_doc(docs:List[Document]) -> int:
+        return len(vectordb._clean_doc(docs, False))
+
+    def make_doc_safe(docs:List[Document]) -> int:
+        vectordb._make_doc_safe(docs)
+        return len(docs)
+
+    def make_meta_safe(docs:List[Document]) -> int:
+        for doc in docs:
+            vectordb._make_meta_safe(doc)
+        return len(docs)
+
+    def open_store() -> Tuple[VectorDB, ChunkStore, List[Document]]:
+        store = ChunkStore(os.path.join(work_path, "chunks"))
+        store.create(info=vectordb.splitter_settings())
+        return VectorDB(index=False, chunk_store=store), store, copy.deepcopy(chunks)
+
+    def add_docs(data:Tuple[VectorDB, ChunkStore, List[Document]]) -> int:
+        # chunks go to a chunk store only, embedding is measured by bench_embeddings.py
+        writer, store, docs = data
+        for start in range(0, len(docs), 256):
+            writer._add_docs(docs[start:start + 256])
+        store.close()
+        return len(docs)
+
+    def nothing() -> None:
+        return None
+
+    # name: (setup, run, bytes processed)
+    runs: Dict[str, Tuple[Callable[[], Any], Callable[[Any], int], int]] = {
+        "html_to_markdown": (nothing, html_to_markdown, sum(len(text.encode("utf-8")) for text in corpus.html)),
+        "markdown_split": (nothing, markdown_split, corpus.bytes),
+        "token_split": (nothing, token_split, corpus.bytes),
+        "clean_doc": (lambda: copy.deepcopy(sections), clean_doc, corpus.bytes),
+        "make_doc_safe": (lambda: copy.deepcopy(unsafe_chunks), make_doc_safe, corpus.bytes),
+        "make_meta_safe": (lambda: copy.deepcopy(unsafe_chunks), make_meta_safe, corpus.bytes),
+        "add_docs": (open_store, add_docs, corpus.bytes),
+    }
+
+    results = []
+    for name in benchmarks:
+        setup, run, size = runs[name]
+        if name == "html_to_markdown" and not corpus.html:
+            continue
+        seconds, count, peak_mb = _measure(setup, run, repeat)
+        result = {
+            "corpus": corpus.name,
+            "benchmark": name,
+            "bytes": size,
+            "chunks": count,
+            "seconds": seconds,
+            "mb_per_second": size / (1024 * 1024) / seconds if seconds else 0.0,
+            "chunks_per_second": count / seconds if seconds else 0.0,
+            "peak_memory_mb": peak_mb,
+        }
+        results.append(result)
+        print("%-20s %-16s %8.3fs %8.2f MB/s %10.0f chunks/s %8.1f MB peak" % (corpus.name, name, seconds, result["mb_per_second"], result["chunks_per_second"], peak_mb))
+    return results
+
+
+def compare(results:dict, baseline:dict, max_slowdown:float, max_memory_growth:float) -> List[str]:
+    """
+    Returns the benchmarks whose throughput dropped more than max_slowdown
+    or whose peak memory grew more than max_memory_growth (fractions) from
+    the baseline.
+    """
+    base = {(result["corpus"], result["benchmark"]): result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results["results"]:
+        before = base.get((result["corpus"], result["benchmark"]))
+        if not before:
+            continue
+        name = "%s %s" % (result["corpus"], result["benchmark"])
+        if before["mb_per_second"] > 0 and result["mb_per_second"] < before["mb_per_second"] * (1 - max_slowdown):
+            regressions.append("%s: %.2f -> %.2f MB/s" % (name, before["mb_per_second"], result["mb_per_second"]))
+        if result["peak_memory_mb"] > before["peak_memory_mb"] * (1 + max_memory_growth) + _MEMORY_NOISE_MB:
+            regressions.append("%s: %.1f -> %.1f MB peak" % (name, before["peak_memory_mb"], result["peak_memory_mb"]))
+    return regressions
+
+
+############################
+# Run the benchmarks
+############################
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='bench_ingest',
+        description='Measure throughput and peak memory of the ingestion steps of vectordb.py')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='synthetic corpus sizes in KB')
+    parser.add_argument('--sample', nargs='*', default=[], help='folders of sample .md and .html files to benchmark as well')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS), help='steps to measure')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpora')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='results json of a previous run to compare with')
+    parser.add_argument('--max_slowdown', type=float, default=0.1, help='largest throughput drop from the baseline allowed, as a fraction')
+    parser.add_argument('--max_memory_growth', type=float, default=0.2, help='largest peak memory growth from the baseline allowed, as a fraction')
+    args = parser.parse_args()
+
+    corpora = [synthetic_corpus(size, args.seed) for size in args.sizes]
+    corpora.extend(sample_corpus(path) for path in args.sample)
+
+    work_path = tempfile.mkdtemp(prefix="bench-ingest-")
+    try:
+        all_results = []
+        for corpus in corpora:
+            all_results.extend(run_benchmarks(corpus, args.benchmarks, args.repeat, work_path))
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "results": all_results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_slowdown, args.max_memory_growth)
+        if regressions:
+            print("performance regressions:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("performance is within %.0f%% of the baseline" % (100 * args.max_slowdown))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the checkpoint log of resumable ingestion runs."""
+
+import json
+import os
+import uuid
+from typing import Dict, Optional
+
+_CHUNK_ID_NAMESPACE = uuid.UUID("0f6b7e0c-6a4e-4d0f-9a53-2b4a3c1f8e21")
+
+
+def chunk_id(collection_name:str, source:str, chunk_number:int) -> str:
+    """
+    Returns the id of a file's chunk. Ids are deterministic, so a resumed run
+    can tell which chunks of a file the interrupted run added; the chunks of
+    an earlier build of the file share them and are removed before it is
+    added again (see VectorDB._remove_previous).
+    """
+    return str(uuid.uuid5(_CHUNK_ID_NAMESPACE, "%s\n%s\n%d" % (collection_name, source, chunk_number)))
+
+
+class CheckpointLog:
+    """
+    This class keeps a durable, append-only log of the work an ingestion run
+    has committed: each chunk batch added to the vector store and each file
+    completed. Every record is fsynced before the run moves on, so after a
+    crash a resumed run knows which files to skip and which batches of a
+    partially added file are already in the store.
+
+    A new log started over the log of an interrupted run keeps, in
+    abandoned, the files that run started committing but did not complete,
+    with the number of their chunks it logged, so their chunks can be
+    removed from the store instead of being left half added.
+
+    Params:
+      path  the log file
+      resume  keep the records of a previous run, otherwise start a new log
+    """
+
+    def __init__(self, path:str, resume:bool=False):
+        self._path = path
+        self._files = {}
+        self._batches = set()
+        self._started = {}
+        self.abandoned: Dict[str, int] = {}
+
+        if os.path.exists(path):
+            self._load()
+        if not resume:
+            self.abandoned = {source: chunks for source, chunks in self._started.items() if source not in self._files}
+            self._files = {}
+            self._batches = set()
+            self._started = {}
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w"):
+                pass
+
+        self.resumed = bool(self._files or self._batches)
+        self._log = open(path, "a", encoding="utf-8")
+
+    def _load(self) -> None:
+        with open(self._path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write of the last record
+                    break
+
+                if record["type"] == "file":
+                    self._files[record["source"]] = record
+                elif record["type"] == "start":
+                    self._started.setdefault(record["source"], 0)
+                elif record["type"] == "batch":
+                    self._batches.add((record["source"], record["batch"]))
+                    self._started[record["source"]] = self._started.get(record["source"], 0) + record["chunks"]
+
+    def _append(self, record:dict) -> None:
+        self._log.write(json.dumps(record) + "\n")
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def is_file_done(self, source:str) -> bool:
+        return source in self._files
+
+    def is_file_started(self, source:str) -> bool:
+        return source in self._started
+
+    def is_batch_done(self, source:str, batch_number:int) -> bool:
+        return (source, batch_number) in self._batches
+
+    def last_file(self) -> Optional[dict]:
+        """Returns the record of the last completed file."""
+        if not self._files:
+            return None
+        return list(self._files.values())[-1]
+
+    def start_file(self, source:str) -> None:
+        """Records that chunks of a file are about to be committed, before the first of them."""
+        if source not in self._started:
+            self._started[source] = 0
+            self._append({"type": "start", "source": source})
+
+    def add_batch(self, source:str, batch_number:int, chunks:int) -> None:
+        self._batches.add((source, batch_number))
+        self._started[source] = self._started.get(source, 0) + chunks
+        self._append({"type": "batch", "source": source, "batch": batch_number, "chunks": chunks})
+
+    def add_file(self, source:str, chunks:int, chunk_store:Optional[list]=None) -> None:
+        """
+        Params:
+          chunk_store  the (bytes, chunks) position of the chunk store after the file
+        """
+        record = {"type": "file", "source": source, "chunks": chunks, "chunk_store": chunk_store}
+        self._files[source] = record
+        self._append(record)
+
+    def close(self, remove:bool=False) -> None:
+        """Closes the log, removing it when the run completed."""
+        self._log.close()
+        if remove:
+            os.remove(self._path)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the chunk store written by the parse phase of ingestion."""
+
+import json
+import os
+from typing import Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+_CHUNKS_FILE = "chunks.jsonl"
+_INFO_FILE = "info.json"
+_READ_BUFFER_BYTES = 4 * 1024 * 1024
+
+
+class ChunkStore:
+    """
+    This class stores the cleaned and split chunks of a course with their
+    metadata, one JSON record per line, so the embed/index phase can rebuild
+    an index from them without parsing the source files again.
+
+    A store is written in one go (create, append, close); the chunks only
+    replace the previous ones when the store is closed, so an interrupted
+    parse keeps the last complete store.
+
+    Params:
+      path  the folder holding the store
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        self._writer = None
+        self._written = 0
+        self._info = {}
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _file(self, name:str) -> str:
+        return os.path.join(self._path, name)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._file(_INFO_FILE))
+
+    def info(self) -> dict:
+        with open(self._file(_INFO_FILE), "r") as f:
+            return json.load(f)
+
+    def __len__(self) -> int:
+        return self.info()["count"] if self.exists() else 0
+
+    def create(self, info:Optional[dict]=None, resume:Optional[list]=None) -> None:
+        """
+        Starts writing a new store.
+
+        Params:
+          info  settings the chunks depend on, e.g., the splitter's, kept in info.json
+          resume  a (bytes, chunks) position returned by flush(), continues
+            the uncommitted store of an interrupted run from there
+        """
+        os.makedirs(self._path, exist_ok=True)
+        self._info = dict(info or {})
+        tmp_path = self._file(_CHUNKS_FILE + ".tmp")
+        if resume and os.path.exists(tmp_path):
+            self._writer = open(tmp_path, "r+", encoding="utf-8")
+            self._writer.truncate(resume[0])
+            self._writer.seek(resume[0])
+            self._written = resume[1]
+        else:
+            self._writer = open(tmp_path, "w", encoding="utf-8")
+            self._written = 0
+
+    def append(self, docs:List[Document]) -> None:
+        if not self._writer:
+            raise RuntimeError("chunk store %s is not open for writing" % self._path)
+
+        for doc in docs:
+            self._writer.write(json.dumps({"text": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False))
+            self._writer.write("\n")
+        self._written += len(docs)
+
+    def flush(self) -> list:
+        """Makes the chunks written so far durable and returns the (bytes, chunks) position."""
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        return [self._writer.tell(), self._written]
+
+    def close(self) -> None:
+        """Commits the written chunks."""
+        if not self._writer:
+            return
+
+        self._writer.close()
+        self._writer = None
+        os.replace(self._file(_CHUNKS_FILE + ".tmp"), self._file(_CHUNKS_FILE))
+
+        self._info["count"] = self._written
+        with open(self._file(_INFO_FILE + ".tmp"), "w") as f:
+            json.dump(self._info, f, indent=2)
+        os.replace(self._file(_INFO_FILE + ".tmp"), self._file(_INFO_FILE))
+
+    def iter_batches(self, batch_size:int=1024) -> Iterator[Tuple[List[str], List[dict]]]:
+        """Reads the chunks sequentially as (texts, metadatas) batches."""
+        texts = []
+        metadatas = []
+        with open(self._file(_CHUNKS_FILE), "r", encoding="utf-8", buffering=_READ_BUFFER_BYTES) as f:
+            for line in f:
+                record = json.loads(line)
+                texts.append(record["text"])
+                metadatas.append(record["metadata"])
+                if len(texts) >= batch_size:
+                    yield texts, metadatas
+                    texts = []
+                    metadatas = []
+
+        if texts:
+            yield texts, metadatas
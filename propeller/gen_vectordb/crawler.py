@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+"""This module holds the web crawler that downloads course web pages for ingestion."""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import pathlib
+import time
+import xml.etree.ElementTree as ElementTree
+from html.parser import HTMLParser
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+import aiohttp
+
+# kept in the output folder, ignored by the ingest walk
+CRAWL_STATE_FILE = "crawl_state.json"
+_USER_AGENT = "chatur-crawler"
+_HTML_TYPES = ("text/html", "application/xhtml+xml")
+
+
+def get_extension_for_content_type(content_type:str) -> str:
+    content_type_arr = content_type.split(";")
+    for content_type in content_type_arr:
+        match content_type:
+            case "text/html" | "application/xhtml+xml":
+                return "html"
+            case "application/pdf":
+                return "pdf"
+            case "application/vnd.ms-powerpoint":
+                return "ppt"
+            case "application/vnd.openxmlformats-officedocument.presentationml.presentation":
+                return "pptx"
+            case "text/plain":
+                return "txt"
+            case "application/msword" | "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+                return "docx"
+            case "text/markdown":
+                return "md"
+            case _:
+                pass
+
+    return "unknown"
+
+
+def url_file_name(url:str, content_type:str) -> str:
+    """
+    Returns the name a downloaded URL is saved under: "b64:" and the
+    URL-safe base64 of the URL (no "/" in the name), followed by the
+    extension of the URL path or of the content type.
+    """
+    fileext = ""
+    urlobj = urlparse(url)
+    if len(urlobj.path) > 0:
+        fileext = pathlib.Path(urlobj.path).suffix
+        if not fileext:
+            fileext = "." + get_extension_for_content_type(content_type)
+    return "b64:" + base64.urlsafe_b64encode(url.encode("utf-8")).decode("ascii") + fileext
+
+
+def url_of_file_name(name:str) -> str:
+    """Returns the URL of a file named by url_file_name, also for names with the standard base64 alphabet."""
+    encoded = name[4:].split(".")[0]
+    return base64.b64decode(encoded, altchars=b"-_").decode("utf-8")
+
+
+def normalize_url(url:str) -> str:
+    url, _ = urldefrag(url.strip())
+    urlobj = urlparse(url)
+    path = urlobj.path or "/"
+    normalized = "%s://%s%s" % (urlobj.scheme.lower(), urlobj.netloc.lower(), path)
+    if urlobj.query:
+        normalized += "?" + urlobj.query
+    return normalized
+
+
+class _LinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.base = None
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "base" and attrs.get("href"):
+            self.base = attrs["href"]
+        elif tag == "a" and attrs.get("href"):
+            self.links.append(attrs["href"])
+
+
+def extract_links(url:str, html:str) -> List[str]:
+    parser = _LinkParser()
+    try:
+        parser.feed(html)
+    except Exception as e:
+        print("> cannot parse links of %s: %s" % (url, e))
+    base = urljoin(url, parser.base) if parser.base else url
+    links = []
+    for link in parser.links:
+        link = urljoin(base, link)
+        if urlparse(link).scheme in ("http", "https"):
+            links.append(normalize_url(link))
+    return links
+
+
+def parse_sitemap(xml:bytes) -> Tuple[List[str], List[str]]:
+    """Returns the (page URLs, nested sitemap URLs) of a sitemap or sitemap index."""
+    pages = []
+    sitemaps = []
+    try:
+        root = ElementTree.fromstring(xml)
+    except ElementTree.ParseError:
+        return pages, sitemaps
+
+    # a sitemap index lists nested sitemaps instead of pages
+    locations = sitemaps if root.tag.endswith("sitemapindex") else pages
+    for element in root.iter():
+        if element.tag.endswith("loc") and element.text:
+            locations.append(element.text.strip())
+    return pages, sitemaps
+
+
+class _Host:
+    def __init__(self, concurrency:int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.lock = asyncio.Lock()
+        self.next_request = 0.0
+        self.robots = None
+
+
+class Crawler:
+    """
+    This class crawls web sites from seed URLs into a folder, one file per
+    page named by url_file_name, the format the ingest walk reads from
+    downloaded .url lists.
+
+    Pages are fetched concurrently from a breadth-first frontier, at most
+    host_concurrency at a time and one every delay seconds per host, within
+    max_depth links of a seed (or of the site's sitemap.xml) and on the
+    seeds' domains. Pages with the same content as a page already saved are
+    not saved again. The ETag and Last-Modified validators of every page are
+    kept in the folder, so a re-crawl only downloads pages that changed.
+
+    Params:
+      output_path  the folder pages are saved to
+      max_depth  links followed from a seed
+      max_pages  pages fetched at most
+      domains  allowed domains (and their subdomains), default the seeds'
+      concurrency  pages fetched at once
+      host_concurrency  pages fetched at once from one host
+      delay  seconds between requests to one host
+      use_sitemaps  also start from /sitemap.xml of each seed's site
+      respect_robots  skip URLs robots.txt disallows
+    """
+
+    def __init__(self, output_path:str, max_depth:int=3, max_pages:int=10000, domains:Optional[List[str]]=None, concurrency:int=16, host_concurrency:int=2, delay:float=0.5, timeout:float=30.0, use_sitemaps:bool=True, respect_robots:bool=True):
+        self._output_path = output_path
+        self._max_depth = max_depth
+        self._max_pages = max_pages
+        self._domains = [domain.lower() for domain in domains] if domains else []
+        self._concurrency = concurrency
+        self._host_concurrency = host_concurrency
+        self._delay = delay
+        self._timeout = timeout
+        self._use_sitemaps = use_sitemaps
+        self._respect_robots = respect_robots
+
+        self._state_path = os.path.join(output_path, CRAWL_STATE_FILE)
+        self._state: Dict[str, dict] = {}
+        self._hosts: Dict[str, _Host] = {}
+        self._seen: Set[str] = set()
+        self._hashes: Dict[str, str] = {}
+        self._queue = None
+        self.stats = {"fetched": 0, "unchanged": 0, "saved": 0, "duplicates": 0, "skipped": 0, "failed": 0}
+
+    def _load_state(self) -> None:
+        if os.path.exists(self._state_path):
+            with open(self._state_path, "r") as f:
+                self._state = json.load(f)
+        for url, page in self._state.items():
+            if page.get("file"):
+                self._hashes.setdefault(page["hash"], url)
+
+    def _save_state(self) -> None:
+        tmp_path = self._state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(tmp_path, self._state_path)
+
+    def _allowed(self, url:str) -> bool:
+        host = urlparse(url).hostname or ""
+        return any(host == domain or host.endswith("." + domain) for domain in self._domains)
+
+    def _host(self, url:str) -> _Host:
+        netloc = urlparse(url).netloc.lower()
+        if netloc not in self._hosts:
+            self._hosts[netloc] = _Host(self._host_concurrency)
+        return self._hosts[netloc]
+
+    async def _request(self, session:aiohttp.ClientSession, url:str, headers:Optional[dict]=None) -> Tuple[int, Mapping[str, str], bytes]:
+        host = self._host(url)
+        async with host.semaphore:
+            # politeness: requests to a host are spaced by delay seconds
+            async with host.lock:
+                wait = host.next_request - time.monotonic()
+                host.next_request = max(host.next_request, time.monotonic()) + self._delay
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with session.get(url, headers=headers or {}, allow_redirects=True) as response:
+                return response.status, response.headers.copy(), await response.read()
+
+    async def _robots(self, session:aiohttp.ClientSession, url:str) -> Optional[RobotFileParser]:
+        host = self._host(url)
+        if host.robots is None:
+            urlobj = urlparse(url)
+            robots = RobotFileParser()
+            try:
+                status, _, body = await self._request(session, "%s://%s/robots.txt" % (urlobj.scheme, urlobj.netloc))
+                robots.parse(body.decode("utf-8", "replace").splitlines() if status == 200 else [])
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                robots.parse([])
+            host.robots = robots
+        return host.robots
+
+    def _enqueue(self, url:str, depth:int) -> None:
+        url = normalize_url(url)
+        if url in self._seen or depth > self._max_depth or not self._allowed(url):
+            return
+        if len(self._seen) >= self._max_pages:
+            return
+        self._seen.add(url)
+        self._queue.put_nowait((url, depth))
+
+    async def _add_sitemap(self, session:aiohttp.ClientSession, url:str, nested:int=0) -> None:
+        try:
+            status, _, body = await self._request(session, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return
+        if status != 200:
+            return
+
+        pages, sitemaps = parse_sitemap(body)
+        print("> sitemap %s: %d pages" % (url, len(pages)))
+        for page in pages:
+            self._enqueue(page, 0)
+        if nested < 2:
+            for sitemap in sitemaps:
+                await self._add_sitemap(session, sitemap, nested + 1)
+
+    def _remove_saved(self, page:dict) -> None:
+        if page.get("file"):
+            try:
+                os.remove(os.path.join(self._output_path, page["file"]))
+            except FileNotFoundError:
+                pass
+
+    def _saved_links(self, url:str, page:dict) -> List[str]:
+        # an unchanged page is not downloaded again, so its links come from the saved copy
+        if not page.get("file") or not page.get("html"):
+            return []
+        try:
+            with open(os.path.join(self._output_path, page["file"]), "r", encoding="utf-8", errors="replace") as f:
+                return extract_links(url, f.read())
+        except FileNotFoundError:
+            return []
+
+    async def _fetch(self, session:aiohttp.ClientSession, url:str, depth:int) -> None:
+        if self._respect_robots:
+            robots = await self._robots(session, url)
+            if not robots.can_fetch(_USER_AGENT, url):
+                self.stats["skipped"] += 1
+                return
+
+        page = self._state.get(url, {})
+        headers = {"User-Agent": _USER_AGENT}
+        if page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+
+        try:
+            status, response_headers, body = await self._request(session, url, headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print("> failed to fetch %s: %s" % (url, e))
+            self.stats["failed"] += 1
+            return
+        self.stats["fetched"] += 1
+
+        if status == 304:
+            self.stats["unchanged"] += 1
+            page["crawled"] = time.time()
+            links = self._saved_links(url, page)
+        elif status == 200:
+            content_type = response_headers.get("Content-Type", "")
+            digest = hashlib.sha256(body).hexdigest()
+            page = {
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified"),
+                "hash": digest,
+                "html": content_type.split(";")[0].strip() in _HTML_TYPES,
+                "crawled": time.time(),
+                "file": None,
+            }
+
+            duplicate = self._hashes.get(digest)
+            if duplicate and duplicate != url:
+                # the same content under another URL, e.g., index.html and /
+                self.stats["duplicates"] += 1
+                self._remove_saved(self._state.get(url, {}))
+            else:
+                self._hashes[digest] = url
+                page["file"] = url_file_name(url, content_type)
+                with open(os.path.join(self._output_path, page["file"]), "wb") as f:
+                    f.write(body)
+                self.stats["saved"] += 1
+            links = extract_links(url, body.decode("utf-8", "replace")) if page["html"] else []
+        else:
+            print("> %s returned %d" % (url, status))
+            self.stats["failed"] += 1
+            if 400 <= status < 500 and url in self._state:
+                # the page is gone, so is its copy
+                self._remove_saved(self._state.pop(url))
+            return
+
+        self._state[url] = page
+        if depth < self._max_depth:
+            for link in links:
+                self._enqueue(link, depth + 1)
+
+    async def _worker(self, session:aiohttp.ClientSession) -> None:
+        while True:
+            url, depth = await self._queue.get()
+            try:
+                await self._fetch(session, url, depth)
+            except Exception as e:
+                print("> failed to crawl %s: %s" % (url, e))
+                self.stats["failed"] += 1
+            finally:
+                self._queue.task_done()
+
+    async def crawl(self, seeds:Iterable[str]) -> dict:
+        """Crawls from the seed URLs and returns the crawl statistics."""
+        os.makedirs(self._output_path, exist_ok=True)
+        self._load_state()
+
+        seeds = [normalize_url(seed) for seed in seeds]
+        if not self._domains:
+            self._domains = sorted({urlparse(seed).hostname for seed in seeds if urlparse(seed).hostname})
+
+        self._queue = asyncio.Queue()
+        timeout = aiohttp.ClientTimeout(total=self._timeout)
+        async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": _USER_AGENT}) as session:
+            for seed in seeds:
+                self._enqueue(seed, 0)
+            if self._use_sitemaps:
+                sites = sorted({"%s://%s" % (urlparse(seed).scheme, urlparse(seed).netloc) for seed in seeds})
+                await asyncio.gather(*(self._add_sitemap(session, site + "/sitemap.xml") for site in sites))
+
+            workers = [asyncio.create_task(self._worker(session)) for _ in range(self._concurrency)]
+            await self._queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        self._save_state()
+        return self.stats
+
+
+def read_seeds(lines:Iterable[str]) -> List[str]:
+    """Returns the URLs of a seed list, skipping comments and empty lines, as .url lists."""
+    seeds = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            seeds.append(line)
+    return seeds
+
+
+def crawl(seeds:List[str], output_path:str, **kwargs) -> dict:
+    """Runs a Crawler (see its parameters) to completion."""
+    return asyncio.run(Crawler(output_path, **kwargs).crawl(seeds))
+
+
+############################
+# Crawl web sites
+############################
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='crawler',
+        description='Crawl web sites into a folder of pages for create_vectordb')
+
+    parser.add_argument('-d', '--depth', type=int, default=3, help='links followed from a seed')
+    parser.add_argument('--max_pages', type=int, default=10000, help='pages fetched at most')
+    parser.add_argument('--domain', action='append', help='allowed domain, repeatable (default: the seeds\' domains)')
+    parser.add_argument('--concurrency', type=int, default=16, help='pages fetched at once')
+    parser.add_argument('--host_concurrency', type=int, default=2, help='pages fetched at once from one host')
+    parser.add_argument('--delay', type=float, default=0.5, help='seconds between requests to one host')
+    parser.add_argument('--no_sitemap', action='store_true', help='do not read sitemap.xml')
+    parser.add_argument('--ignore_robots', action='store_true', help='do not read robots.txt')
+    parser.add_argument('-o', '--output', required=True, help='folder the pages are saved to')
+    parser.add_argument('seeds', nargs='+', help='seed URLs, or files of seed URLs')
+    args = parser.parse_args()
+
+    seeds = []
+    for seed in args.seeds:
+        if os.path.isfile(seed):
+            with open(seed, "r") as f:
+                seeds.extend(read_seeds(f))
+        else:
+            seeds.append(seed)
+
+    stats = crawl(seeds, args.output, max_depth=args.depth, max_pages=args.max_pages, domains=args.domain, concurrency=args.concurrency, host_concurrency=args.host_concurrency, delay=args.delay, use_sitemaps=not args.no_sitemap, respect_robots=not args.ignore_robots)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
 
 import os
-import pathlib
 import argparse
+import atexit
 import shutil
 import tarfile
 import zipfile
 import requests
-import base64
 
 from concurrent.futures import ThreadPoolExecutor
-from urllib.parse import urlparse
 from vectordb import VectorDB
+from chunkstore import ChunkStore
+from checkpoint import CheckpointLog
+from flatindex import FLAT_DTYPES
+from hnsw import add_hnsw_arguments
+from artifact import publish_artifact
+from soffice_pool import SofficeConverter
+from crawler import CRAWL_STATE_FILE, crawl, read_seeds, url_file_name, url_of_file_name
 from webdav3.client import Client
 
 
 scratch_root = "./scratch"
 scratch_inter_root = "./scratch_intermediate"
+chunk_root = "./chunks"
+checkpoint_root = "./checkpoints"
+report_root = "./reports"
+conversion_root = "./conversions"
 vectordb_root = "./vectordb"
 webdav_options = {
     'webdav_hostname': "https://data.cyverse.org",
@@ -41,49 +50,15 @@ def download_course_resource_webdav(course_name:str, no_download:bool) -> str:
         webdav_client.download_sync(remote_path=url_path, local_path=target_path)
     return target_path
 
-def get_extension_for_content_type(content_type:str) -> str:
-    content_type_arr = content_type.split(";")
-    for content_type in content_type_arr:
-        match content_type:
-            case "text/html" | "application/xhtml+xml":
-                return "html"
-            case "application/pdf":
-                return "pdf"
-            case "application/vnd.ms-powerpoint":
-                return "ppt"
-            case "application/vnd.openxmlformats-officedocument.presentationml.presentation":
-                return "pptx"
-            case "text/plain":
-                return "txt"
-            case "application/msword" | "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                return "docx"
-            case "text/markdown":
-                return "md"
-            case _:
-                pass
-    
-    return "unknown"
-
 def download_web_resource(url:str, output_path:str) -> None:
     print("retrieving data from url %s" % url)
     r = requests.get(url)
 
     content_type = r.headers["Content-Type"]
-    urlobj = urlparse(url)
-    fileext = ""
-    
-    if len(urlobj.path) > 0:
-        fileext = pathlib.Path(urlobj.path).suffix
-        if not fileext:
-            newext = get_extension_for_content_type(content_type)
-            if newext:
-                fileext = "." + newext
-    
-    output_path_url = os.path.join(output_path, "b64:" + base64.b64encode(url.encode("ascii")).decode("ascii"))
-    output_path_url = output_path_url + fileext
+    output_path_url = os.path.join(output_path, url_file_name(url, content_type))
 
-    with open(output_path_url, "w") as f:
-        f.write(r.text)
+    with open(output_path_url, "wb") as f:
+        f.write(r.content)
 
 def download_web_resources(urls:str, output_path:str) -> None:
     with ThreadPoolExecutor(max_workers=16) as executor:
@@ -100,15 +75,18 @@ def is_file_ignored(name:str) -> bool:
     if name.startswith("~"):
         # ignore temp files
         return True
+    if name.startswith(CRAWL_STATE_FILE):
+        # validators of crawled pages
+        return True
     return False
 
 def is_bundle_file(name:str) -> bool:
     lname = name.lower()
-    if lname.endswith(".tar") or lname.endswith(".tar.gz") or lname.endswith(".zip") or lname.endswith(".url"):
+    if lname.endswith(".tar") or lname.endswith(".tar.gz") or lname.endswith(".zip") or lname.endswith(".url") or lname.endswith(".crawl"):
         return True
     return False
 
-def extract_bundle_files(course_material_path:str) -> None:
+def extract_bundle_files(course_material_path:str, crawl_depth:int=3, crawl_max_pages:int=10000) -> None:
     for root, _, files in os.walk(course_material_path, topdown=True):
         for file in files:
             # file
@@ -157,6 +135,32 @@ def extract_bundle_files(course_material_path:str) -> None:
                 with open(fullpath, "r") as url_f:
                     lines = url_f.readlines()
                     download_web_resources(lines, webpath)
+            elif file.lower().endswith(".crawl"):
+                # seed URLs, crawled again on every run; only changed pages are downloaded
+                print("crawling %s" % fullpath)
+                webpath = os.path.join(dirpath, file + ".crawled")
+
+                with open(fullpath, "r") as crawl_f:
+                    seeds = read_seeds(crawl_f)
+                stats = crawl(seeds, webpath, max_depth=crawl_depth, max_pages=crawl_max_pages)
+                print("crawled %s: %s" % (fullpath, stats))
+
+
+def convert_legacy_files(converter:SofficeConverter, course_material_path:str) -> None:
+    paths = []
+    for root, _, files in os.walk(course_material_path, topdown=True):
+        for file in files:
+            if not is_file_ignored(file) and converter.converts(file):
+                paths.append(os.path.join(root, file))
+    # concurrently on all instances, files are then added from the cache
+    converter.convert_all(paths)
+    print("converted %d files: %s" % (len(paths), converter.stats))
+
+
+def publish_course(args:argparse.Namespace, vectordb_path:str, course_name:str, collection_name:str) -> None:
+    if args.publish_root and not args.create_allinone:
+        version = publish_artifact(vectordb_path, args.publish_root, course_name, info={"collection": collection_name, "backend": args.backend})
+        print("published %s version %s" % (course_name, version))
 
 
 ############################
@@ -172,9 +176,48 @@ def main() -> None:
     parser.add_argument('--delete_old', action='store_true', help='delete old db and intermediate docs')
     parser.add_argument('--create_allinone', action='store_true', help='create all-in-one db')
     parser.add_argument('--prepare_source', action='store_true', help='prepare source only (download and extract)')
+    parser.add_argument('--backend', choices=['chroma', 'flat'], default='chroma', help='vector store backend')
+    parser.add_argument('--flat_dtype', choices=FLAT_DTYPES, default='float16', help='embedding storage type for the flat backend')
+    parser.add_argument('--flat_keep_float32', action='store_true', help='also keep float32 embeddings in a flat index, to measure recall with flatindex.py')
+    parser.add_argument('--publish_root', help='publish a versioned artifact of each db to this folder')
+    parser.add_argument('--phase', choices=['all', 'parse', 'index'], default='all', help='parse sources into the chunk store, index the chunk store, or both')
+    parser.add_argument('--chunk_root', default=chunk_root, help='folder of the per-course chunk stores')
+    parser.add_argument('--sheet_max_rows', type=int, default=100000, help='rows read per spreadsheet sheet')
+    parser.add_argument('--sheet_max_cells', type=int, default=1000000, help='cells read per spreadsheet sheet')
+    parser.add_argument('--pdf_workers', type=int, help='processes parsing a large PDF (default: one per CPU)')
+    parser.add_argument('--pdf_pages_per_task', type=int, default=50, help='PDF pages parsed per worker task')
+    parser.add_argument('--index_batch_size', type=int, default=1024, help='chunks embedded per batch when indexing a chunk store')
+    parser.add_argument('--commit_batch_size', type=int, default=256, help='chunks committed to the vector store per checkpointed batch')
+    parser.add_argument('--no_isolation', action='store_true', help='parse files in this process instead of an isolated worker per file')
+    parser.add_argument('--file_timeout', type=float, default=1800, help='seconds a file may take to parse')
+    parser.add_argument('--file_max_memory_mb', type=float, default=8192, help='private memory a file may take to parse, in MB')
+    parser.add_argument('--resume', action='store_true', help='resume an interrupted run from its checkpoint log')
+    parser.add_argument('--embed_threads', type=int, help='CPU threads per embedding model instance (default: GPT4All\'s choice)')
+    parser.add_argument('--embed_instances', type=int, default=1, help='embedding model instances, each in its own process when more than one')
+    parser.add_argument('--soffice_instances', type=int, default=2, help='LibreOffice instances converting .ppt, .doc and .xls files, 0 to parse them directly')
+    parser.add_argument('--conversion_cache', default=conversion_root, help='folder of converted .ppt, .doc and .xls files')
+    parser.add_argument('--crawl_depth', type=int, default=3, help='links followed from the seeds of .crawl files')
+    parser.add_argument('--crawl_max_pages', type=int, default=10000, help='pages fetched per .crawl file')
+    add_hnsw_arguments(parser)
     parser.add_argument('course_numbers', nargs="+", help='course number')
     args = parser.parse_args()
 
+    hnsw = {
+        "space": args.hnsw_space,
+        "m": args.hnsw_m,
+        "construction_ef": args.hnsw_construction_ef,
+        "search_ef": args.hnsw_search_ef,
+    }
+
+    converter = None
+    if args.soffice_instances > 0 and args.phase != "index":
+        try:
+            converter = SofficeConverter(size=args.soffice_instances, cache_root=os.path.abspath(args.conversion_cache))
+            # the instances run in their own sessions, stop them however the run ends
+            atexit.register(converter.close)
+        except FileNotFoundError:
+            print("soffice is not installed, parsing .ppt, .doc and .xls files directly")
+
     for course_number in args.course_numbers:
         course_name = course_number.upper().strip()
 
@@ -185,7 +228,7 @@ def main() -> None:
 
         # create
         # save file to local
-        course_material_path = download_course_resource_webdav(course_name, no_download=args.no_download)
+        course_material_path = download_course_resource_webdav(course_name, no_download=args.no_download or args.phase == "index")
         
         intermedate_doc_output_path = os.path.join(scratch_inter_root, course_name)
         intermedate_doc_output_path = os.path.abspath(intermedate_doc_output_path)
@@ -198,9 +241,11 @@ def main() -> None:
         else:
             collection_name = course_name
 
-        if args.delete_old:
+        if args.delete_old and args.resume:
+            print("resuming, keeping old vectordb and intermediate docs")
+        elif args.delete_old:
             # clear
-            if os.path.exists(vectordb_path):
+            if os.path.exists(vectordb_path) and args.phase != "parse":
                 print("removing old vectordb - %s" % vectordb_path)
                 shutil.rmtree(vectordb_path)
 
@@ -208,16 +253,51 @@ def main() -> None:
                 print("removing old doc - %s" % intermedate_doc_output_path)
                 shutil.rmtree(intermedate_doc_output_path)
 
-        print("creating vectordb - %s, collection - %s" % (vectordb_path, collection_name))
-        vectorstore = VectorDB(db_path=vectordb_path, collection_name=collection_name)
+        chunk_store = ChunkStore(os.path.join(os.path.abspath(args.chunk_root), course_name))
+        # one log per course and phase, removed once the course is done
+        checkpoint_path = os.path.join(os.path.abspath(checkpoint_root), "%s-%s.jsonl" % (course_name, args.phase))
+
+        if args.phase == "index":
+            # rebuild from the chunk store, without touching the sources
+            if not chunk_store.exists():
+                print("no chunk store for %s at %s, run with --phase parse first" % (course_name, chunk_store.path))
+                continue
+
+            print("creating vectordb - %s, collection - %s from %s" % (vectordb_path, collection_name, chunk_store.path))
+            checkpoint = CheckpointLog(checkpoint_path, resume=args.resume)
+            vectorstore = VectorDB(db_path=vectordb_path, collection_name=collection_name, backend=args.backend, flat_dtype=args.flat_dtype, flat_keep_float32=args.flat_keep_float32, hnsw=hnsw, checkpoint=checkpoint, commit_batch_size=args.commit_batch_size, embed_threads=args.embed_threads, embed_instances=args.embed_instances)
+            vectorstore.add_chunk_store(chunk_store, batch_size=args.index_batch_size)
+            vectorstore.close()
+            checkpoint.close(remove=True)
+            print("VectorDB for %s is created" % course_name)
+            publish_course(args, vectordb_path, course_name, collection_name)
+            continue
+
+        checkpoint = CheckpointLog(checkpoint_path, resume=args.resume)
+        if checkpoint.resumed:
+            print("resuming from %s" % checkpoint_path)
+
+        if args.phase == "parse":
+            print("creating chunk store - %s" % chunk_store.path)
+        else:
+            print("creating vectordb - %s, collection - %s" % (vectordb_path, collection_name))
+        vectorstore = VectorDB(db_path=vectordb_path, collection_name=collection_name, backend=args.backend, flat_dtype=args.flat_dtype, flat_keep_float32=args.flat_keep_float32, hnsw=hnsw, chunk_store=chunk_store, index=args.phase == "all", sheet_max_rows=args.sheet_max_rows, sheet_max_cells=args.sheet_max_cells, pdf_workers=args.pdf_workers, pdf_pages_per_task=args.pdf_pages_per_task, checkpoint=checkpoint, commit_batch_size=args.commit_batch_size, isolate_files=not args.no_isolation, file_timeout=args.file_timeout, file_max_memory_mb=args.file_max_memory_mb, embed_threads=args.embed_threads, embed_instances=args.embed_instances, converter=converter)
 
         print("check tarballs/zip files")
-        extract_bundle_files(course_material_path)
+        extract_bundle_files(course_material_path, crawl_depth=args.crawl_depth, crawl_max_pages=args.crawl_max_pages)
+
+        if converter:
+            print("converting legacy office files")
+            convert_legacy_files(converter, course_material_path)
 
         if args.prepare_source:
+            vectorstore.close()
+            checkpoint.close(remove=True)
             continue
             
         print("adding class materials for %s" % course_name)
+        last_file = checkpoint.last_file()
+        chunk_store.create(info={"course": course_name, "splitter": vectorstore.splitter_settings()}, resume=last_file["chunk_store"] if last_file else None)
         for root, dirs, files in os.walk(course_material_path, topdown=True):
             for file in files:
                 # file
@@ -229,8 +309,7 @@ def main() -> None:
 
                 source = relpath
                 if file.startswith("b64:"):
-                    newfile = file[4:].split(".")[0]
-                    source = base64.b64decode(newfile).decode("ascii")
+                    source = url_of_file_name(file)
 
                 if is_file_ignored(file):
                     # ignore temp files
@@ -250,7 +329,25 @@ def main() -> None:
                     vectorstore.add_file(path=fullpath, source=source)
 
 
+        chunk_store.close()
+        vectorstore.close()
+        checkpoint.close(remove=True)
+
+        report_path = os.path.join(os.path.abspath(report_root), "%s-%s.json" % (course_name, args.phase))
+        vectorstore.report.write(report_path)
+        print(vectorstore.report.summary())
+        print("report for %s is written to %s" % (course_name, report_path))
+        print("chunk store for %s is created, %d chunks" % (course_name, len(chunk_store)))
+        if args.phase == "parse":
+            continue
+
         print("VectorDB for %s is created" % course_name)
+        publish_course(args, vectordb_path, course_name, collection_name)
+
+    if args.publish_root and args.create_allinone and not args.prepare_source and args.phase != "parse":
+        collection_names = [course_number.upper().strip() for course_number in args.course_numbers]
+        version = publish_artifact(os.path.abspath(vectordb_root), args.publish_root, "ALLINONE", info={"collections": collection_names, "backend": args.backend})
+        print("published ALLINONE version %s" % version)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the embedding worker pool used to embed chunks on all CPU cores."""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+# the model of a pool worker process, see _init_worker()
+_worker_model = None
+
+
+def _load_model(threads:Optional[int]):
+    # the same model GPT4AllEmbeddings loads
+    from gpt4all import Embed4All
+    return Embed4All(n_threads=threads)
+
+
+def _init_worker(threads:Optional[int]) -> None:
+    global _worker_model
+    _worker_model = _load_model(threads)
+
+
+def _embed_batch(texts:List[str]) -> List[List[float]]:
+    return [list(map(float, _worker_model.embed(text))) for text in texts]
+
+
+class EmbeddingPool(Embeddings):
+    """
+    This class embeds texts with GPT4All on `instances` model instances, each
+    using `threads` CPU threads. With one instance the model runs in this
+    process; with more, each instance runs in its own worker process, and
+    texts are split into batches of batch_size that the workers take from a
+    shared queue, so a slow batch does not hold the others back. Results
+    keep the order of the texts.
+
+    Params:
+      threads  CPU threads per instance (default: GPT4All's choice)
+      instances  model instances (worker processes when more than one)
+      batch_size  texts per batch sent to a worker
+    """
+
+    def __init__(self, threads:Optional[int]=None, instances:int=1, batch_size:int=32):
+        self._threads = threads
+        self._instances = max(1, instances)
+        self._batch_size = batch_size
+        self._model = None
+        self._executor = None
+
+        if self._instances == 1:
+            self._model = _load_model(threads)
+        else:
+            # spawned, so a worker does not inherit the parent's threads or loaded models
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._instances,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(threads,),
+            )
+
+    @property
+    def threads(self) -> Optional[int]:
+        return self._threads
+
+    @property
+    def instances(self) -> int:
+        return self._instances
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        if self._model is not None:
+            return [list(map(float, self._model.embed(text))) for text in texts]
+
+        batches = [texts[start:start + self._batch_size] for start in range(0, len(texts), self._batch_size)]
+        embeddings = []
+        for batch in self._executor.map(_embed_batch, batches):
+            embeddings.extend(batch)
+        return embeddings
+
+    def embed_query(self, text:str) -> List[float]:
+        if self._model is not None:
+            return list(map(float, self._model.embed(text)))
+        return self._executor.submit(_embed_batch, [text]).result()[0]
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""This module holds the offline retrieval evaluation: recall@k, MRR and latency of a collection against a golden question set."""
+
+import argparse
+import json
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from langchain_community.retrievers import TFIDFRetriever
+from langchain_core.documents import Document
+
+from vectordb_reader import VectorDBReader
+
+EVAL_MODES = ("vector", "mmr", "tfidf", "hybrid")
+# reciprocal rank fusion constant of the hybrid mode
+RRF_K = 60
+
+
+def load_golden(path:str) -> List[dict]:
+    """
+    Reads a golden set, one JSON object per line:
+    {"question": "...", "sources": ["syllabus.pdf", ...]}
+    A retrieved document is relevant when its source contains one of the
+    expected sources (case-insensitive).
+    """
+    golden = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            golden.append(json.loads(line))
+    return golden
+
+
+def _doc_key(doc:Document) -> tuple:
+    return (doc.metadata.get("source", ""), doc.page_content)
+
+
+def reciprocal_rank_fusion(rankings:List[List[Document]], k:int) -> List[Document]:
+    """Merges several rankings of documents, scoring each by the sum of 1/(RRF_K + rank)."""
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            docs.setdefault(key, doc)
+    keys = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in keys]
+
+
+def make_searchers(reader:VectorDBReader, modes:List[str], k:int, fetch_k:int) -> Dict[str, Callable[[str], List[Document]]]:
+    searchers = {}
+    vector = reader.as_retriever(k=k)
+    if "vector" in modes:
+        searchers["vector"] = vector.get_relevant_documents
+    if "mmr" in modes:
+        searchers["mmr"] = reader.as_retriever(k=k, search_type="mmr", fetch_k=fetch_k).get_relevant_documents
+
+    if "tfidf" in modes or "hybrid" in modes:
+        print("building tf-idf index")
+        tfidf = TFIDFRetriever.from_documents(reader.documents(), k=k)
+        if "tfidf" in modes:
+            searchers["tfidf"] = tfidf.get_relevant_documents
+        if "hybrid" in modes:
+            vector_candidates = reader.as_retriever(k=fetch_k)
+            tfidf_candidates = tfidf.copy(update={"k": fetch_k})
+            searchers["hybrid"] = lambda question: reciprocal_rank_fusion(
+                [vector_candidates.get_relevant_documents(question), tfidf_candidates.get_relevant_documents(question)], k)
+    return searchers
+
+
+def _first_relevant_rank(docs:List[Document], sources:List[str]) -> int:
+    expected = [source.lower() for source in sources]
+    for rank, doc in enumerate(docs, start=1):
+        source = str(doc.metadata.get("source", "")).lower()
+        if any(item in source for item in expected):
+            return rank
+    return 0
+
+
+def evaluate(search:Callable[[str], List[Document]], golden:List[dict], ks:List[int]) -> dict:
+    ranks = []
+    latencies = []
+    for item in golden:
+        start = time.perf_counter()
+        docs = search(item["question"])
+        latencies.append(time.perf_counter() - start)
+        ranks.append(_first_relevant_rank(docs, item["sources"]))
+
+    ranks = np.asarray(ranks)
+    latencies = np.asarray(latencies) * 1000
+    found = ranks > 0
+    result = {"recall@%d" % k: float(np.mean(found & (ranks <= k))) for k in ks}
+    result["mrr"] = float(np.mean(np.where(found, 1.0 / np.maximum(ranks, 1), 0.0)))
+    result["p50_ms"] = float(np.percentile(latencies, 50))
+    result["p99_ms"] = float(np.percentile(latencies, 99))
+    result["mean_ms"] = float(latencies.mean())
+    result["misses"] = [item["question"] for item, rank in zip(golden, ranks) if rank == 0]
+    return result
+
+
+def check_budget(results:dict, baseline:dict, max_recall_drop:float) -> List[str]:
+    """Returns the metrics that dropped more than max_recall_drop below the baseline."""
+    regressions = []
+    for mode, metrics in results["modes"].items():
+        for name, value in metrics.items():
+            if not (name.startswith("recall@") or name == "mrr"):
+                continue
+            base = baseline.get("modes", {}).get(mode, {}).get(name)
+            if base is not None and base - value > max_recall_drop:
+                regressions.append("%s %s: %.3f -> %.3f" % (mode, name, base, value))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='eval_retrieval',
+        description='Measure retrieval recall@k, MRR and latency against a golden question set')
+    parser.add_argument('--golden', required=True, help='golden set, one {"question", "sources"} json object per line')
+    parser.add_argument('--k', nargs='+', type=int, default=[1, 3, 5], help='cutoffs for recall@k')
+    parser.add_argument('--fetch_k', type=int, default=20, help='candidates fetched by the mmr and hybrid modes')
+    parser.add_argument('--modes', nargs='+', choices=EVAL_MODES, default=list(EVAL_MODES), help='retrieval modes to evaluate')
+    parser.add_argument('--backend', choices=['chroma', 'flat'], default='chroma', help='vector store backend')
+    parser.add_argument('--search_ef', type=int, help='hnsw search_ef override')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='results json of a previous run to compare with')
+    parser.add_argument('--max_recall_drop', type=float, default=0.02, help='largest recall@k or MRR drop from the baseline allowed')
+    parser.add_argument('db_path', help='vectordb path')
+    parser.add_argument('collection', nargs='?', default='langchain', help='collection name')
+    args = parser.parse_args()
+
+    golden = load_golden(args.golden)
+    if not golden:
+        sys.exit("no golden questions in %s" % args.golden)
+    print("%d golden questions" % len(golden))
+
+    reader = VectorDBReader(db_path=args.db_path, collection_name=args.collection, backend=args.backend, search_ef=args.search_ef)
+    searchers = make_searchers(reader, args.modes, max(args.k), args.fetch_k)
+
+    results = {
+        "db_path": args.db_path,
+        "collection": args.collection,
+        "backend": args.backend,
+        "queries": len(golden),
+        "modes": {},
+    }
+    for mode, search in searchers.items():
+        # warm up caches and lazy loads outside the measurement
+        search(golden[0]["question"])
+        results["modes"][mode] = evaluate(search, golden, args.k)
+        print(json.dumps({"mode": mode, **{name: value for name, value in results["modes"][mode].items() if name != "misses"}}))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = check_budget(results, baseline, args.max_recall_drop)
+        if regressions:
+            print("quality regressions beyond %.3f:" % args.max_recall_drop)
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("quality is within %.3f of the baseline" % args.max_recall_drop)
+
+
+if __name__ == "__main__":
+    main()
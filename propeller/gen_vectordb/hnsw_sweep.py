@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""Measures HNSW recall@k against brute force and query latency over a grid of settings."""
+
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+import chromadb
+
+from chromadb.utils.batch_utils import create_batches
+from langchain_community.embeddings import GPT4AllEmbeddings
+
+from hnsw import HNSW_SPACES, hnsw_metadata, set_search_ef
+
+
+def load_collection(db_path:str, collection_name:str):
+    client_settings = chromadb.Settings()
+    client_settings.persist_directory=db_path
+    client_settings.is_persistent=True
+    client = chromadb.Client(client_settings)
+
+    collection = client.get_collection(collection_name, embedding_function=None)
+    data = collection.get(include=["embeddings"])
+    return data["ids"], np.asarray(data["embeddings"], dtype=np.float32)
+
+
+def brute_force(embeddings:np.ndarray, queries:np.ndarray, space:str, k:int) -> np.ndarray:
+    """Returns the exact top-k row indices of each query for the given space."""
+    if space == "l2":
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ embeddings.T + (embeddings ** 2).sum(axis=1)[None, :]
+    elif space == "cosine":
+        norm_e = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norm_q = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        distances = 1.0 - norm_q @ norm_e.T
+    else:
+        distances = 1.0 - queries @ embeddings.T
+
+    return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+
+def sweep_point(client, ids:list, embeddings:np.ndarray, queries:np.ndarray, truth:np.ndarray, space:str, m:int, construction_ef:int, search_efs:list, k:int) -> list:
+    metadata = hnsw_metadata(space=space, m=m, construction_ef=construction_ef)
+    collection = client.create_collection("sweep", metadata=metadata, embedding_function=None)
+
+    build_start = time.perf_counter()
+    for batch_ids, batch_embeddings, _, _ in create_batches(api=client, ids=ids, embeddings=embeddings.tolist()):
+        collection.add(ids=batch_ids, embeddings=batch_embeddings)
+    build_sec = time.perf_counter() - build_start
+
+    row_of_id = {docid: row for row, docid in enumerate(ids)}
+    results = []
+    for search_ef in search_efs:
+        set_search_ef(client, collection, search_ef)
+
+        latencies = []
+        hits = 0
+        for query, expected in zip(queries, truth):
+            query_start = time.perf_counter()
+            found = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+            latencies.append(time.perf_counter() - query_start)
+
+            rows = set(row_of_id[docid] for docid in found["ids"][0])
+            hits += len(rows & set(expected.tolist()))
+
+        latencies_ms = np.asarray(latencies) * 1000.0
+        results.append({
+            "space": space,
+            "M": m,
+            "construction_ef": construction_ef,
+            "search_ef": search_ef,
+            "k": k,
+            "recall": hits / float(truth.size),
+            "latency_ms_p50": float(np.percentile(latencies_ms, 50)),
+            "latency_ms_p99": float(np.percentile(latencies_ms, 99)),
+            "latency_ms_mean": float(latencies_ms.mean()),
+            "build_sec": build_sec,
+        })
+
+    client.delete_collection("sweep")
+    return results
+
+
+############################
+# Sweep hnsw settings
+############################
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='hnsw_sweep',
+        description='Measure hnsw recall@k and query latency across a grid of settings')
+
+    parser.add_argument('--queries', required=True, help='file with one query per line')
+    parser.add_argument('--k', type=int, default=4, help='number of results per query')
+    parser.add_argument('--space', nargs='+', choices=HNSW_SPACES, default=['l2'], help='distance functions to try')
+    parser.add_argument('--m', nargs='+', type=int, default=[8, 16, 32], help='M values to try')
+    parser.add_argument('--construction_ef', nargs='+', type=int, default=[100, 200], help='construction_ef values to try')
+    parser.add_argument('--search_ef', nargs='+', type=int, default=[10, 50, 100], help='search_ef values to try')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('db_path', help='vectordb path')
+    parser.add_argument('collection', nargs='?', default='langchain', help='collection name')
+    args = parser.parse_args()
+
+    print("loading %s, collection - %s" % (args.db_path, args.collection))
+    ids, embeddings = load_collection(args.db_path, args.collection)
+
+    with open(args.queries, "r") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    queries = np.asarray(GPT4AllEmbeddings().embed_documents(questions), dtype=np.float32)
+    print("%d vectors, %d queries" % (len(ids), len(queries)))
+
+    client = chromadb.Client(chromadb.Settings(anonymized_telemetry=False))
+
+    results = []
+    for space in args.space:
+        truth = brute_force(embeddings, queries, space, args.k)
+        for m, construction_ef in itertools.product(args.m, args.construction_ef):
+            for result in sweep_point(client, ids, embeddings, queries, truth, space, m, construction_ef, args.search_ef, args.k):
+                print(json.dumps(result))
+                results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
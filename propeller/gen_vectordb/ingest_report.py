@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the per-file resource report of an ingestion run."""
+
+import json
+import os
+from typing import Optional
+
+
+class IngestReport:
+    """
+    This class collects, for every file of an ingestion run, its status,
+    wall-clock time, peak memory, pages and chunks, and summarizes the
+    slowest and failed files.
+    """
+
+    def __init__(self):
+        self.files = []
+
+    def add(self, source:str, status:str, seconds:float, peak_memory_mb:Optional[float]=None, pages:int=0, chunks:int=0, error:Optional[str]=None) -> None:
+        self.files.append({
+            "source": source,
+            "status": status,
+            "seconds": round(seconds, 3),
+            "peak_memory_mb": round(peak_memory_mb, 1) if peak_memory_mb is not None else None,
+            "pages": pages,
+            "chunks": chunks,
+            "error": error,
+        })
+
+    def failed(self) -> list:
+        return [entry for entry in self.files if entry["status"] != "ok"]
+
+    def slowest(self, count:int=10) -> list:
+        return sorted(self.files, key=lambda entry: entry["seconds"], reverse=True)[:count]
+
+    def summary(self, count:int=10) -> str:
+        lines = [
+            "%d files, %d failed, %.1fs, %d pages, %d chunks" % (
+                len(self.files),
+                len(self.failed()),
+                sum(entry["seconds"] for entry in self.files),
+                sum(entry["pages"] for entry in self.files),
+                sum(entry["chunks"] for entry in self.files),
+            ),
+            "slowest files:",
+        ]
+        for entry in self.slowest(count):
+            lines.append("  %8.1fs %8s MB %5d pages %6d chunks  %s" % (entry["seconds"], entry["peak_memory_mb"], entry["pages"], entry["chunks"], entry["source"]))
+
+        if self.failed():
+            lines.append("failed files:")
+            for entry in self.failed():
+                lines.append("  %-8s %s - %s" % (entry["status"], entry["source"], entry["error"]))
+        return "\n".join(lines)
+
+    def write(self, path:str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"files": self.files, "slowest": [entry["source"] for entry in self.slowest()], "failed": self.failed()}, f, indent=2)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the isolated worker processes that files are parsed in."""
+
+import multiprocessing
+import os
+import signal
+import time
+from typing import Callable, Optional, Tuple
+
+# seconds between checks of a worker's run time and memory
+_POLL_SECONDS = 0.1
+
+
+def _children(pid:int) -> list:
+    children = []
+    try:
+        for task in os.listdir("/proc/%d/task" % pid):
+            with open("/proc/%d/task/%s/children" % (pid, task), "r") as f:
+                children.extend(int(child) for child in f.read().split())
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return children
+
+
+def _private_kb(pid:int) -> int:
+    # pages only this process uses, so memory shared copy-on-write with the
+    # parent, e.g., a loaded embedding model, is not counted
+    total = 0
+    try:
+        with open("/proc/%d/smaps_rollup" % pid, "r") as f:
+            for line in f:
+                if line.startswith("Private_Clean:") or line.startswith("Private_Dirty:"):
+                    total += int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return total
+
+
+def process_tree_memory_mb(pid:int) -> float:
+    """
+    Returns the private memory (unique set size) of a process and all its
+    descendants, e.g., PDF page workers, in MB.
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += _private_kb(current)
+        pending.extend(_children(current))
+    return total / 1024
+
+
+def _run_in_group(target:Callable, args:tuple, final_memory_mb) -> None:
+    # own process group, so a kill also reaches the worker's own workers
+    os.setpgrp()
+    target(*args)
+    # a worker may finish between two polls
+    final_memory_mb.value = process_tree_memory_mb(os.getpid())
+
+
+def run_isolated(target:Callable, args:tuple, timeout:Optional[float]=None, max_memory_mb:Optional[float]=None) -> Tuple[str, float, float]:
+    """
+    Runs target(*args) in a forked worker process and kills it (with its
+    descendants) when it runs longer than timeout seconds or its private
+    memory goes over max_memory_mb. The worker shares what this process has
+    loaded, so starting one is cheap and that memory is not counted.
+
+    Returns:
+      (status, seconds, peak memory in MB) with status one of "ok",
+      "timeout", "memory" or "failed"
+    """
+    context = multiprocessing.get_context("fork")
+    final_memory_mb = context.Value("d", 0.0, lock=False)
+    process = context.Process(target=_run_in_group, args=(target, args, final_memory_mb), daemon=False)
+    start = time.perf_counter()
+    process.start()
+
+    status = None
+    peak_memory_mb = 0.0
+    while True:
+        process.join(_POLL_SECONDS)
+        if process.exitcode is not None:
+            break
+
+        peak_memory_mb = max(peak_memory_mb, process_tree_memory_mb(process.pid))
+        if max_memory_mb and peak_memory_mb > max_memory_mb:
+            status = "memory"
+        elif timeout and time.perf_counter() - start > timeout:
+            status = "timeout"
+
+        if status:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # not in its own group yet
+                process.kill()
+            process.join()
+            break
+
+    seconds = time.perf_counter() - start
+    peak_memory_mb = max(peak_memory_mb, final_memory_mb.value)
+    if not status:
+        status = "ok" if process.exitcode == 0 else "failed"
+    process.close()
+    return status, seconds, peak_memory_mb
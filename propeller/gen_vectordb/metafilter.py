@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the metadata facets of chunks and the filters that scope a search to some of them."""
+
+import json
+import os
+import pathlib
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+# metadata fields indexed at ingest time for filtering and faceting
+FACET_FIELDS = ("source", "file_type", "module", "Header 1", "Header 2", "Header 3")
+SECTION_FIELDS = ("Header 1", "Header 2", "Header 3")
+# filter keys, see expand_filter()
+FILTER_KEYS = ("source", "section", "file_type", "module")
+
+
+def add_facets(metadata:dict) -> dict:
+    """
+    Adds the derived facets of a chunk to its metadata: file_type, the
+    extension of the source, and module, the top folder of the source (the
+    host of a web page).
+    """
+    source = str(metadata.get("source", ""))
+    if "file_type" not in metadata:
+        path = urlparse(source).path if "://" in source else source
+        metadata["file_type"] = pathlib.PurePosixPath(path).suffix.lstrip(".").lower()
+    if "module" not in metadata:
+        if "://" in source:
+            metadata["module"] = urlparse(source).netloc.lower()
+        else:
+            parts = pathlib.PurePosixPath(source).parts
+            metadata["module"] = parts[0] if len(parts) > 1 else ""
+    return metadata
+
+
+def _as_list(value) -> List[str]:
+    if isinstance(value, (list, tuple, set)):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def _sources_with(vocabulary:Dict[str, Iterable[str]], field:str, values:set) -> set:
+    # chunks indexed before the derived facets were added only have their
+    # source, so they are matched by the sources the facets derive from
+    return {source for source in vocabulary.get("source", []) if add_facets({"source": source})[field] in values}
+
+
+def expand_filter(metadata_filter:dict, vocabulary:Dict[str, Iterable[str]]) -> List[Dict[str, set]]:
+    """
+    Turns a filter into the metadata values it allows, using the values the
+    collection holds per field (its vocabulary). A filter has any of:
+      source     source path prefix(es)
+      section    text a lecture or section header contains (any header level, case-insensitive)
+      file_type  file type(s), e.g., "pdf"
+      module     module(s), the top folder of the source
+    Keys are combined with AND, several values of a key with OR. file_type
+    and module also match by the sources they derive from, so chunks of
+    collections built before these facets were added are found as well.
+
+    Returns:
+      clauses, all of which must hold; a clause holds when one of its
+      fields has one of the allowed values
+    """
+    unknown = set(metadata_filter) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError("unsupported filter keys %s, use %s" % (sorted(unknown), ", ".join(FILTER_KEYS)))
+
+    clauses = []
+    for key, value in metadata_filter.items():
+        if value is None or value == []:
+            continue
+        values = _as_list(value)
+        match key:
+            case "source":
+                allowed = {item for item in vocabulary.get("source", []) if any(item.startswith(prefix) for prefix in values)}
+                clauses.append({"source": allowed})
+            case "section":
+                needles = [needle.lower() for needle in values]
+                clauses.append({
+                    field: {item for item in vocabulary.get(field, []) if any(needle in item.lower() for needle in needles)}
+                    for field in SECTION_FIELDS
+                })
+            case "file_type":
+                file_types = {item.lstrip(".").lower() for item in values}
+                clauses.append({"file_type": file_types, "source": _sources_with(vocabulary, "file_type", file_types)})
+            case "module":
+                clauses.append({"module": set(values), "source": _sources_with(vocabulary, "module", set(values))})
+    return clauses
+
+
+def chroma_where(clauses:List[Dict[str, set]]) -> Optional[dict]:
+    """
+    Returns the Chroma where filter of expanded clauses, None for no filter,
+    or {} when no chunk can match.
+    """
+    conditions = []
+    for clause in clauses:
+        options = [{field: {"$in": sorted(values)}} for field, values in clause.items() if values]
+        if not options:
+            return {}
+        conditions.append(options[0] if len(options) == 1 else {"$or": options})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+class FacetIndex:
+    """
+    This class keeps the number of chunks per value of each facet field of a
+    collection, written next to the database at ingest time, so the values
+    of a collection (and so its filters) are known without scanning it.
+
+    Params:
+      path  the JSON file of the index
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        self._counts: Dict[str, Dict[str, int]] = {field: {} for field in FACET_FIELDS}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._counts.update(json.load(f))
+
+    @staticmethod
+    def path_for(db_path:str, collection_name:str) -> str:
+        return os.path.join(db_path, collection_name + ".facets.json")
+
+    def exists(self) -> bool:
+        return os.path.exists(self._path)
+
+    def add(self, metadatas:Iterable[dict]) -> None:
+        for metadata in metadatas:
+            for field in FACET_FIELDS:
+                value = metadata.get(field)
+                if value is not None and value != "":
+                    counts = self._counts[field]
+                    counts[str(value)] = counts.get(str(value), 0) + 1
+
+    def remove(self, metadatas:Iterable[dict]) -> None:
+        for metadata in metadatas:
+            for field in FACET_FIELDS:
+                value = metadata.get(field)
+                if value is not None and value != "":
+                    counts = self._counts[field]
+                    counts[str(value)] = counts.get(str(value), 0) - 1
+                    if counts[str(value)] <= 0:
+                        del counts[str(value)]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._counts, f)
+        os.replace(tmp_path, self._path)
+
+    def vocabulary(self) -> Dict[str, List[str]]:
+        return {field: list(counts) for field, counts in self._counts.items()}
+
+    def facets(self) -> Dict[str, Dict[str, int]]:
+        return {field: dict(counts) for field, counts in self._counts.items()}
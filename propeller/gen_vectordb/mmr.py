@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds vectorized maximal marginal relevance selection."""
+
+from typing import List
+
+import numpy as np
+
+
+def maximal_marginal_relevance(query_embedding:np.ndarray, embeddings:np.ndarray, k:int=4, lambda_mult:float=0.5) -> List[int]:
+    """
+    Returns the indices of k candidates picked by maximal marginal relevance,
+    in pick order. The query and candidate-to-candidate similarities are
+    computed once as matrix products, and the similarity of each candidate to
+    the already picked ones is kept as a running maximum, so each pick is a
+    single vector operation.
+
+    Params:
+      query_embedding  the query embedding
+      embeddings  a (candidates, dim) matrix of candidate embeddings
+      k  the number of candidates to pick
+      lambda_mult  1 ranks by relevance only, 0 by diversity only
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    count = embeddings.shape[0] if embeddings.ndim == 2 else 0
+    k = min(k, count)
+    if k <= 0:
+        return []
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.maximum(norms, 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    query_similarity = embeddings @ query
+    pair_similarity = embeddings @ embeddings.T
+
+    picked = [int(np.argmax(query_similarity))]
+    max_similarity = pair_similarity[picked[0]].copy()
+    available = np.ones(count, dtype=bool)
+    available[picked[0]] = False
+
+    while len(picked) < k:
+        scores = lambda_mult * query_similarity - (1.0 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        picked.append(pick)
+        available[pick] = False
+        np.maximum(max_similarity, pair_similarity[pick], out=max_similarity)
+
+    return picked
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the page-range PDF parsing run in worker processes."""
+
+from typing import List, Tuple
+
+from langchain_core.documents import Document
+import pypdf
+
+from textclean import segment_docs
+
+
+def page_count(pdf_path:str) -> int:
+    # pypdf only reads the page tree here, not the page contents
+    return len(pypdf.PdfReader(pdf_path).pages)
+
+
+def page_ranges(count:int, pages_per_task:int) -> List[Tuple[int, int]]:
+    """Returns [start, end) page ranges covering count pages."""
+    return [(start, min(start + pages_per_task, count)) for start in range(0, count, pages_per_task)]
+
+
+def parse_pdf_pages(pdf_path:str, start:int, end:int) -> List[Document]:
+    """
+    Extracts and segments pages [start, end) of a PDF, one document per page
+    with the same metadata as PyPDFLoader ("source" and the 0-based "page").
+    Runs in a worker process, so it only depends on light modules.
+    """
+    reader = pypdf.PdfReader(pdf_path)
+    docs = []
+    for page_number in range(start, end):
+        text = reader.pages[page_number].extract_text()
+        docs.append(Document(page_content=text, metadata={"source": pdf_path, "page": page_number}))
+    return segment_docs(docs, True)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the pool of long-lived LibreOffice instances that convert legacy Office files."""
+
+import hashlib
+import json
+import os
+import pathlib
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+# legacy formats and the formats they are converted to, with LibreOffice's export filter
+CONVERSIONS = {
+    ".ppt": ("pptx", "Impress MS PowerPoint 2007 XML"),
+    ".doc": ("docx", "MS Word 2007 XML"),
+    # openpyxl streams .xlsx, xlrd loads a whole .xls sheet
+    ".xls": ("xlsx", "Calc MS Excel 2007 XML"),
+}
+# converts through the UNO bindings, under a python that has them
+UNO_HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soffice_uno.py")
+_START_SECONDS = 60
+_PING_SECONDS = 10
+_READ_BUFFER_BYTES = 1024 * 1024
+
+
+def file_hash(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_BUFFER_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def find_uno_python(soffice:str) -> Optional[str]:
+    """
+    Returns a python that imports LibreOffice's UNO bindings: SOFFICE_PYTHON,
+    this python, the one bundled with LibreOffice or the system's (e.g., with
+    python3-uno), or None.
+    """
+    candidates = [
+        os.environ.get("SOFFICE_PYTHON"),
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.realpath(soffice)), "python"),
+        "/usr/bin/python3",
+    ]
+    for candidate in dict.fromkeys(candidate for candidate in candidates if candidate and os.path.exists(candidate)):
+        try:
+            found = subprocess.run([candidate, "-c", "import uno"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=_PING_SECONDS).returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            found = False
+        if found:
+            return candidate
+    return None
+
+
+def _kill(process:Optional[subprocess.Popen]) -> None:
+    if process is not None and process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+def _read_replies(stdout, replies:"queue.Queue") -> None:
+    for line in stdout:
+        replies.put(json.loads(line))
+    # the helper exited
+    replies.put(None)
+
+
+class _Instance:
+    """
+    One headless soffice with its own user profile. With a python that has
+    the UNO bindings it keeps running and listens on a local port, and a
+    soffice_uno.py helper under that python converts with it, so a
+    conversion does not pay for a start. Without one every conversion runs
+    soffice --convert-to on the instance's profile.
+    """
+
+    def __init__(self, soffice:str, uno_python:Optional[str], number:int):
+        self._soffice = soffice
+        self._uno_python = uno_python
+        self._profile = tempfile.mkdtemp(prefix="soffice-profile-%d-" % number)
+        self._process = None
+        self._helper = None
+        self._replies = None
+        self.conversions = 0
+        self.restarts = 0
+
+    def _profile_arg(self) -> str:
+        return "-env:UserInstallation=" + pathlib.Path(self._profile).as_uri()
+
+    @property
+    def persistent(self) -> bool:
+        return self._uno_python is not None
+
+    def start(self) -> None:
+        if not self.persistent:
+            return
+        port = _free_port()
+        self._process = subprocess.Popen(
+            [self._soffice, self._profile_arg(), "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+             "--accept=socket,host=127.0.0.1,port=%d;urp;StarOffice.ComponentContext" % port],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+        )
+        self._helper = subprocess.Popen(
+            [self._uno_python, UNO_HELPER, str(port), str(_START_SECONDS)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, start_new_session=True,
+        )
+        self._replies = queue.Queue()
+        threading.Thread(target=_read_replies, args=(self._helper.stdout, self._replies), daemon=True).start()
+        try:
+            self._reply(_START_SECONDS + _PING_SECONDS)
+        except Exception:
+            self.stop()
+            raise RuntimeError("soffice did not start")
+
+    def stop(self) -> None:
+        _kill(self._helper)
+        _kill(self._process)
+        self._helper = None
+        self._process = None
+
+    def restart(self) -> None:
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def _reply(self, timeout:float) -> None:
+        try:
+            reply = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("soffice did not answer within %ss" % timeout)
+        if reply is None:
+            raise RuntimeError("the soffice helper exited")
+        if "error" in reply:
+            raise ValueError(reply["error"])
+
+    def _call(self, request:dict, timeout:float) -> None:
+        if self._helper is None or self._helper.poll() is not None:
+            raise RuntimeError("the soffice helper is not running")
+        self._helper.stdin.write(json.dumps(request) + "\n")
+        self._helper.stdin.flush()
+        self._reply(timeout)
+
+    def healthy(self) -> bool:
+        if not self.persistent:
+            # nothing keeps running between conversions
+            return True
+        if self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            self._call({"op": "ping"}, _PING_SECONDS)
+            return True
+        except Exception:
+            return False
+
+    def convert(self, path:str, output_path:str, target:str, export_filter:str, timeout:float) -> None:
+        self.conversions += 1
+        if not self.persistent:
+            with tempfile.TemporaryDirectory(prefix="soffice-out-") as out_dir:
+                process = subprocess.Popen(
+                    [self._soffice, self._profile_arg(), "--headless", "--norestore", "--convert-to", target, "--outdir", out_dir, path],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+                )
+                try:
+                    process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    _kill(process)
+                    raise TimeoutError("conversion ran longer than %ss" % timeout)
+                converted = os.path.join(out_dir, pathlib.Path(path).stem + "." + target)
+                if not os.path.exists(converted):
+                    raise ValueError("soffice did not convert %s" % path)
+                shutil.move(converted, output_path)
+            return
+
+        try:
+            self._call({"op": "convert", "path": os.path.abspath(path), "output_path": os.path.abspath(output_path), "export_filter": export_filter}, timeout)
+        except TimeoutError:
+            # a hung conversion blocks the instance, it is killed and started again
+            self.restart()
+            raise TimeoutError("conversion ran longer than %ss" % timeout)
+
+    def close(self) -> None:
+        self.stop()
+        shutil.rmtree(self._profile, ignore_errors=True)
+
+
+class SofficeConverter:
+    """
+    This class converts legacy .ppt, .doc and .xls files to .pptx, .docx and
+    .xlsx with a pool of headless LibreOffice instances that are reused across files,
+    instead of starting soffice for every file. Up to size conversions run
+    at once; an instance that fails its health check is restarted before
+    use, and one whose conversion runs longer than timeout seconds is killed
+    and restarted. Converted files are cached by the hash of the source file,
+    so unchanged files are not converted again by later runs.
+
+    Persistent instances need a python with LibreOffice's UNO bindings,
+    see find_uno_python(); without one there are no persistent instances,
+    each conversion starts soffice --convert-to, and this is said when the
+    pool starts.
+
+    Params:
+      size  LibreOffice instances
+      cache_root  folder of converted files (default: a temporary folder removed by close())
+      timeout  seconds a conversion may take
+      soffice  the soffice executable (default: SOFFICE or soffice on the PATH)
+    """
+
+    def __init__(self, size:int=2, cache_root:Optional[str]=None, timeout:float=120.0, soffice:Optional[str]=None):
+        self._soffice = soffice or os.environ.get("SOFFICE") or shutil.which("soffice") or shutil.which("libreoffice")
+        if not self._soffice:
+            raise FileNotFoundError("soffice is not installed")
+
+        self._timeout = timeout
+        self._temp_cache = cache_root is None
+        self._cache_root = cache_root or tempfile.mkdtemp(prefix="soffice-cache-")
+        os.makedirs(self._cache_root, exist_ok=True)
+
+        self._uno_python = find_uno_python(self._soffice)
+        self._instances = [_Instance(self._soffice, self._uno_python, number) for number in range(size)]
+        self._idle = queue.Queue()
+        for instance in self._instances:
+            instance.start()
+            self._idle.put(instance)
+
+        self._lock = threading.Lock()
+        self._converting: Dict[str, threading.Event] = {}
+        self.stats = {"converted": 0, "cached": 0, "failed": 0}
+        if self._uno_python:
+            print("> %d soffice instance(s) ready, converting through %s" % (size, self._uno_python))
+        else:
+            print("> no python with LibreOffice's UNO bindings (install python3-uno or set SOFFICE_PYTHON): no persistent soffice instances, every file starts soffice --convert-to, %d at once" % size)
+
+    @staticmethod
+    def converts(path:str) -> bool:
+        return pathlib.Path(path).suffix.lower() in CONVERSIONS
+
+    def _cached_path(self, digest:str, target:str) -> str:
+        return os.path.join(self._cache_root, "%s.%s" % (digest, target))
+
+    def convert(self, path:str) -> Optional[str]:
+        """
+        Returns the path of the converted file (in the cache), or None when
+        the file cannot be converted.
+        """
+        target, export_filter = CONVERSIONS[pathlib.Path(path).suffix.lower()]
+        cached_path = self._cached_path(file_hash(path), target)
+
+        # the same file converted by two callers at once is only converted once
+        with self._lock:
+            pending = self._converting.get(cached_path)
+            if pending is None and not os.path.exists(cached_path):
+                self._converting[cached_path] = threading.Event()
+        if pending is not None:
+            pending.wait()
+        if os.path.exists(cached_path):
+            self.stats["cached"] += 1
+            return cached_path
+        if pending is not None:
+            return None
+
+        instance = self._idle.get()
+        try:
+            if not instance.healthy():
+                print("> restarting unresponsive soffice")
+                instance.restart()
+            tmp_path = cached_path + ".tmp"
+            instance.convert(path, tmp_path, target, export_filter, self._timeout)
+            os.replace(tmp_path, cached_path)
+            self.stats["converted"] += 1
+            return cached_path
+        except Exception as e:
+            print("> failed to convert '%s' to %s - %s: %s" % (path, target, type(e).__name__, e))
+            self.stats["failed"] += 1
+            return None
+        finally:
+            self._idle.put(instance)
+            with self._lock:
+                self._converting.pop(cached_path).set()
+
+    def convert_all(self, paths:List[str]) -> None:
+        """Converts files concurrently on all instances, filling the cache."""
+        with ThreadPoolExecutor(max_workers=len(self._instances)) as executor:
+            list(executor.map(self.convert, paths))
+
+    def health(self) -> List[dict]:
+        return [{"persistent": instance.persistent, "healthy": instance.healthy(), "conversions": instance.conversions, "restarts": instance.restarts} for instance in self._instances]
+
+    def close(self) -> None:
+        for instance in self._instances:
+            instance.close()
+        if self._temp_cache:
+            shutil.rmtree(self._cache_root, ignore_errors=True)
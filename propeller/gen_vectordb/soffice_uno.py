@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+This module holds the helper that converts files with a running LibreOffice
+instance through its UNO bindings. soffice_pool.py runs it under a python
+that has the bindings, e.g., the one bundled with LibreOffice, since the
+environment of the ingest usually does not.
+
+Usage: soffice_uno.py <port> <start seconds>
+
+It connects to the instance listening on port, then answers one json
+request per line of stdin with one json line on stdout:
+  {"op": "ping"}  checks the instance responds
+  {"op": "convert", "path": ..., "output_path": ..., "export_filter": ...}
+Replies are {"ok": true} or {"error": "..."}; the first line is the reply
+to connecting.
+"""
+
+import json
+import os
+import sys
+import time
+
+import uno
+from com.sun.star.beans import PropertyValue
+
+
+def _property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+def connect(port, start_seconds):
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+    deadline = time.monotonic() + start_seconds
+    while True:
+        try:
+            context = resolver.resolve("uno:socket,host=127.0.0.1,port=%d;urp;StarOffice.ComponentContext" % port)
+            break
+        except Exception:
+            if time.monotonic() > deadline:
+                raise RuntimeError("soffice did not start")
+            time.sleep(0.2)
+    return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+
+def convert(desktop, path, output_path, export_filter):
+    document = desktop.loadComponentFromURL(uno.systemPathToFileUrl(os.path.abspath(path)), "_blank", 0, (_property("Hidden", True), _property("ReadOnly", True)))
+    if document is None:
+        raise ValueError("soffice cannot open %s" % path)
+    try:
+        document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(output_path)), (_property("FilterName", export_filter),))
+    finally:
+        document.close(True)
+
+
+def reply(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    try:
+        desktop = connect(int(sys.argv[1]), float(sys.argv[2]))
+    except Exception as e:
+        reply({"error": str(e)})
+        sys.exit(1)
+    reply({"ok": True})
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            if request["op"] == "ping":
+                desktop.getComponents()
+            else:
+                convert(desktop, request["path"], request["output_path"], request["export_filter"])
+            reply({"ok": True})
+        except Exception as e:
+            reply({"error": str(e)})
+
+
+if __name__ == "__main__":
+    main()
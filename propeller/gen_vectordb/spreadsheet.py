@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the streaming spreadsheet reader used for ingestion."""
+
+import datetime
+import pathlib
+from typing import Any, Iterator, List, Tuple
+
+import openpyxl
+import xlrd
+
+# longest text kept from a single cell
+MAX_CELL_CHARS = 500
+# longest text of one row group, close to the splitter's chunk size
+MAX_GROUP_CHARS = 1500
+# bytes of .xls records per cell, cells take 6 (MULRK) to 18 (NUMBER) bytes plus the strings
+XLS_BYTES_PER_CELL = 20
+
+
+def cell_text(value:Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        value = value.isoformat()
+    text = " ".join(str(value).split())
+    return text[:MAX_CELL_CHARS]
+
+
+def _iter_xlsx_sheets(xlsx_path:str) -> Iterator[Tuple[str, Iterator[tuple]]]:
+    # read-only mode streams rows from the archive instead of building the workbook
+    workbook = openpyxl.load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            # do not trust the stored dimensions, some writers get them wrong
+            sheet.reset_dimensions()
+            yield sheet.title, sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _xls_sheet_bytes(workbook:xlrd.Book) -> List[int]:
+    # the records of a sheet run from its BOF to the next sheet's, or to the
+    # end of the workbook stream for the last one
+    positions = workbook._sh_abs_posn
+    ends = sorted(positions) + [workbook.stream_len]
+    return [ends[ends.index(position) + 1] - position for position in positions]
+
+
+def _iter_xls_sheets(xls_path:str, max_cells:int) -> Iterator[Tuple[str, Iterator[tuple]]]:
+    # xlrd cannot stream rows, a sheet is loaded whole; sheets whose records
+    # are too large for max_cells cells are skipped instead of capped
+    workbook = xlrd.open_workbook(xls_path, on_demand=True)
+    try:
+        for name, size in zip(workbook.sheet_names(), _xls_sheet_bytes(workbook)):
+            if size > max_cells * XLS_BYTES_PER_CELL:
+                print("> skipped sheet '%s' of %s, its %d KB of records exceed the %d cell cap, convert the file to .xlsx to read it" % (name, xls_path, size // 1024, max_cells))
+                continue
+            sheet = workbook.sheet_by_name(name)
+            yield name, (tuple(sheet.row_values(row)) for row in range(sheet.nrows))
+            workbook.unload_sheet(name)
+    finally:
+        workbook.release_resources()
+
+
+def iter_sheets(path:str, max_cells:int=1000000) -> Iterator[Tuple[str, Iterator[tuple]]]:
+    """
+    Yields (sheet name, row iterator) of each sheet of an .xlsx or .xls file.
+    .xlsx rows are streamed; an .xls sheet is loaded whole, so sheets larger
+    than max_cells cells (estimated from their size in the file) are skipped.
+    """
+    if pathlib.Path(path).suffix.lower() == ".xls":
+        return _iter_xls_sheets(path, max_cells)
+    return _iter_xlsx_sheets(path)
+
+
+def iter_row_groups(rows:Iterator[tuple], max_rows:int, max_cells:int) -> Iterator[Tuple[str, List[str], int, int]]:
+    """
+    Groups the rows of a sheet into chunks of at most MAX_GROUP_CHARS. The
+    first non-empty row is taken as the header. Reading stops after max_rows
+    rows or max_cells cells, so memory stays bounded by one group whatever
+    the sheet size.
+
+    Returns:
+      (header, row lines, first row number, last row number) per group
+    """
+    header = None
+    header_row = 0
+    lines = []
+    chars = 0
+    first = last = 0
+    cells = 0
+
+    for row_number, row in enumerate(rows, start=1):
+        if row_number > max_rows or cells >= max_cells:
+            print("> sheet capped at %d rows, %d cells" % (row_number - 1, cells))
+            break
+
+        cells += len(row)
+        values = [cell_text(value) for value in row]
+        while values and not values[-1]:
+            values.pop()
+        if not values:
+            continue
+
+        line = " | ".join(values)
+        if header is None:
+            header = line
+            header_row = row_number
+            continue
+
+        if lines and chars + len(line) > MAX_GROUP_CHARS:
+            yield header, lines, first, last
+            lines = []
+            chars = 0
+
+        if not lines:
+            first = row_number
+        lines.append(line)
+        chars += len(line) + 1
+        last = row_number
+
+    if lines:
+        yield header, lines, first, last
+    elif header is not None:
+        # a sheet with a single row
+        yield "", [header], header_row, header_row
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""Tests of rebuilding a vector database in place, run with python3 -m pytest test_vectordb.py."""
+
+import hashlib
+from typing import List
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+import vectordb
+from checkpoint import CheckpointLog
+from vectordb import VectorDB
+
+
+class HashEmbeddings(Embeddings):
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        return [np.random.default_rng(int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)).normal(size=16).tolist() for text in texts]
+
+    def embed_query(self, text:str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def build(tmp_path, backend:str, files:dict) -> VectorDB:
+    # a run without --delete_old or --resume, as create_vectordb.py does it
+    checkpoint = CheckpointLog(str(tmp_path / "checkpoint.jsonl"))
+    db = VectorDB(db_path=str(tmp_path / "vectordb"), collection_name="TEST", backend=backend, checkpoint=checkpoint, commit_batch_size=2)
+    for name, text in files.items():
+        path = tmp_path / name
+        path.write_text(text)
+        db.add_file(str(path), source=name)
+    db.close()
+    checkpoint.close(remove=True)
+    return db
+
+
+def served_texts(db:VectorDB) -> List[str]:
+    return sorted(doc.page_content for doc in db._impl.similarity_search("lecture", k=100))
+
+
+@pytest.mark.parametrize("backend", ["flat", "chroma"])
+def test_rebuild_without_delete_old_serves_modified_file(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(vectordb, "GPT4AllEmbeddings", HashEmbeddings)
+    build(tmp_path, backend, {"syllabus.md": "# Syllabus\n\nThe exam is on Monday.\n", "notes.md": "# Notes\n\nLecture one.\n"})
+    db = build(tmp_path, backend, {"syllabus.md": "# Syllabus\n\nThe exam moved to Friday.\n", "notes.md": "# Notes\n\nLecture one.\n"})
+
+    texts = served_texts(db)
+    assert any("Friday" in text for text in texts)
+    assert not any("Monday" in text for text in texts)
+    assert sum("Lecture one" in text for text in texts) == 1
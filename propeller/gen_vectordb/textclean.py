@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the sentence segmentation applied to documents before they are split."""
+
+from typing import List
+
+from langchain_core.documents import Document
+
+import pysbd
+
+
+def segment_docs(docs:List[Document], is_pdf:bool=False) -> List[Document]:
+    """
+    Rewrites each document with one sentence per line, dropping empty ones.
+    Documents that fail to segment are kept as they are.
+    """
+    new_docs = []
+    for doc in docs:
+        if hasattr(doc, "page_content") and len(doc.page_content) > 0:
+            try:
+                content = doc.page_content.replace("\n"," ")
+
+                doctype = None
+                clean = False
+                if is_pdf:
+                    doctype = "pdf"
+                    clean = True
+
+                seg = pysbd.Segmenter(language="en", doc_type=doctype, clean=clean)
+                all_sent = seg.segment(content)
+                page_content = "\n".join(all_sent)
+                page_content = page_content.replace("   ", "\n")
+
+                if len(page_content) > 0:
+                    new_doc = Document(page_content=page_content, metadata=doc.metadata.copy())
+                    new_docs.append(new_doc)
+            except Exception as e:
+                # failed to clean
+                # just put as it is
+                print("> failed to segment sentences, keeping the text as is - %s: %s" % (type(e).__name__, e))
+                new_docs.append(doc)
+    return new_docs
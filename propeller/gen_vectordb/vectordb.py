@@ -5,11 +5,16 @@
 import pathlib
 import json
 import os
+import shutil
 import tempfile
+import time
 import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, Literal, List
 
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import (
     GPT4AllEmbeddings
@@ -17,14 +22,12 @@ from langchain_community.embeddings import (
 
 from langchain_community.vectorstores import Chroma   # pylint: disable=no-name-in-module
 from langchain_community.document_loaders import (
-    PyPDFLoader,
     PDFMinerLoader,
     PyPDFium2Loader,
     PyMuPDFLoader,
     UnstructuredPowerPointLoader,
     TextLoader,
     Docx2txtLoader,
-    UnstructuredExcelLoader
 )
 
 from langchain.text_splitter import MarkdownHeaderTextSplitter
@@ -34,46 +37,171 @@ import tiktoken
 import pptx2md
 from pptx2md.global_var import g as pptx2md_g
 import mammoth
-import pysbd
 import markdownify 
 import chromadb
 
 from chromadb.utils.batch_utils import create_batches
+from checkpoint import CheckpointLog, chunk_id
+from chunkstore import ChunkStore
+from embedding_pool import EmbeddingPool
+from flatindex import FlatIndex
+from hnsw import hnsw_metadata, search_k
+from ingest_report import IngestReport
+from isolation import run_isolated
+from metafilter import FacetIndex, add_facets
+from pdfpages import page_count, page_ranges, parse_pdf_pages
+from soffice_pool import SofficeConverter
+from spreadsheet import iter_row_groups, iter_sheets
+from textclean import segment_docs
+
+# spreadsheet chunks added to the vector store at a time
+_SHEET_BATCH_DOCS = 256
 
 def _tiktoken_len(text) -> int:
     tokenizer = tiktoken.get_encoding("cl100k_base")
     tokens = tokenizer.encode(text)
     return len(tokens)
 
+def _parse_file(parse_options:dict, path:str, source:str, doc_output_path:Optional[str], store_path:str) -> None:
+    # runs in an isolated worker, see VectorDB.add_file()
+    store = ChunkStore(store_path)
+    vectordb = VectorDB(index=False, chunk_store=store, **parse_options)
+    store.create()
+    try:
+        vectordb.add_file(path, source=source, doc_output_path=doc_output_path)
+    except Exception as e:
+        with open(os.path.join(store_path, "error"), "w") as f:
+            f.write("%s: %s" % (type(e).__name__, e))
+        raise
+    store.close()
+
+
 class VectorDB:
     """
     This class manages the maintenance of a vector database, e.g., adding
     documents. When constructing one, the path to the folder where the database
     will be persisted should be provided. If it isn't the database will not be
     persisted.
+
+    The backend is either "chroma" (HNSW index) or "flat" (memory-mapped
+    exact search over a float16 or int8 matrix, see flatindex.FlatIndex).
+    flat_keep_float32 also keeps a float32 copy to measure recall with.
+    HNSW settings (see hnsw.hnsw_metadata) only apply to Chroma collections
+    created by this instance.
+
+    When a chunk store is given, every chunk added is also written to it.
+    With index=False nothing is embedded or indexed and the embedding model
+    is not loaded; the chunks only go to the chunk store, to be indexed
+    later with add_chunk_store().
+
+    Spreadsheets are read row by row; sheet_max_rows and sheet_max_cells
+    cap how much of each sheet is read. PDFs are parsed in ranges of
+    pdf_pages_per_task pages by up to pdf_workers processes (default: one
+    per CPU).
+
+    With a checkpoint log, an interrupted run can be resumed without adding
+    completed files or committed chunk batches again, see add_file().
+
+    With isolate_files, each file is parsed in its own worker process that
+    is killed after file_timeout seconds or above file_max_memory_mb of
+    private memory, so one bad file cannot stall or crash the run. The time,
+    peak memory, pages and chunks of every file go to the report attribute.
+
+    Chunks are embedded by embed_instances model instances using
+    embed_threads CPU threads each (see embedding_pool.EmbeddingPool);
+    bench_embeddings.py finds the fastest setting for a machine.
+
+    With a converter, legacy .ppt, .doc and .xls files are converted to
+    .pptx, .docx and .xlsx by its pool of LibreOffice instances and parsed
+    as those.
+
+    Every chunk indexed gets the file_type and module facets (see
+    metafilter.add_facets) so searches can be filtered by them. The flat
+    index keeps the facets of its rows itself; a persisted Chroma collection
+    gets a facet index file next to the database.
     """
 
-    def __init__(self, db_path:Optional[str]=None, collection_name:Optional[str]=None):
-        self._embedding=GPT4AllEmbeddings()
+    def __init__(self, db_path:Optional[str]=None, collection_name:Optional[str]=None, backend:str="chroma", flat_dtype:str="float16", flat_keep_float32:bool=False, hnsw:Optional[dict]=None, chunk_store:Optional[ChunkStore]=None, index:bool=True, sheet_max_rows:int=100000, sheet_max_cells:int=1000000, pdf_workers:Optional[int]=None, pdf_pages_per_task:int=50, checkpoint:Optional[CheckpointLog]=None, commit_batch_size:int=256, isolate_files:bool=False, file_timeout:Optional[float]=None, file_max_memory_mb:Optional[float]=None, embed_threads:Optional[int]=None, embed_instances:int=1, converter:Optional[SofficeConverter]=None):
         self._db_path = db_path
+        self._converter = converter
+        self._embed_threads = embed_threads
+        self._embed_instances = embed_instances
+        self._isolate_files = isolate_files
+        self._file_timeout = file_timeout
+        self._file_max_memory_mb = file_max_memory_mb
+        self._parse_options = {
+            "sheet_max_rows": sheet_max_rows,
+            "sheet_max_cells": sheet_max_cells,
+            "pdf_workers": pdf_workers,
+            "pdf_pages_per_task": pdf_pages_per_task,
+        }
+        self.report = IngestReport()
+        self._checkpoint = checkpoint
+        self._commit_batch_size = commit_batch_size
+        # the file being added, see add_file()
+        self._file = None
+        self._skip_file = False
+        self._pending = []
+        self._file_chunks = 0
+        self._file_batches = 0
+        self._file_pages = set()
+        self._pdf_workers = pdf_workers or os.cpu_count() or 1
+        self._pdf_pages_per_task = pdf_pages_per_task
+        self._sheet_max_rows = sheet_max_rows
+        self._sheet_max_cells = sheet_max_cells
+        self._backend = backend
+        self._chunk_store = chunk_store
+        self._facet_index = None
+        # rows of each file in a flat index before this run, see _remove_previous()
+        self._previous_rows = None
         if collection_name:
             self._collection_name=collection_name
         else:
             self._collection_name="langchain"
-        
-        client_settings = chromadb.Settings()
-        if db_path:
-            client_settings.persist_directory=db_path
-            client_settings.is_persistent=True
-
-        client = chromadb.Client(client_settings)
-
-        self._impl = Chroma(
-            embedding_function=self._embedding,
-            client_settings=client_settings,
-            client=client,
-            collection_name=self._collection_name, 
-        )
+
+        if not index:
+            self._embedding = None
+            self._impl = None
+        elif backend == "flat":
+            self._embedding=self._make_embedding()
+            self._impl = FlatIndex(
+                embedding_function=self._embedding,
+                persist_directory=db_path,
+                collection_name=self._collection_name,
+                dtype=flat_dtype,
+                keep_float32=flat_keep_float32,
+            )
+        else:
+            self._embedding=self._make_embedding()
+            client_settings = chromadb.Settings()
+            if db_path:
+                client_settings.persist_directory=db_path
+                client_settings.is_persistent=True
+
+            client = chromadb.Client(client_settings)
+
+            collection_metadata = hnsw_metadata(**(hnsw or {}))
+            existing = [collection.name for collection in client.list_collections()]
+            if collection_metadata and self._collection_name in existing:
+                # chroma fixes hnsw settings when the collection is created
+                print("> collection %s already exists, keeping its hnsw settings" % self._collection_name)
+                collection_metadata = None
+
+            self._impl = Chroma(
+                embedding_function=self._embedding,
+                client_settings=client_settings,
+                client=client,
+                collection_name=self._collection_name, 
+                collection_metadata=collection_metadata or None,
+            )
+            if db_path:
+                self._facet_index = FacetIndex(FacetIndex.path_for(db_path, self._collection_name))
+                if not self._facet_index.exists() and self._collection_name in existing:
+                    # a collection built before facets, its values are counted once
+                    self._facet_index.add(metadata or {} for metadata in self._impl._collection.get(include=["metadatas"])["metadatas"])
+
+        if checkpoint is not None and checkpoint.abandoned and self._impl is not None:
+            self._remove_abandoned(checkpoint.abandoned)
 
         # this splits the input text
         self.text_splitter = RecursiveCharacterTextSplitter(
@@ -84,11 +212,69 @@ class VectorDB:
             length_function = _tiktoken_len,
         )
 
-    def _dump_docs(self, docs:List[Document], doc_output_path:str) -> None:
+    def _remove_abandoned(self, abandoned:dict) -> None:
+        # files an interrupted run left half added; the batch it may have
+        # added without logging is covered by the commit batch size
+        for source, chunks in abandoned.items():
+            ids = [chunk_id(self._collection_name, source, number) for number in range(chunks + self._commit_batch_size)]
+            if self._backend == "flat":
+                # the file was the last one added, its rows end the index
+                ids = set(ids)
+                count = self._impl.count
+                while count > 0 and self._impl._get_document(count - 1)[0] in ids:
+                    count -= 1
+                removed = self._impl.count - count
+                self._impl.truncate(count)
+            else:
+                metadatas = self._impl._collection.get(ids=ids, include=["metadatas"])["metadatas"]
+                removed = len(metadatas)
+                if metadatas:
+                    self._impl._collection.delete(ids=ids)
+                    if self._facet_index is not None:
+                        self._facet_index.remove(metadata or {} for metadata in metadatas)
+                        self._facet_index.save()
+            print("> removed %d chunks of '%s' left by an interrupted run" % (removed, source))
+
+    def _remove_previous(self, source:str) -> None:
+        # chunks of an earlier build of the file, e.g., a run without
+        # --delete_old: they share the ids of its new chunks, so Chroma would
+        # keep them instead of the new ones and the flat index would hold both
+        if self._backend == "flat":
+            if self._previous_rows is None:
+                self._previous_rows = self._impl.rows_by_source()
+            rows = self._previous_rows.pop(source, [])
+            if rows:
+                self._impl.delete_rows(rows)
+            removed = len(rows)
+        else:
+            previous = self._impl._collection.get(where={"source": source}, include=["metadatas"])
+            removed = len(previous["ids"])
+            if removed:
+                self._impl._collection.delete(ids=previous["ids"])
+                if self._facet_index is not None:
+                    self._facet_index.remove(metadata or {} for metadata in previous["metadatas"])
+                    self._facet_index.save()
+        if removed:
+            print("> replacing %d chunks of '%s' from an earlier build" % (removed, source))
+
+    def _make_embedding(self) -> Embeddings:
+        if self._embed_threads is None and self._embed_instances <= 1:
+            return GPT4AllEmbeddings()
+        print("> embedding with %d instance(s) of %s thread(s)" % (self._embed_instances, self._embed_threads or "default"))
+        return EmbeddingPool(threads=self._embed_threads, instances=self._embed_instances)
+
+    def splitter_settings(self) -> dict:
+        """Returns the settings the chunks depend on, kept with a chunk store."""
+        return {
+            "chunk_size": self.text_splitter._chunk_size,
+            "chunk_overlap": self.text_splitter._chunk_overlap,
+        }
+
+    def _dump_docs(self, docs:List[Document], doc_output_path:str, append:bool=False) -> None:
         docdir = os.path.dirname(doc_output_path)
         os.makedirs(docdir, exist_ok=True)
 
-        with open(doc_output_path, "w") as f:
+        with open(doc_output_path, "a" if append else "w") as f:
                 for docid, doc in enumerate(docs):
                     f.write("==== doc %d ====\n" % docid)
                     f.write("[metadata]\n")
@@ -99,32 +285,7 @@ class VectorDB:
                     f.write("\n\n")
 
     def _clean_doc(self, docs:List[Document], is_pdf:bool=False) -> List[Document]:
-        new_docs = []
-        for doc in docs:
-            if hasattr(doc, "page_content") and len(doc.page_content) > 0:
-                try:
-                    content = doc.page_content.replace("\n"," ")
-                    
-                    doctype = None
-                    clean = False
-                    if is_pdf:
-                        doctype = "pdf"
-                        clean = True
-
-                    seg = pysbd.Segmenter(language="en", doc_type=doctype, clean=clean)
-                    all_sent = seg.segment(content)
-                    page_content = "\n".join(all_sent)
-                    page_content = page_content.replace("   ", "\n")
-
-                    if len(page_content) > 0:
-                        new_doc = Document(page_content=page_content, metadata=doc.metadata.copy())
-                        new_docs.append(new_doc)
-                except Exception as e:
-                    # failed to clearn
-                    # just put as it is
-                    new_docs.append(doc)
-
-
+        new_docs = segment_docs(docs, is_pdf)
         split_docs = self.text_splitter.split_documents(new_docs)
         self._make_doc_safe(split_docs)
 
@@ -168,12 +329,75 @@ class VectorDB:
         Adds a file to the vector store. It will use the file's extension to
         determine the type of file.
 
+        The chunks of the file are committed in batches of commit_batch_size
+        with ids derived from the source, and each batch and the completed
+        file are recorded in the checkpoint log. A file the log records as
+        completed is skipped.
+
         Params:
           path  The path to the file on the local filesystem
         """
         if not source:
             source = path
 
+        if self._checkpoint is not None and self._checkpoint.is_file_done(source):
+            print("> already added '%s', skipping" % path)
+            return
+
+        start = time.perf_counter()
+        self._begin_file(source)
+        if self._converter is not None and self._converter.converts(path):
+            # converted here, so isolated workers parse the converted file
+            path = self._converter.convert(path) or path
+
+        if self._isolate_files:
+            status, peak_memory_mb, error = self._add_file_isolated(path, source, doc_output_path)
+        else:
+            self._add_file_by_type(path, source, doc_output_path)
+            status, peak_memory_mb, error = "ok", None, None
+
+        pages = len(self._file_pages)
+        if status == "ok":
+            self._end_file()
+            chunks = self._file_chunks
+        else:
+            print("> failed to add '%s' (%s) - %s" % (path, status, error))
+            self._abort_file()
+            chunks = 0
+        self.report.add(source, status, time.perf_counter() - start, peak_memory_mb, pages=pages, chunks=chunks, error=error)
+
+    def _add_file_isolated(self, path:str, source:str, doc_output_path:Optional[str]) -> tuple:
+        # the worker writes its chunks to a temporary chunk store, they are
+        # only added here once the whole file parsed
+        store_path = tempfile.mkdtemp(prefix="vectordb-file-")
+        try:
+            status, _, peak_memory_mb = run_isolated(
+                _parse_file,
+                (self._parse_options, path, source, doc_output_path, store_path),
+                timeout=self._file_timeout,
+                max_memory_mb=self._file_max_memory_mb,
+            )
+
+            error = None
+            error_path = os.path.join(store_path, "error")
+            if status == "ok":
+                store = ChunkStore(store_path)
+                for texts, metadatas in store.iter_batches(self._commit_batch_size):
+                    self._add_docs([Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)])
+            elif status == "timeout":
+                error = "ran longer than %ss" % self._file_timeout
+            elif status == "memory":
+                error = "used more than %s MB" % self._file_max_memory_mb
+            elif os.path.exists(error_path):
+                with open(error_path, "r") as f:
+                    error = f.read()
+            else:
+                error = "worker exited abnormally"
+            return status, peak_memory_mb, error
+        finally:
+            shutil.rmtree(store_path, ignore_errors=True)
+
+    def _add_file_by_type(self, path:str, source:str, doc_output_path:Optional[str]) -> None:
         # detect format
         file_ext = pathlib.Path(path).suffix
         match file_ext.lower():
@@ -188,8 +412,7 @@ class VectorDB:
             case ".docx" | ".doc":
                 self.add_docx(path, source=source, doc_output_path=doc_output_path)
             case ".xlsx" | ".xls":
-                #self.add_xlsx(path, source=source, doc_output_path)
-                print("ignore microsoft excel file (%s)" % path)
+                self.add_xlsx(path, source=source, doc_output_path=doc_output_path)
             case ".png" | ".jpg" | ".jpeg" | ".gif" | ".tiff":
                 print("ignore image file (%s)" % path)
             case ".html" | ".htm":
@@ -266,15 +489,33 @@ class VectorDB:
         return self._add_pdf_pypdf(pdf_path=pdf_path, source=source, doc_output_path=doc_output_path)
     
     def _add_pdf_pypdf(self, pdf_path:str, source:Optional[str]=None, doc_output_path:Optional[str]=None) -> None:
-        docs = PyPDFLoader(pdf_path).load_and_split()
-        docs = self._clean_doc(docs, True)
-        if source:
-            self._add_source(docs, source)
+        # pages are parsed in ranges of pdf_pages_per_task, in worker
+        # processes when there are several ranges, and added in page order
+        # one range at a time
+        ranges = page_ranges(page_count(pdf_path), self._pdf_pages_per_task)
+        if self._pdf_workers > 1 and len(ranges) > 1:
+            # fork is cheap, but not from a process that loaded the embedding model
+            context = multiprocessing.get_context("spawn" if self._embedding else "fork")
+            executor = ProcessPoolExecutor(max_workers=min(self._pdf_workers, len(ranges)), mp_context=context)
+            results = executor.map(parse_pdf_pages, *zip(*[(pdf_path, start, end) for start, end in ranges]))
+        else:
+            executor = None
+            results = (parse_pdf_pages(pdf_path, start, end) for start, end in ranges)
 
-        if doc_output_path:
-            self._dump_docs(docs, doc_output_path)
+        try:
+            for range_number, docs in enumerate(results):
+                docs = self.text_splitter.split_documents(docs)
+                self._make_doc_safe(docs)
+                if source:
+                    self._add_source(docs, source)
 
-        self._add_docs(docs)
+                if doc_output_path:
+                    self._dump_docs(docs, doc_output_path, append=range_number > 0)
+
+                self._add_docs(docs)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
 
     def _add_pdf_pdfminer(self, pdf_path:str, source:Optional[str]=None, doc_output_path:Optional[str]=None) -> None:
         docs = PDFMinerLoader(pdf_path).load()
@@ -342,22 +583,26 @@ class VectorDB:
         return self._add_pptx_pptx2md(pptx_path=pptx_path, source=source, doc_output_path=doc_output_path)
 
     def _add_pptx_pptx2md(self, pptx_path:str, source:Optional[str]=None, doc_output_path:Optional[str]=None) -> None:
-        try:
-            pptx2md_g.disable_image = True
-            pptx2md_g.disable_wmf = True
-            pptx2md_g.disable_color = True
-            pptx2md_g.disable_escaping = True
+        pptx2md_g.disable_image = True
+        pptx2md_g.disable_wmf = True
+        pptx2md_g.disable_color = True
+        pptx2md_g.disable_escaping = True
 
+        temp_path = tempfile.mktemp()
+        try:
             prs = pptx2md.Presentation(pptx=pptx_path)
-            temp_path = tempfile.mktemp()
             md_out = pptx2md.outputter.md_outputter(temp_path)
             pptx2md.parse(prs, md_out)
-            self.add_markdown(markdown_path=temp_path, source=source, doc_output_path=doc_output_path)
-
-            os.remove(temp_path)
-        except:
+        except Exception as e:
             # fail to convert to markdown
-            self._add_pptx_unstructured(ppt_path=pptx_path, doc_output_path=doc_output_path)
+            print("> failed to convert '%s' to markdown, using unstructured - %s: %s" % (pptx_path, type(e).__name__, e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._add_pptx_unstructured(ppt_path=pptx_path, source=source, doc_output_path=doc_output_path)
+            return
+
+        self.add_markdown(markdown_path=temp_path, source=source, doc_output_path=doc_output_path)
+        os.remove(temp_path)
 
     def _add_pptx_unstructured(self, ppt_path:str, source:Optional[str]=None, doc_output_path:Optional[str]=None) -> None:
         docs = UnstructuredPowerPointLoader(ppt_path).load()
@@ -410,18 +655,39 @@ class VectorDB:
 
     def add_xlsx(self, xlsx_path:str, source:Optional[str]=None, doc_output_path:Optional[str]=None) -> None:
         """
-        Adds a Excel file to the vector store.
+        Adds a Excel file to the vector store. Rows are streamed and grouped
+        into chunks that repeat the sheet's header row, and chunks are added
+        in batches, so memory does not grow with the sheet size.
 
         Params:
-          xlsx_path  The path to the file on the local filesystem
+          xlsx_path  The path to the file on the local filesystem (.xlsx or .xls)
         """
-        docs = UnstructuredExcelLoader(xlsx_path).load()
-        docs = self._clean_doc(docs, False)
+        docs = []
+        dumped = False
+        for sheet_name, rows in iter_sheets(xlsx_path, self._sheet_max_cells):
+            for header, lines, first, last in iter_row_groups(rows, self._sheet_max_rows, self._sheet_max_cells):
+                heading = ["Sheet: %s" % sheet_name] + ([header] if header else [])
+                page_content = "\n".join(heading + lines)
+                docs.append(Document(page_content=page_content, metadata={"sheet": sheet_name, "rows": "%d-%d" % (first, last)}))
+
+                if len(docs) >= _SHEET_BATCH_DOCS:
+                    self._add_sheet_docs(docs, source, doc_output_path, dumped)
+                    dumped = True
+                    docs = []
+
+        self._add_sheet_docs(docs, source, doc_output_path, dumped)
+
+    def _add_sheet_docs(self, docs:List[Document], source:Optional[str], doc_output_path:Optional[str], append:bool) -> None:
+        if not docs:
+            return
+
+        # only splits groups made of very wide rows
+        docs = self.text_splitter.split_documents(docs)
         if source:
             self._add_source(docs, source)
 
         if doc_output_path:
-            self._dump_docs(docs, doc_output_path)
+            self._dump_docs(docs, doc_output_path, append=append)
 
         self._add_docs(docs)
 
@@ -464,12 +730,143 @@ class VectorDB:
             print(">> ignoring empty doc")
             return
 
-        texts = [doc.page_content for doc in docs]
-        metadatas = [doc.metadata for doc in docs]
-        ids = [str(uuid.uuid1()) for _ in texts]
+        if self._skip_file:
+            return
+
+        for doc in docs:
+            if "page" in doc.metadata:
+                self._file_pages.add(doc.metadata["page"])
+
+        if self._chunk_store is not None:
+            self._chunk_store.append(docs)
+
+        if self._file is None:
+            # not part of a file, e.g., add_text()
+            if self._impl is not None:
+                texts = [doc.page_content for doc in docs]
+                metadatas = [doc.metadata for doc in docs]
+                self._add_texts(texts, metadatas)
+            return
 
+        self._pending.extend(docs)
+        self._commit_pending(final=False)
+
+    def _add_texts(self, texts:List[str], metadatas:List[dict], ids:Optional[List[str]]=None) -> None:
+        if not ids:
+            ids = [str(uuid.uuid1()) for _ in texts]
+        for metadata in metadatas:
+            add_facets(metadata)
         self._impl.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+        if self._facet_index is not None:
+            self._facet_index.add(metadatas)
+            self._facet_index.save()
+
+    def _begin_file(self, source:str) -> None:
+        self._file = source
+        self._skip_file = self._checkpoint is not None and self._checkpoint.is_file_done(source)
+        self._pending = []
+        self._file_chunks = 0
+        self._file_batches = 0
+        self._file_pages = set()
+
+    def _abort_file(self) -> None:
+        # nothing of the file was added, it is retried by a resumed run
+        self._pending = []
+        self._file = None
+        self._skip_file = False
+
+    def _end_file(self) -> None:
+        if not self._skip_file:
+            self._commit_pending(final=True)
+            if self._checkpoint is not None:
+                position = self._chunk_store.flush() if self._chunk_store is not None else None
+                self._checkpoint.add_file(self._file, self._file_chunks, chunk_store=position)
+
+        self._file = None
+        self._skip_file = False
+
+    def _commit_pending(self, final:bool) -> None:
+        while len(self._pending) >= self._commit_batch_size or (final and self._pending):
+            batch = self._pending[:self._commit_batch_size]
+            del self._pending[:self._commit_batch_size]
+            self._commit_batch(batch)
+
+    def _commit_batch(self, docs:List[Document]) -> None:
+        batch_number = self._file_batches
+        first_chunk = self._file_chunks
+        self._file_batches += 1
+        self._file_chunks += len(docs)
+        if self._impl is None:
+            return
+
+        ids = [chunk_id(self._collection_name, self._file, first_chunk + i) for i in range(len(docs))]
+        started = self._checkpoint is not None and self._checkpoint.is_file_started(self._file)
+        if self._checkpoint is not None:
+            if self._checkpoint.is_batch_done(self._file, batch_number):
+                return
+            if started and self._checkpoint.resumed and self._is_committed(ids):
+                # added just before the previous run stopped, not yet logged
+                self._checkpoint.add_batch(self._file, batch_number, len(docs))
+                return
+        if not started:
+            self._remove_previous(self._file)
+        if self._checkpoint is not None:
+            self._checkpoint.start_file(self._file)
+
+        self._add_texts([doc.page_content for doc in docs], [doc.metadata for doc in docs], ids)
+        if self._checkpoint is not None:
+            self._checkpoint.add_batch(self._file, batch_number, len(docs))
+
+    def _is_committed(self, ids:List[str]) -> bool:
+        if self._backend == "flat":
+            # a flat index batch is committed as a whole, at the end of the index
+            count = self._impl.count
+            if count < len(ids):
+                return False
+            return [self._impl._get_document(row)[0] for row in range(count - len(ids), count)] == ids
+        return len(self._impl._collection.get(ids=[ids[-1]], include=[])["ids"]) > 0
+
+    def add_chunk_store(self, chunk_store:ChunkStore, batch_size:int=1024) -> int:
+        """
+        Embeds and indexes the chunks of a chunk store, reading it in large
+        sequential batches. Chunks are committed per file as in add_file(),
+        so an interrupted run can be resumed from the checkpoint log.
+        Returns the number of chunks read.
 
-    def as_retriever(self) -> VectorStoreRetriever:
+        Params:
+          chunk_store  a store written by the parse phase
+          batch_size  chunks read per batch
+        """
+        added = 0
+        for texts, metadatas in chunk_store.iter_batches(batch_size):
+            for text, metadata in zip(texts, metadatas):
+                # the chunks of a file are contiguous in the store
+                source = metadata.get("source", "")
+                if source != self._file:
+                    if self._file is not None:
+                        self._end_file()
+                    self._begin_file(source)
+
+                if not self._skip_file:
+                    self._pending.append(Document(page_content=text, metadata=metadata))
+            self._commit_pending(final=False)
+
+            added += len(texts)
+            print("> indexed %d/%d chunks" % (added, len(chunk_store)))
+
+        if self._file is not None:
+            self._end_file()
+        return added
+
+    def close(self) -> None:
+        """Removes the rows of files added again from a flat index, and stops the embedding worker processes, if any."""
+        if self._backend == "flat" and self._impl is not None:
+            removed = self._impl.compact()
+            if removed:
+                print("> compacted %d replaced chunks out of the flat index" % removed)
+        if isinstance(self._embedding, EmbeddingPool):
+            self._embedding.close()
+
+    def as_retriever(self, k:Optional[int]=None) -> VectorStoreRetriever:
         """Return VectorStoreRetriever initialized from this VectorStore."""
-        return self._impl.as_retriever()
+        return self._impl.as_retriever(search_kwargs={"k": search_k(k)})
@@ -2,45 +2,506 @@
 
 """This module holds the vector database maintenance logic."""
 
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import threading
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
 
 from langchain_community.embeddings import (
     GPT4AllEmbeddings
 )
 
 from langchain_community.vectorstores import Chroma   # pylint: disable=no-name-in-module
-from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import ConfigurableField
 import chromadb
+from chromadb.api.client import SharedSystemClient
+
+from flatindex import FlatIndex
+from hnsw import hnsw_metadata, search_k, set_search_ef
+from metafilter import FACET_FIELDS, FacetIndex, chroma_where, expand_filter
+from mmr import maximal_marginal_relevance
+
+SEARCH_TYPES = ("similarity", "mmr", "similarity_score_threshold")
+# fields of SearchModeRetriever that can be set per request
+SEARCH_OPTIONS = ("search_type", "k", "fetch_k", "lambda_mult", "score_threshold", "filter")
+
+def _close_client(client) -> None:
+    # chroma caches one system per persist directory, drop it so a later
+    # reader of the same path starts fresh
+    client._system.stop()
+    SharedSystemClient._identifer_to_system.pop(client._identifier, None)
+
 
 class VectorDBReader:
     """
     This class provide reader for a vector database, When constructing one, the path to the folder where the database
     will be persisted should be provided. If it isn't the database will not be
     persisted.
+
+    The backend must match the one the database was created with, "chroma"
+    or "flat". search_ef (default HNSW_SEARCH_EF) overrides the collection's
+    HNSW search setting for this reader. An embedding model and a Chroma
+    client can be passed in to share them between readers.
+
+    Searches take an optional metadata filter (see metafilter.expand_filter)
+    applied before the vector search: the flat backend only scores the rows
+    the filter selects, and Chroma gets it as a where filter on the metadata
+    values the collection holds.
     """
 
-    def __init__(self, db_path:Optional[str]=None, collection_name:Optional[str]=None):
-        self._embedding=GPT4AllEmbeddings()
+    def __init__(self, db_path:Optional[str]=None, collection_name:Optional[str]=None, backend:str="chroma", search_ef:Optional[int]=None, embedding:Optional[Embeddings]=None, client:Optional[Any]=None):
+        if embedding:
+            self._embedding=embedding
+        else:
+            self._embedding=GPT4AllEmbeddings()
         self._db_path = db_path
+        self._backend = backend
         if collection_name:
             self._collection_name=collection_name
         else:
             self._collection_name="langchain"
 
-        client_settings = chromadb.Settings()
-        if db_path:
-            client_settings.persist_directory=db_path
-            client_settings.is_persistent=True
-
-        client = chromadb.Client(client_settings)
-        
-        self._impl = Chroma(
-            embedding_function=self._embedding, 
-            client_settings=client_settings,
-            client=client,
-            collection_name=self._collection_name, 
+        self._client = None
+        self._facet_index = None
+        if backend == "flat":
+            # the dtype is read back from the index header
+            self._impl = FlatIndex(
+                embedding_function=self._embedding,
+                persist_directory=db_path,
+                collection_name=self._collection_name,
+            )
+        else:
+            client_settings = chromadb.Settings()
+            if db_path:
+                client_settings.persist_directory=db_path
+                client_settings.is_persistent=True
+
+            if not client:
+                client = chromadb.Client(client_settings)
+                self._client = client
+            
+            self._impl = Chroma(
+                embedding_function=self._embedding, 
+                client_settings=client_settings,
+                client=client,
+                collection_name=self._collection_name, 
+            )
+
+            search_ef = hnsw_metadata(search_ef=search_ef).get("hnsw:search_ef")
+            if search_ef:
+                set_search_ef(client, self._impl._collection, search_ef)
+
+    @property
+    def collection_name(self) -> str:
+        return self._collection_name
+
+    def close(self) -> None:
+        """Stops the Chroma client created by this reader."""
+        if self._client:
+            _close_client(self._client)
+            self._client = None
+
+    def embed_query(self, query:str) -> List[float]:
+        return self._embedding.embed_query(query)
+
+    def _chroma_facet_index(self) -> FacetIndex:
+        # written at ingest time; a collection built without it is scanned once
+        if self._facet_index is None:
+            facet_index = FacetIndex(FacetIndex.path_for(self._db_path or ".", self._collection_name))
+            if not facet_index.exists():
+                results = self._impl._collection.get(include=["metadatas"])
+                facet_index.add(metadata or {} for metadata in results["metadatas"])
+            self._facet_index = facet_index
+        return self._facet_index
+
+    def vocabulary(self) -> dict:
+        """Returns the values of each facet field in the collection."""
+        if self._backend == "flat":
+            return self._impl.vocabulary()
+        return self._chroma_facet_index().vocabulary()
+
+    def facets(self) -> dict:
+        """Returns the number of chunks per value of each facet field, e.g., to list the filters of a collection."""
+        if self._backend == "flat":
+            return self._impl.facets()
+        return {field: counts for field, counts in self._chroma_facet_index().facets().items() if field in FACET_FIELDS}
+
+    def search_by_vector(self, embedding:List[float], k:Optional[int]=None, include_embeddings:bool=False, filter:Optional[dict]=None) -> Tuple[List[Document], np.ndarray, Optional[np.ndarray]]:
+        """
+        Returns the documents closest to a query embedding, their relevance
+        scores (higher is more relevant) and, if asked, their stored
+        embeddings.
+
+        Params:
+          embedding  the query embedding
+          k  the number of documents to return
+          include_embeddings  also return a (documents, dim) embedding matrix
+          filter  only search the documents matching this metadata filter
+        """
+        k = search_k(k)
+        clauses = expand_filter(filter, self.vocabulary()) if filter else []
+        if self._backend == "flat":
+            rows = self._impl.filter_rows(clauses)
+            if include_embeddings:
+                return self._impl.similarity_search_by_vector_with_embeddings(embedding, k=k, rows=rows)
+            docs_and_scores = self._impl.similarity_search_by_vector_with_relevance_scores(embedding, k=k, rows=rows)
+            return [doc for doc, _ in docs_and_scores], np.asarray([score for _, score in docs_and_scores], dtype=np.float32), None
+
+        where = chroma_where(clauses)
+        if where == {}:
+            # no document has the filtered values
+            return [], np.empty(0, dtype=np.float32), np.empty((0, len(embedding)), dtype=np.float32) if include_embeddings else None
+
+        include = ["documents", "metadatas", "distances"]
+        if include_embeddings:
+            include.append("embeddings")
+        results = self._impl._collection.query(query_embeddings=[embedding], n_results=k, where=where, include=include)
+
+        relevance_fn = self._impl._select_relevance_score_fn()
+        docs = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(results["documents"][0], results["metadatas"][0])
+        ]
+        scores = np.asarray([relevance_fn(distance) for distance in results["distances"][0]], dtype=np.float32)
+        embeddings = None
+        if include_embeddings:
+            embeddings = np.asarray(results["embeddings"][0], dtype=np.float32)
+        return docs, scores, embeddings
+
+    def documents(self) -> List[Document]:
+        """Returns every document of the collection, e.g., to build a keyword index over the same chunks."""
+        if self._backend == "flat":
+            return [self._impl._get_document(row)[1] for row in range(self._impl.count)]
+
+        results = self._impl._collection.get(include=["documents", "metadatas"])
+        return [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(results["documents"], results["metadatas"])
+        ]
+
+    def embed_queries(self, queries:List[str]) -> np.ndarray:
+        """Embeds a batch of queries in one call, as a (queries, dim) matrix."""
+        return np.asarray(self._embedding.embed_documents(queries), dtype=np.float32)
+
+    def search_by_vectors(self, embeddings:np.ndarray, k:Optional[int]=None, filter:Optional[dict]=None) -> Tuple[List[List[str]], List[List[Document]], np.ndarray]:
+        """
+        Runs the searches of a batch of query embeddings as one operation, a
+        matrix product for the flat backend and a single multi-embedding query
+        for Chroma, all within the documents matching filter if given.
+
+        Returns:
+          (ids, documents, scores) per query, with scores shaped (queries, k),
+          best match first
+        """
+        k = search_k(k)
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        clauses = expand_filter(filter, self.vocabulary()) if filter else []
+        if self._backend == "flat":
+            rows, scores = self._impl.query(embeddings, k, rows=self._impl.filter_rows(clauses))
+            ids = []
+            docs = []
+            for query_rows in rows:
+                records = [self._impl._get_document(int(row)) for row in query_rows]
+                ids.append([record_id for record_id, _ in records])
+                docs.append([doc for _, doc in records])
+            return ids, docs, scores
+
+        where = chroma_where(clauses)
+        if where == {}:
+            return [[] for _ in embeddings], [[] for _ in embeddings], np.empty((len(embeddings), 0), dtype=np.float32)
+
+        results = self._impl._collection.query(
+            query_embeddings=embeddings.tolist(),
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas", "distances"],
+        )
+        relevance_fn = self._impl._select_relevance_score_fn()
+        docs = [
+            [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)]
+            for texts, metadatas in zip(results["documents"], results["metadatas"])
+        ]
+        scores = np.asarray(
+            [[relevance_fn(distance) for distance in distances] for distances in results["distances"]],
+            dtype=np.float32,
         )
+        return results["ids"], docs, scores
+
+    def as_retriever(self, k:Optional[int]=None, search_type:str="similarity", **kwargs:Any) -> "VectorDBRetriever":
+        """
+        Return a retriever for this collection.
+
+        Params:
+          k  the number of documents to return
+          search_type  one of SEARCH_TYPES
+          kwargs  fetch_k, lambda_mult, score_threshold and filter, see SearchModeRetriever
+        """
+        return VectorDBRetriever(reader=self, k=search_k(k), search_type=search_type, **kwargs)
+
+
+class EmbeddedQuery(str):
+    """
+    A query that carries its embedding, e.g., computed for a cache lookup
+    before retrieval; retrievers search with it instead of embedding the
+    query again.
+    """
+
+    def __new__(cls, query:str, embedding:List[float]):
+        embedded = super().__new__(cls, query)
+        embedded.embedding = embedding
+        return embedded
+
+
+class SearchModeRetriever(BaseRetriever):
+    """
+    Base of the retrievers with selectable search modes:
+    - "similarity" returns the k closest documents
+    - "mmr" over-fetches fetch_k candidates with their stored embeddings and
+      picks k of them by maximal marginal relevance
+    - "similarity_score_threshold" returns the closest documents scoring at
+      least score_threshold, possibly none
+    score_threshold also applies to the other modes when it is set, and
+    filter (see metafilter.expand_filter) restricts every mode to the
+    documents matching it, e.g., {"file_type": "pdf", "section": "Lecture 3"}.
+    Use configurable_search() to let each request pick the mode and filter.
+    """
+
+    search_type: str = "similarity"
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    score_threshold: Optional[float] = None
+    filter: Optional[dict] = None
+
+    def search_options(self) -> dict:
+        return {option: getattr(self, option) for option in SEARCH_OPTIONS}
+
+    def _embed_query(self, query:str) -> List[float]:
+        raise NotImplementedError()
+
+    def _search(self, query_embedding:List[float], k:int, include_embeddings:bool, filter:Optional[dict]) -> Tuple[List[Document], np.ndarray, Optional[np.ndarray]]:
+        raise NotImplementedError()
+
+    def _get_relevant_documents(self, query:str, *, run_manager:CallbackManagerForRetrieverRun) -> List[Document]:
+        if self.search_type not in SEARCH_TYPES:
+            raise ValueError("unsupported search type %s" % self.search_type)
+
+        query_embedding = query.embedding if isinstance(query, EmbeddedQuery) else self._embed_query(query)
+        is_mmr = self.search_type == "mmr"
+        fetch_k = max(self.fetch_k, self.k) if is_mmr else self.k
+        docs, scores, embeddings = self._search(query_embedding, fetch_k, is_mmr, self.filter)
 
-    def as_retriever(self) -> VectorStoreRetriever:
-        """Return VectorStoreRetriever initialized from this VectorStore."""
-        return self._impl.as_retriever()
+        keep = np.arange(len(docs))
+        if self.score_threshold is not None:
+            keep = np.flatnonzero(scores >= self.score_threshold)
+
+        if is_mmr:
+            picks = maximal_marginal_relevance(np.asarray(query_embedding), embeddings[keep], k=self.k, lambda_mult=self.lambda_mult)
+            keep = keep[picks]
+
+        return [docs[i] for i in keep[:self.k]]
+
+
+def configurable_search(retriever:SearchModeRetriever):
+    """
+    Returns the retriever with its search options exposed as configurable
+    fields, so a request can pass e.g.
+    {"configurable": {"search_type": "mmr", "filter": {"file_type": "pdf"}}}.
+    """
+    return retriever.configurable_fields(
+        search_type=ConfigurableField(id="search_type", name="Search type", description="|".join(SEARCH_TYPES)),
+        k=ConfigurableField(id="k", name="Number of documents"),
+        fetch_k=ConfigurableField(id="fetch_k", name="MMR candidates"),
+        lambda_mult=ConfigurableField(id="lambda_mult", name="MMR relevance weight"),
+        score_threshold=ConfigurableField(id="score_threshold", name="Minimum relevance score"),
+        filter=ConfigurableField(id="filter", name="Metadata filter", description="source, section, file_type and module"),
+    )
+
+
+class VectorDBRetriever(SearchModeRetriever):
+    """Retriever over a single VectorDBReader collection."""
+
+    reader: VectorDBReader
+
+    def _embed_query(self, query:str) -> List[float]:
+        return self.reader.embed_query(query)
+
+    def _search(self, query_embedding:List[float], k:int, include_embeddings:bool, filter:Optional[dict]) -> Tuple[List[Document], np.ndarray, Optional[np.ndarray]]:
+        return self.reader.search_by_vector(query_embedding, k, include_embeddings, filter)
+
+
+class CollectionSearches:
+    """
+    This class runs the searches of each collection on threads of its own, so
+    a slow collection only holds its own threads, and counts the searches that
+    timed out. A search that times out keeps its thread until it returns, so a
+    collection is not searched again while one of its timed-out searches still
+    runs, instead of queuing every later request behind it.
+
+    Params:
+        collection_names: the collections to search
+        threads: the number of searches of one collection that may run at once
+    """
+
+    def __init__(self, collection_names:List[str], threads:int=4):
+        # sized so a few concurrent requests can fan out at once
+        self._executors = {name: ThreadPoolExecutor(max_workers=threads) for name in collection_names}
+        self._lock = threading.Lock()
+        self._late = {name: 0 for name in collection_names}
+        self._late_futures = set()
+
+    def busy(self, collection_name:str) -> int:
+        """Returns the number of timed-out searches of the collection still running."""
+        with self._lock:
+            return self._late[collection_name]
+
+    def submit(self, collection_name:str, fn, *args) -> Future:
+        """Runs fn(*args) on a thread of the collection."""
+        future = self._executors[collection_name].submit(fn, *args)
+        future.add_done_callback(lambda future: self._finish(collection_name, future))
+        return future
+
+    def timed_out(self, collection_name:str, future:Future) -> None:
+        """Cancels a search that did not answer within the timeout, or counts it if it is running."""
+        # a search still queued never takes a thread
+        if future.cancel():
+            return
+        with self._lock:
+            if not future.done():
+                self._late[collection_name] += 1
+                self._late_futures.add(future)
+
+    def _finish(self, collection_name:str, future:Future) -> None:
+        with self._lock:
+            if future in self._late_futures:
+                self._late_futures.remove(future)
+                self._late[collection_name] -= 1
+
+    def close(self) -> None:
+        """Stops the search threads."""
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+
+
+class MultiCollectionRetriever(SearchModeRetriever):
+    """
+    Retriever that searches several collections concurrently with one query
+    embedding and merges the results by relevance score. Collections that do
+    not answer within the timeout, or are still busy with searches that timed
+    out, are left out of the results.
+    """
+
+    readers: List[VectorDBReader]
+    embedding: Embeddings
+    searches: CollectionSearches
+    timeout: float = 5.0
+
+    def _embed_query(self, query:str) -> List[float]:
+        return self.embedding.embed_query(query)
+
+    def _search(self, query_embedding:List[float], k:int, include_embeddings:bool, filter:Optional[dict]) -> Tuple[List[Document], np.ndarray, Optional[np.ndarray]]:
+        futures = {}
+        for reader in self.readers:
+            busy = self.searches.busy(reader.collection_name)
+            if busy:
+                print("> collection %s skipped, still busy with %d search(es) that timed out" % (reader.collection_name, busy))
+                continue
+            future = self.searches.submit(reader.collection_name, reader.search_by_vector, query_embedding, k, include_embeddings, filter)
+            futures[future] = reader
+        done, not_done = wait(futures, timeout=self.timeout)
+
+        for future in not_done:
+            reader = futures[future]
+            self.searches.timed_out(reader.collection_name, future)
+            print("> collection %s timed out after %.1fs" % (reader.collection_name, self.timeout))
+
+        all_docs = []
+        all_scores = []
+        all_embeddings = []
+        for future in done:
+            reader = futures[future]
+            try:
+                docs, scores, embeddings = future.result()
+            except Exception as e:
+                print("> collection %s failed - %s" % (reader.collection_name, e))
+                continue
+
+            for doc in docs:
+                doc.metadata["collection"] = reader.collection_name
+            all_docs.extend(docs)
+            all_scores.append(scores)
+            if include_embeddings:
+                all_embeddings.append(embeddings)
+
+        if not all_docs:
+            return [], np.empty(0, dtype=np.float32), None
+
+        scores = np.concatenate(all_scores)
+        order = np.argsort(-scores, kind="stable")[:k]
+        embeddings = None
+        if include_embeddings:
+            embeddings = np.concatenate(all_embeddings)[order]
+        return [all_docs[i] for i in order], scores[order], embeddings
+
+
+class MultiCollectionReader:
+    """
+    This class provide reader for several collections of one vector database,
+    e.g., the per-course collections created with --create_allinone. All
+    collections share one embedding model and one Chroma client, and must be
+    built with the same embedding model and distance function for their
+    scores to be comparable.
+    """
+
+    def __init__(self, db_path:Optional[str]=None, collection_names:Optional[List[str]]=None, backend:str="chroma", search_ef:Optional[int]=None, timeout:float=5.0, embedding:Optional[Embeddings]=None):
+        if embedding:
+            self._embedding=embedding
+        else:
+            self._embedding=GPT4AllEmbeddings()
+        self._timeout = timeout
+        if not collection_names:
+            collection_names = ["langchain"]
+
+        client = None
+        self._client = None
+        if backend != "flat":
+            client_settings = chromadb.Settings()
+            if db_path:
+                client_settings.persist_directory=db_path
+                client_settings.is_persistent=True
+            client = chromadb.Client(client_settings)
+            self._client = client
+
+        self._readers = [
+            VectorDBReader(db_path=db_path, collection_name=collection_name, backend=backend, search_ef=search_ef, embedding=self._embedding, client=client)
+            for collection_name in collection_names
+        ]
+        self._searches = CollectionSearches(collection_names)
+
+    def close(self) -> None:
+        """Stops the shared Chroma client and the search threads."""
+        self._searches.close()
+        if self._client:
+            _close_client(self._client)
+            self._client = None
+
+    def facets(self) -> dict:
+        """Returns the facets of each collection, see VectorDBReader.facets."""
+        return {reader.collection_name: reader.facets() for reader in self._readers}
+
+    def as_retriever(self, k:Optional[int]=None, search_type:str="similarity", **kwargs:Any) -> MultiCollectionRetriever:
+        """Return a retriever that searches all collections, see VectorDBReader.as_retriever."""
+        return MultiCollectionRetriever(
+            readers=self._readers,
+            embedding=self._embedding,
+            searches=self._searches,
+            k=search_k(k),
+            search_type=search_type,
+            timeout=self._timeout,
+            **kwargs,
+        )
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the answer chain served by langclient.py, with its precomputed answers and semantic cache."""
+
+from operator import itemgetter
+from typing import AsyncIterator, Callable, Iterator, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableBranch, RunnableConfig, RunnableGenerator, RunnableLambda, RunnablePassthrough
+
+from answer_table import AnswerTable
+from compression import ContextCompressor
+from prompts import format_context, prompt
+from semantic_cache import SemanticCache, doc_id
+from vectordb_reader import SEARCH_OPTIONS, EmbeddedQuery
+
+
+def _find_answer(question:str, embedding:Optional[Embeddings], answer_cache:Optional[SemanticCache], answer_table:Optional[AnswerTable], collection:str) -> dict:
+    # outside of make_answer_chain: RunnableLambda inspects the attributes
+    # its function reads from enclosing variables, which may be None here
+    request = {"question": question, "embedding": None, "cached": None}
+    if not (answer_cache or answer_table):
+        return request
+
+    question_embedding = embedding.embed_query(question)
+    request["question"] = EmbeddedQuery(question, question_embedding)
+    if answer_table:
+        precomputed = answer_table.lookup(question, question_embedding)
+        if precomputed:
+            print("> precomputed answer (%.3f): %s" % (precomputed.similarity, precomputed.question))
+            request["cached"] = precomputed.answer
+            return request
+    if answer_cache:
+        cached = answer_cache.lookup(collection, question_embedding)
+        if cached:
+            print("> semantic cache hit (%.3f): %s" % (cached.similarity, cached.question))
+            request["cached"] = cached.answer
+            return request
+        request["embedding"] = question_embedding
+    return request
+
+
+def make_answer_chain(retriever:Runnable, llm:BaseLanguageModel, embedding:Optional[Embeddings]=None, answer_cache:Optional[SemanticCache]=None, answer_table:Optional[AnswerTable]=None, collection:str="", compressor:Optional[ContextCompressor]=None, format_documents:Callable[[List[Document]], str]=format_context) -> Runnable:
+    """
+    Returns the chain answering a question with the documents of the
+    retriever.
+
+    With an answer table or a semantic cache, the question is embedded once
+    and looked up in the table, then in the cache; on a miss the retriever
+    searches with the same embedding, and the answer is added to the cache
+    once it is completely generated. A request whose "configurable" config
+    holds search options (see vectordb_reader.SEARCH_OPTIONS) bypasses both,
+    its answer depends on them.
+
+    The retriever and the llm are steps of the returned chain, so their
+    configurable fields are its config specs and langserve passes the
+    "configurable" config of a request on to them.
+
+    Params:
+      retriever  the retriever, e.g., with configurable_search()
+      llm  the model generating the answer
+      embedding  the embedding model of the retriever, to look questions up
+      answer_cache  the semantic cache of generated answers
+      answer_table  the precomputed answers, served first
+      collection  the name answers are cached under
+      compressor  shrinks the retrieved documents before generation
+      format_documents  turns the documents into the context of the prompt
+    """
+    def lookup(question:str, config:RunnableConfig) -> dict:
+        if set(config.get("configurable", {})) & set(SEARCH_OPTIONS):
+            return {"question": question, "embedding": None, "cached": None}
+        return _find_answer(question, embedding, answer_cache, answer_table, collection)
+
+    def compress_documents(inputs:dict) -> List[Document]:
+        docs, stats = compressor.compress(inputs["question"], inputs["docs"])
+        print("> compressed context to %d/%d tokens (%.0f%%) in %.3fs, about %.2fs to first token saved" % (stats.kept_tokens, stats.original_tokens, 100 * stats.ratio, stats.seconds, stats.saved_seconds))
+        return docs
+
+    def remember(request:dict, answer:List[str]) -> None:
+        # only reached when the whole answer was generated
+        if answer and answer_cache and request.get("embedding") is not None:
+            answer_cache.add(collection, request["embedding"], str(request["question"]), "".join(answer), [doc_id(doc) for doc in request["docs"]])
+
+    def stream_answer(chunks:Iterator[dict]) -> Iterator[str]:
+        request = {}
+        answer = []
+        for chunk in chunks:
+            # streamed, the request fields and the answer come in separate chunks
+            request.update((key, value) for key, value in chunk.items() if key != "answer")
+            if "answer" in chunk:
+                answer.append(chunk["answer"])
+                yield chunk["answer"]
+        remember(request, answer)
+
+    async def astream_answer(chunks:AsyncIterator[dict]) -> AsyncIterator[str]:
+        request = {}
+        answer = []
+        async for chunk in chunks:
+            # streamed, the request fields and the answer come in separate chunks
+            request.update((key, value) for key, value in chunk.items() if key != "answer")
+            if "answer" in chunk:
+                answer.append(chunk["answer"])
+                yield chunk["answer"]
+        remember(request, answer)
+
+    docs = itemgetter("question") | retriever
+    if compressor:
+        docs = {"docs": docs, "question": itemgetter("question")} | RunnableLambda(compress_documents)
+    answer = (
+        {"context": itemgetter("docs") | RunnableLambda(format_documents), "question": itemgetter("question")}
+        | prompt
+        | llm
+        | StrOutputParser()
+    )
+    generate = (
+        RunnablePassthrough.assign(docs=docs)
+        | RunnablePassthrough.assign(answer=answer)
+        | RunnableGenerator(stream_answer, astream_answer)
+    )
+    return RunnableLambda(lookup) | RunnableBranch(
+        (lambda request: request["cached"] is not None, itemgetter("cached")),
+        generate,
+    )
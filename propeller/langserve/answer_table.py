@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the lookup table of precomputed answers to frequent questions."""
+
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from semantic_cache import CachedAnswer, SemanticCache
+
+
+def normalize_question(question:str) -> str:
+    """Returns the question lowercased, without punctuation and repeated spaces."""
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+def write_answer_table(path:str, table:dict) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class AnswerTable:
+    """
+    This class serves the answers written by precompute_answers.py. A
+    question matches an entry when it is the same question up to case and
+    punctuation or, with its embedding, when it is at least threshold similar
+    to the entry's question. The table file and the served index version
+    are checked at most every check_interval seconds: the table is reloaded
+    when it is replaced, and ignored while it was built for another index
+    version or with another model than the ones being served, or does not
+    say which.
+
+    Params:
+      path  the table file
+      threshold  minimum cosine similarity of a paraphrase match
+      index_version  returns the version of the served index
+      model  the model generating the live answers
+    """
+
+    def __init__(self, path:str, threshold:float=0.95, index_version:Optional[Callable[[], Any]]=None, model:Optional[str]=None, check_interval:float=30.0):
+        self._path = path
+        self._threshold = threshold
+        self._index_version = index_version
+        self._model = model
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = None
+        self._mismatch = None
+        self._table = {}
+        self._questions = {}
+        self._cache = None
+
+    def _load(self) -> None:
+        # call with the lock held
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+
+        self._mtime = mtime
+        self._table = {}
+        self._questions = {}
+        self._cache = None
+        if mtime is None:
+            return
+
+        with open(self._path, "r", encoding="utf-8") as f:
+            self._table = json.load(f)
+        entries = self._table.get("answers", [])
+        self._questions = {normalize_question(entry["question"]): entry for entry in entries}
+        with_embeddings = [entry for entry in entries if entry.get("embedding")]
+        if with_embeddings:
+            self._cache = SemanticCache(threshold=self._threshold, max_entries=len(with_embeddings))
+            for entry in with_embeddings:
+                self._cache.add("", entry["embedding"], entry["question"], entry["answer"], entry.get("doc_ids", []))
+        print("> loaded %d precomputed answers (index version %s)" % (len(entries), self._table.get("index_version")))
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self._check_interval:
+            self._checked = now
+            self._load()
+            mismatch = None
+            served_version = self._index_version() if self._questions and self._index_version else None
+            if self._questions and self._index_version and self._table.get("index_version") != served_version:
+                mismatch = "built for index version %s, not %s" % (self._table.get("index_version"), served_version)
+            elif self._questions and self._model and self._table.get("model") != self._model:
+                mismatch = "generated by model %s, not %s" % (self._table.get("model"), self._model)
+            if mismatch and mismatch != self._mismatch:
+                print("> not serving the precomputed answers, %s" % mismatch)
+            self._mismatch = mismatch
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._check()
+            return len(self._questions)
+
+    def lookup(self, question:str, embedding:Optional[List[float]]=None) -> Optional[CachedAnswer]:
+        with self._lock:
+            self._check()
+            if not self._questions or self._mismatch:
+                return None
+
+            entry = self._questions.get(normalize_question(question))
+            if entry:
+                return CachedAnswer(entry["question"], entry["answer"], entry.get("doc_ids", []), 1.0)
+            if embedding is not None and self._cache:
+                return self._cache.lookup("", embedding)
+            return None
+
+    def info(self) -> dict:
+        with self._lock:
+            self._check()
+            return {
+                "path": self._path,
+                "answers": len(self._questions),
+                "index_version": self._table.get("index_version"),
+                "model": self._table.get("model"),
+                "created": self._table.get("created"),
+                "served": bool(self._questions) and not self._mismatch,
+                "mismatch": self._mismatch,
+            }
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""This module holds the logic to publish and fetch versioned vector database artifacts."""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from typing import Iterator, List, Optional
+
+MANIFEST_FILE = "manifest.json"
+ARCHIVE_FILE = "index.tar.gz"
+CURRENT_FILE = "CURRENT"
+# in an unpacked version, the checksum of the archive it was unpacked from
+FETCHED_FILE = ".sha256"
+# in the cache folder of an artifact, serialize the processes sharing it
+LOCK_FILE = ".lock"
+REFERENCES_DIR = ".references"
+
+
+def _sha256(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomic(path:str, content:str) -> None:
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def list_versions(publish_root:str, name:str) -> List[str]:
+    """Returns the published versions of an artifact, oldest first."""
+    artifact_root = os.path.join(publish_root, name)
+    if not os.path.isdir(artifact_root):
+        return []
+
+    versions = []
+    for version in os.listdir(artifact_root):
+        if os.path.exists(os.path.join(artifact_root, version, MANIFEST_FILE)):
+            versions.append(version)
+    return sorted(versions)
+
+
+def current_version(publish_root:str, name:str) -> Optional[str]:
+    """Returns the version an artifact's CURRENT pointer refers to."""
+    current_path = os.path.join(publish_root, name, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+
+    with open(current_path, "r") as f:
+        return f.read().strip() or None
+
+
+def set_current_version(publish_root:str, name:str, version:str) -> None:
+    if version not in list_versions(publish_root, name):
+        raise ValueError("version %s of %s is not published" % (version, name))
+    _write_atomic(os.path.join(publish_root, name, CURRENT_FILE), version + "\n")
+
+
+def read_manifest(publish_root:str, name:str, version:str) -> dict:
+    with open(os.path.join(publish_root, name, version, MANIFEST_FILE), "r") as f:
+        return json.load(f)
+
+
+def publish_artifact(db_path:str, publish_root:str, name:str, info:Optional[dict]=None) -> str:
+    """
+    Packs a vector database folder into an immutable, checksummed artifact
+    and points the artifact's CURRENT file at it.
+
+    Params:
+      db_path  the vector database folder
+      publish_root  the folder holding published artifacts
+      name  the artifact name, e.g., the course name
+      info  extra fields to record in the manifest
+    """
+    version = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+    artifact_root = os.path.join(publish_root, name)
+    os.makedirs(artifact_root, exist_ok=True)
+
+    # build the version in a temp dir next to its final path, then rename it
+    temp_dir = tempfile.mkdtemp(prefix=".publish-", dir=artifact_root)
+    archive_path = os.path.join(temp_dir, ARCHIVE_FILE)
+    with tarfile.open(archive_path, "w:gz") as tfile:
+        tfile.add(db_path, arcname=".")
+
+    manifest = {
+        "name": name,
+        "version": version,
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "archive": ARCHIVE_FILE,
+        "sha256": _sha256(archive_path),
+        "size": os.path.getsize(archive_path),
+    }
+    if info:
+        manifest.update(info)
+
+    _write_atomic(os.path.join(temp_dir, MANIFEST_FILE), json.dumps(manifest, indent=2))
+    os.replace(temp_dir, os.path.join(artifact_root, version))
+
+    set_current_version(publish_root, name, version)
+    return version
+
+
+@contextlib.contextmanager
+def _cache_lock(cache_root:str, name:str) -> Iterator[str]:
+    """Holds the lock of an artifact's cache folder, shared by the worker processes of a server."""
+    name_root = os.path.join(cache_root, name)
+    os.makedirs(name_root, exist_ok=True)
+    with open(os.path.join(name_root, LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield name_root
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _fetched_checksum(target_path:str) -> Optional[str]:
+    try:
+        with open(os.path.join(target_path, FETCHED_FILE), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def fetch_artifact(publish_root:str, name:str, version:str, cache_root:str) -> str:
+    """
+    Verifies a published artifact and unpacks it into the cache folder,
+    returning the path of the unpacked vector database. Processes sharing
+    the cache folder fetch under a lock, so a version is unpacked once and
+    the others use it.
+    """
+    manifest = read_manifest(publish_root, name, version)
+    with _cache_lock(cache_root, name) as name_root:
+        target_path = os.path.join(name_root, version)
+        if os.path.exists(target_path):
+            if _fetched_checksum(target_path) == manifest["sha256"]:
+                return target_path
+            # left by an older fetch, or unpacked from another archive
+            shutil.rmtree(target_path)
+
+        archive_path = os.path.join(publish_root, name, version, manifest["archive"])
+        checksum = _sha256(archive_path)
+        if checksum != manifest["sha256"]:
+            raise ValueError("checksum mismatch for %s version %s" % (name, version))
+
+        temp_dir = tempfile.mkdtemp(prefix=".fetch-", dir=name_root)
+        try:
+            with tarfile.open(archive_path, "r:gz") as tfile:
+                tfile.extractall(temp_dir)
+            _write_atomic(os.path.join(temp_dir, FETCHED_FILE), checksum + "\n")
+            os.replace(temp_dir, target_path)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+    return target_path
+
+
+def _is_running(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def reference_fetched(cache_root:str, name:str, versions:List[str], owner:Optional[int]=None) -> None:
+    """
+    Records the unpacked versions a process uses (default: this one), so
+    remove_fetched() in another process sharing the cache folder keeps them.
+    """
+    with _cache_lock(cache_root, name) as name_root:
+        references_root = os.path.join(name_root, REFERENCES_DIR)
+        os.makedirs(references_root, exist_ok=True)
+        _write_atomic(os.path.join(references_root, str(owner or os.getpid())), "\n".join(versions) + "\n")
+
+
+def remove_fetched(cache_root:str, name:str, keep:List[str]) -> None:
+    """
+    Removes unpacked versions from the cache folder except the ones to keep
+    and the ones referenced by a running process, see reference_fetched().
+    """
+    if not os.path.isdir(os.path.join(cache_root, name)):
+        return
+
+    with _cache_lock(cache_root, name) as name_root:
+        keep = set(keep)
+        references_root = os.path.join(name_root, REFERENCES_DIR)
+        if os.path.isdir(references_root):
+            for owner in os.listdir(references_root):
+                reference_path = os.path.join(references_root, owner)
+                if not owner.isdigit() or not _is_running(int(owner)):
+                    os.remove(reference_path)
+                    continue
+                with open(reference_path, "r") as f:
+                    keep.update(line.strip() for line in f if line.strip())
+
+        for version in os.listdir(name_root):
+            # no fetch runs while the lock is held, a temp dir was left by a crash
+            if (version not in keep and not version.startswith(".")) or version.startswith(".fetch-"):
+                shutil.rmtree(os.path.join(name_root, version), ignore_errors=True)
+
+
+def rollback(publish_root:str, name:str, version:Optional[str]=None) -> str:
+    """
+    Points an artifact's CURRENT file at the given version, or at the
+    version published before the current one.
+    """
+    if not version:
+        versions = list_versions(publish_root, name)
+        current = current_version(publish_root, name)
+        if current not in versions or versions.index(current) == 0:
+            raise ValueError("no version of %s to roll back to" % name)
+        version = versions[versions.index(current) - 1]
+
+    set_current_version(publish_root, name, version)
+    return version
+
+
+############################
+# Manage published artifacts
+############################
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='artifact',
+        description='List or roll back published vectordb artifacts')
+
+    parser.add_argument('--version', help='version to roll back to (default: the previous one)')
+    parser.add_argument('command', choices=['list', 'rollback'], help='command')
+    parser.add_argument('publish_root', help='folder holding published artifacts')
+    parser.add_argument('name', help='artifact name, e.g., course name')
+    args = parser.parse_args()
+
+    if args.command == "rollback":
+        version = rollback(args.publish_root, args.name, args.version)
+        print("%s now points at version %s" % (args.name, version))
+        return
+
+    current = current_version(args.publish_root, args.name)
+    for version in list_versions(args.publish_root, args.name):
+        manifest = read_manifest(args.publish_root, args.name, version)
+        marker = "*" if version == current else " "
+        print("%s %s %s %d" % (marker, version, manifest["sha256"][:12], manifest["size"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the query-aware extractive compression of retrieved context before generation."""
+
+import collections
+import threading
+import time
+from typing import Any, Deque, List, Optional, Tuple
+
+import numpy as np
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import LLMResult
+
+# rough size of a token, the prompt is not tokenized by the server
+CHARS_PER_TOKEN = 4
+# compressions kept for the per-request percentiles
+_RECENT_REQUESTS = 1000
+
+
+def estimate_tokens(text:str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def split_sentences(text:str) -> List[str]:
+    """Returns the sentences of a chunk, stored one per line by the ingest (see textclean.segment_docs)."""
+    return [line.strip() for line in text.split("\n") if line.strip()]
+
+
+class CompressionStats:
+    def __init__(self, original_tokens:int, kept_tokens:int, sentences:int, kept_sentences:int, seconds:float, saved_seconds:float):
+        self.original_tokens = original_tokens
+        self.kept_tokens = kept_tokens
+        self.sentences = sentences
+        self.kept_sentences = kept_sentences
+        self.seconds = seconds
+        # estimated time to first token saved, net of the compression itself
+        self.saved_seconds = saved_seconds
+
+    @property
+    def ratio(self) -> float:
+        return self.kept_tokens / self.original_tokens if self.original_tokens else 1.0
+
+    def as_dict(self) -> dict:
+        return {
+            "original_tokens": self.original_tokens,
+            "kept_tokens": self.kept_tokens,
+            "ratio": self.ratio,
+            "sentences": self.sentences,
+            "kept_sentences": self.kept_sentences,
+            "seconds": self.seconds,
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+class ContextCompressor:
+    """
+    This class shrinks the retrieved documents of a question to the sentences
+    most similar to it. The question and every sentence not embedded before
+    are embedded in one batched call; sentences are then picked by cosine
+    similarity to the question until max_tokens is reached, and kept in
+    their original order within their documents. Documents left without a
+    sentence are dropped.
+
+    The time to first token saved is estimated from the tokens removed and
+    the prompt evaluation rate of the LLM, measured from its responses by a
+    PrefillObserver and starting at prefill_tokens_per_second.
+
+    Params:
+      embedding  the embedding model of the retriever
+      max_tokens  token budget of the compressed context
+      min_similarity  sentences below this similarity are dropped even within the budget
+      prefill_tokens_per_second  prompt evaluation rate assumed until one is measured
+      cache_size  sentence embeddings kept, the same chunks are retrieved again and again
+    """
+
+    def __init__(self, embedding:Embeddings, max_tokens:int=512, min_similarity:Optional[float]=None, prefill_tokens_per_second:float=100.0, cache_size:int=50000):
+        self._embedding = embedding
+        self._max_tokens = max_tokens
+        self._min_similarity = min_similarity
+        self._prefill_tokens_per_second = prefill_tokens_per_second
+        self._cache_size = cache_size
+        self._cache: "collections.OrderedDict[str, np.ndarray]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._recent: Deque[CompressionStats] = collections.deque(maxlen=_RECENT_REQUESTS)
+        self._requests = 0
+        self._original_tokens = 0
+        self._kept_tokens = 0
+        self._saved_seconds = 0.0
+
+    def _embed(self, query:str, sentences:List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        # cached vectors are copied out now, a concurrent request may evict
+        # them before the missing ones are embedded
+        with self._lock:
+            found = {sentence: self._cache[sentence] for sentence in sentences if sentence in self._cache}
+        missing = list(dict.fromkeys(sentence for sentence in sentences if sentence not in found))
+        vectors = np.asarray(self._embedding.embed_documents([query] + missing), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        found.update(zip(missing, vectors[1:]))
+        with self._lock:
+            for sentence in sentences:
+                self._cache[sentence] = found[sentence]
+                self._cache.move_to_end(sentence)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return vectors[0], np.stack([found[sentence] for sentence in sentences])
+
+    def compress(self, query:str, docs:List[Document]) -> Tuple[List[Document], CompressionStats]:
+        """Returns the compressed documents, in their original order, and what the compression saved."""
+        start = time.perf_counter()
+        sentences = []
+        owners = []
+        for doc_number, doc in enumerate(docs):
+            for sentence in split_sentences(doc.page_content):
+                sentences.append(sentence)
+                owners.append(doc_number)
+        original_tokens = sum(estimate_tokens(doc.page_content) for doc in docs)
+        if not sentences:
+            return docs, CompressionStats(original_tokens, original_tokens, 0, 0, 0.0, 0.0)
+
+        query_vector, sentence_vectors = self._embed(query, sentences)
+        similarities = sentence_vectors @ query_vector
+
+        keep = np.zeros(len(sentences), dtype=bool)
+        budget = self._max_tokens
+        for index in np.argsort(-similarities, kind="stable"):
+            if self._min_similarity is not None and similarities[index] < self._min_similarity:
+                break
+            tokens = estimate_tokens(sentences[index])
+            if tokens > budget:
+                # a shorter sentence may still fit
+                continue
+            keep[index] = True
+            budget -= tokens
+
+        kept = collections.defaultdict(list)
+        for index in np.flatnonzero(keep):
+            kept[owners[index]].append(sentences[index])
+        out_docs = [
+            Document(page_content="\n".join(kept[doc_number]), metadata=doc.metadata)
+            for doc_number, doc in enumerate(docs)
+            if kept[doc_number]
+        ]
+
+        seconds = time.perf_counter() - start
+        kept_tokens = sum(estimate_tokens(doc.page_content) for doc in out_docs)
+        saved_seconds = (original_tokens - kept_tokens) / self._prefill_tokens_per_second - seconds
+        stats = CompressionStats(original_tokens, kept_tokens, len(sentences), int(keep.sum()), seconds, saved_seconds)
+        with self._lock:
+            self._recent.append(stats)
+            self._requests += 1
+            self._original_tokens += original_tokens
+            self._kept_tokens += kept_tokens
+            self._saved_seconds += saved_seconds
+        return out_docs, stats
+
+    def observe_prefill(self, tokens:int, seconds:float) -> None:
+        """Updates the prompt evaluation rate from a measured generation."""
+        if tokens > 0 and seconds > 0:
+            with self._lock:
+                # smoothed, a single slow generation does not swing the estimate
+                self._prefill_tokens_per_second = 0.8 * self._prefill_tokens_per_second + 0.2 * (tokens / seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = list(self._recent)
+            result = {
+                "requests": self._requests,
+                "max_tokens": self._max_tokens,
+                "original_tokens": self._original_tokens,
+                "kept_tokens": self._kept_tokens,
+                "ratio": self._kept_tokens / self._original_tokens if self._original_tokens else 1.0,
+                "saved_seconds": self._saved_seconds,
+                "cached_sentences": len(self._cache),
+                "prefill_tokens_per_second": self._prefill_tokens_per_second,
+            }
+        if recent:
+            seconds = np.asarray([stats.seconds for stats in recent])
+            saved = np.asarray([stats.saved_seconds for stats in recent])
+            result.update({
+                "compression_p50_seconds": float(np.percentile(seconds, 50)),
+                "compression_p99_seconds": float(np.percentile(seconds, 99)),
+                "saved_p50_seconds": float(np.percentile(saved, 50)),
+            })
+        return result
+
+
+class PrefillObserver(BaseCallbackHandler):
+    """Feeds the prompt evaluation time Ollama reports with each generation to a ContextCompressor."""
+
+    def __init__(self, compressor:ContextCompressor):
+        self._compressor = compressor
+
+    def on_llm_end(self, response:LLMResult, **kwargs:Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                # durations are in nanoseconds
+                if info.get("prompt_eval_count") and info.get("prompt_eval_duration"):
+                    self._compressor.observe_prefill(info["prompt_eval_count"], info["prompt_eval_duration"] / 1e9)
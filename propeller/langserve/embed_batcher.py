@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the micro-batcher that embeds the questions of concurrent requests together."""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Sequence
+
+from langchain_core.embeddings import Embeddings
+
+# histogram buckets, upper bounds
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+QUEUE_DELAY_MS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """Counts observations per bucket of upper bounds, the last bucket takes the rest."""
+
+    def __init__(self, bounds:Sequence[float]):
+        self._bounds = list(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._total = 0
+
+    def observe(self, value:float) -> None:
+        for bucket, bound in enumerate(self._bounds):
+            if value <= bound:
+                break
+        else:
+            bucket = len(self._bounds)
+        self._counts[bucket] += 1
+        self._sum += value
+        self._total += 1
+
+    def as_dict(self) -> dict:
+        labels = ["<=%g" % bound for bound in self._bounds] + [">%g" % self._bounds[-1]]
+        return {
+            "count": self._total,
+            "mean": self._sum / self._total if self._total else 0.0,
+            "buckets": dict(zip(labels, self._counts)),
+        }
+
+
+class _Request:
+    def __init__(self, text:str):
+        self.text = text
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+def _fail(batch:List[_Request], error:Exception) -> None:
+    for request in batch:
+        # skips the futures already resolved, or cancelled by their callers
+        if not request.future.done() and request.future.set_running_or_notify_cancel():
+            request.future.set_exception(error)
+
+
+class EmbeddingBatcher(Embeddings):
+    """
+    This class embeds queries of concurrent callers in batches. The first
+    query waiting starts a window of window_ms; the queries that arrive
+    within it, up to max_batch, are embedded with one embed_documents call
+    of the wrapped model and every caller gets its own embedding back. A lone
+    query waits at most window_ms, a burst of queries is embedded by one
+    thread instead of as many threads competing for the CPU.
+
+    The batch sizes and the time queries wait for their batch are kept as
+    histograms, see stats(). Documents are embedded directly.
+
+    The batching thread is started on first use in each process, so the
+    batcher can be created before the server forks its workers. A batch that
+    fails, or gets fewer embeddings back than it has queries, fails all its
+    callers, and a caller waits at most timeout seconds for its embedding.
+
+    Params:
+      embedding  the embedding model
+      window_ms  milliseconds a batch waits for more queries
+      max_batch  queries per batch
+      timeout  seconds a caller waits for its embedding
+    """
+
+    def __init__(self, embedding:Embeddings, window_ms:float=5.0, max_batch:int=32, timeout:float=60.0):
+        self._embedding = embedding
+        self._timeout = timeout
+        self._window = window_ms / 1000.0
+        self._max_batch = max(1, max_batch)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self._queue_delays = Histogram(QUEUE_DELAY_MS_BUCKETS)
+        self._batches = 0
+        self._embed_seconds = 0.0
+
+    def _ensure_thread(self) -> "queue.SimpleQueue":
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked worker does not have the thread of its parent
+                self._pid = os.getpid()
+                self._queue = queue.SimpleQueue()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+            return self._queue
+
+    def _run(self, requests:"queue.SimpleQueue") -> None:
+        while True:
+            batch = [requests.get()]
+            deadline = batch[0].enqueued + self._window
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._embed_batch(batch)
+            except Exception as e:
+                # the thread serves every later query, it must not die
+                _fail(batch, e)
+
+    def _embed_batch(self, batch:List[_Request]) -> None:
+        start = time.perf_counter()
+        with self._lock:
+            self._batches += 1
+            self._batch_sizes.observe(len(batch))
+            for request in batch:
+                self._queue_delays.observe((start - request.enqueued) * 1000.0)
+
+        try:
+            embeddings = self._embedding.embed_documents([request.text for request in batch])
+            if len(embeddings) != len(batch):
+                raise ValueError("%d embeddings returned for %d queries" % (len(embeddings), len(batch)))
+        except Exception as e:
+            _fail(batch, e)
+            return
+        finally:
+            with self._lock:
+                self._embed_seconds += time.perf_counter() - start
+
+        for request, embedding in zip(batch, embeddings):
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_result(list(embedding))
+
+    def embed_query(self, text:str) -> List[float]:
+        request = _Request(text)
+        self._ensure_thread().put(request)
+        try:
+            return request.future.result(timeout=self._timeout)
+        except TimeoutError:
+            request.future.cancel()
+            raise TimeoutError("query not embedded within %ss" % self._timeout)
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        return self._embedding.embed_documents(texts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "window_ms": self._window * 1000.0,
+                "max_batch": self._max_batch,
+                "batches": self._batches,
+                "embed_seconds": self._embed_seconds,
+                "batch_size": self._batch_sizes.as_dict(),
+                "queue_delay_ms": self._queue_delays.as_dict(),
+            }
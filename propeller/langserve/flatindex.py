@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds a flat, memory-mapped vector store with quantized storage."""
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import uuid
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from metafilter import FACET_FIELDS, add_facets
+
+_HEADER_FILE = "index.json"
+_VECTORS_FILE = "vectors.bin"
+_SCALES_FILE = "scales.f32"
+_REFERENCE_FILE = "vectors.f32"
+_DOCS_FILE = "docs.jsonl"
+_OFFSETS_FILE = "offsets.i64"
+_FACETS_FILE = "facets.i32"
+
+# rows scored per block, bounds the float32 scratch memory used while searching
+_SEARCH_BLOCK_ROWS = 16384
+
+FLAT_DTYPES = ("float16", "int8")
+
+
+def _normalize(vectors:np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores:np.ndarray, k:int) -> np.ndarray:
+    """Return the indices of the k highest scores of each row, best first."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+class FlatIndex(VectorStore):
+    """
+    This class is an exact-search vector store kept in a directory of flat
+    files. Embeddings are appended to a float16 or int8 (per-row scaled)
+    matrix that readers open with mmap, so worker processes serving the same
+    collection share one copy of the pages through the OS page cache.
+    Documents are stored as JSON lines and only the hits are decoded. The
+    facet fields of every row (see metafilter.FACET_FIELDS) are kept as
+    integer codes, so a metadata filter selects rows without decoding any
+    document and only those rows are scored.
+
+    With keep_float32, a float32 copy of the embeddings is also written, only
+    to measure recall of the quantized matrix against exact search (see
+    recall()); it takes more disk than the quantized matrix itself.
+
+    The row count in the header is written last, so rows appended by a write
+    that did not complete are ignored by readers and truncated by the next
+    writer.
+
+    Rows are deleted by marking them in the header, e.g., those of a file
+    added again, so searches skip them; compact() then rewrites the index
+    without them in one pass.
+    """
+
+    def __init__(self, embedding_function:Embeddings, persist_directory:Optional[str]=None, collection_name:Optional[str]=None, dtype:str="float16", keep_float32:bool=False):
+        if dtype not in FLAT_DTYPES:
+            raise ValueError("unsupported flat index dtype %s" % dtype)
+
+        if not persist_directory:
+            persist_directory = tempfile.mkdtemp()
+        if not collection_name:
+            collection_name = "langchain"
+
+        self._embedding_function = embedding_function
+        self._path = os.path.join(persist_directory, collection_name + ".flat")
+        self._header = {
+            "version": 1,
+            "dtype": dtype,
+            "dim": 0,
+            "count": 0,
+            "docs_bytes": 0,
+            "keep_float32": keep_float32,
+            "facet_fields": list(FACET_FIELDS),
+            "facets": {field: [] for field in FACET_FIELDS},
+        }
+        self._header_mtime = None
+        self._vectors = None
+        self._scales = None
+        self._offsets = None
+        self._docs = None
+        self._facet_codes = None
+
+        os.makedirs(self._path, exist_ok=True)
+        self._refresh()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding_function
+
+    @property
+    def count(self) -> int:
+        self._refresh()
+        return self._header["count"]
+
+    @property
+    def dtype(self) -> str:
+        return self._header["dtype"]
+
+    def _file(self, name:str) -> str:
+        return os.path.join(self._path, name)
+
+    def _refresh(self) -> None:
+        """Re-map the files when another process has committed new rows."""
+        header_path = self._file(_HEADER_FILE)
+        if not os.path.exists(header_path):
+            return
+
+        mtime = os.stat(header_path).st_mtime_ns
+        if mtime == self._header_mtime:
+            return
+
+        with open(header_path, "r") as f:
+            self._header = json.load(f)
+        self._header_mtime = mtime
+
+        count = self._header["count"]
+        dim = self._header["dim"]
+        if count == 0:
+            return
+
+        self._vectors = np.memmap(self._file(_VECTORS_FILE), dtype=self._header["dtype"], mode="r", shape=(count, dim))
+        if self._header["dtype"] == "int8":
+            self._scales = np.memmap(self._file(_SCALES_FILE), dtype=np.float32, mode="r", shape=(count,))
+        self._offsets = np.memmap(self._file(_OFFSETS_FILE), dtype=np.int64, mode="r", shape=(count,))
+        self._facet_codes = None
+        if "facet_fields" in self._header:
+            self._facet_codes = np.memmap(self._file(_FACETS_FILE), dtype=np.int32, mode="r", shape=(count, len(self._header["facet_fields"])))
+
+        with open(self._file(_DOCS_FILE), "rb") as f:
+            self._docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _write_header(self) -> None:
+        header_path = self._file(_HEADER_FILE)
+        temp_path = header_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self._header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, header_path)
+
+    def _truncate_uncommitted(self) -> None:
+        count = self._header["count"]
+        dim = self._header["dim"]
+        itemsize = np.dtype(self._header["dtype"]).itemsize
+        sizes = {
+            _VECTORS_FILE: count * dim * itemsize,
+            _SCALES_FILE: count * 4,
+            _REFERENCE_FILE: count * dim * 4,
+            _OFFSETS_FILE: count * 8,
+            _FACETS_FILE: count * len(self._header.get("facet_fields", [])) * 4,
+            _DOCS_FILE: self._header["docs_bytes"],
+        }
+        for name, size in sizes.items():
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def truncate(self, count:int) -> None:
+        """Drops the rows after the first count, e.g., those of a file whose ingestion did not complete."""
+        self._refresh()
+        if count >= self._header["count"]:
+            return
+
+        self._header["docs_bytes"] = int(self._offsets[count]) if count else 0
+        self._header["count"] = count
+        if self._header.get("deleted"):
+            self._header["deleted"] = [row for row in self._header["deleted"] if row < count]
+        self._write_header()
+        self._vectors = self._scales = self._offsets = self._docs = self._facet_codes = None
+        self._refresh()
+        self._truncate_uncommitted()
+
+    def deleted_rows(self) -> np.ndarray:
+        self._refresh()
+        return np.asarray(self._header.get("deleted", []), dtype=np.int64)
+
+    def delete_rows(self, rows:Iterable[int]) -> None:
+        """Marks rows as deleted, until compact() removes them."""
+        self._refresh()
+        deleted = set(self._header.get("deleted", []))
+        deleted.update(int(row) for row in rows if 0 <= int(row) < self._header["count"])
+        self._header["deleted"] = sorted(deleted)
+        self._write_header()
+        self._refresh()
+
+    def rows_by_source(self) -> dict:
+        """Returns the rows of each source, deleted rows left out."""
+        self._refresh()
+        deleted = set(self._header.get("deleted", []))
+        result = {}
+        for row in range(self._header["count"]):
+            if row not in deleted:
+                result.setdefault(self._get_document(row)[1].metadata.get("source", ""), []).append(row)
+        return result
+
+    def compact(self) -> int:
+        """Rewrites the index without its deleted rows, returns the number of rows removed."""
+        self._refresh()
+        deleted = self.deleted_rows()
+        if len(deleted) == 0:
+            return 0
+
+        count = self._header["count"]
+        keep = np.ones(count, dtype=bool)
+        keep[deleted] = False
+        rows = np.flatnonzero(keep)
+
+        # written next to the index and swapped in, readers keep their maps
+        compact_path = self._path + ".compact"
+        if os.path.exists(compact_path):
+            shutil.rmtree(compact_path)
+        os.makedirs(compact_path)
+        matrices = [(_VECTORS_FILE, self._vectors), (_FACETS_FILE, self._facet_codes), (_SCALES_FILE, self._scales)]
+        if self._header["keep_float32"]:
+            matrices.append((_REFERENCE_FILE, np.memmap(self._file(_REFERENCE_FILE), dtype=np.float32, mode="r", shape=(count, self._header["dim"]))))
+
+        offset = 0
+        with open(os.path.join(compact_path, _DOCS_FILE), "wb") as docs_file, open(os.path.join(compact_path, _OFFSETS_FILE), "wb") as offsets_file:
+            for start in range(0, len(rows), _SEARCH_BLOCK_ROWS):
+                block = rows[start:start + _SEARCH_BLOCK_ROWS]
+                offsets = []
+                for row in block:
+                    begin = int(self._offsets[row])
+                    end = int(self._offsets[row + 1]) if row + 1 < count else self._header["docs_bytes"]
+                    offsets.append(offset)
+                    offset += end - begin
+                    docs_file.write(self._docs[begin:end])
+                offsets_file.write(np.asarray(offsets, dtype=np.int64).tobytes())
+        for name, matrix in matrices:
+            if matrix is None:
+                continue
+            with open(os.path.join(compact_path, name), "wb") as f:
+                for start in range(0, len(rows), _SEARCH_BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(matrix[rows[start:start + _SEARCH_BLOCK_ROWS]]).tobytes())
+
+        header = dict(self._header, count=len(rows), docs_bytes=offset)
+        header.pop("deleted")
+        with open(os.path.join(compact_path, _HEADER_FILE), "w") as f:
+            json.dump(header, f)
+        for name in os.listdir(compact_path):
+            with open(os.path.join(compact_path, name), "rb") as f:
+                os.fsync(f.fileno())
+
+        old_path = self._path + ".old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.rename(self._path, old_path)
+        os.rename(compact_path, self._path)
+        shutil.rmtree(old_path)
+
+        self._header_mtime = None
+        self._vectors = self._scales = self._offsets = self._docs = self._facet_codes = None
+        self._refresh()
+        return len(deleted)
+
+    def _quantize(self, vectors:np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if self._header["dtype"] == "float16":
+            return vectors.astype(np.float16), None
+
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def add_texts(self, texts:Iterable[str], metadatas:Optional[List[dict]]=None, ids:Optional[List[str]]=None, **kwargs:Any) -> List[str]:
+        """
+        Embeds the texts and appends them to the index.
+
+        Params:
+          texts  the texts to add
+          metadatas  optional metadata for each text
+          ids  optional ids for each text
+        """
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        if ids is None:
+            ids = [str(uuid.uuid1()) for _ in texts]
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+
+        vectors = np.asarray(self._embedding_function.embed_documents(texts), dtype=np.float32)
+        vectors = _normalize(vectors)
+
+        self._refresh()
+        if self._header["dim"] == 0:
+            self._header["dim"] = int(vectors.shape[1])
+        elif self._header["dim"] != vectors.shape[1]:
+            raise ValueError("embedding dimension %d does not match index dimension %d" % (vectors.shape[1], self._header["dim"]))
+
+        self._truncate_uncommitted()
+        if "facet_fields" not in self._header:
+            self._backfill_facets()
+
+        quantized, scales = self._quantize(vectors)
+
+        lines = []
+        offsets = []
+        offset = self._header["docs_bytes"]
+        for text, metadata, docid in zip(texts, metadatas, ids):
+            line = (json.dumps({"id": docid, "text": text, "metadata": metadata}) + "\n").encode("utf-8")
+            offsets.append(offset)
+            offset += len(line)
+            lines.append(line)
+
+        appends = [
+            (_VECTORS_FILE, quantized.tobytes()),
+            (_FACETS_FILE, self._encode_facets(metadatas).tobytes()),
+            (_OFFSETS_FILE, np.asarray(offsets, dtype=np.int64).tobytes()),
+            (_DOCS_FILE, b"".join(lines)),
+        ]
+        if scales is not None:
+            appends.append((_SCALES_FILE, scales.tobytes()))
+        if self._header["keep_float32"]:
+            appends.append((_REFERENCE_FILE, vectors.tobytes()))
+
+        for name, data in appends:
+            with open(self._file(name), "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        # commit
+        self._header["count"] += len(texts)
+        self._header["docs_bytes"] = offset
+        self._write_header()
+        self._refresh()
+        return ids
+
+    def _backfill_facets(self) -> None:
+        # an index built before facets gets the codes of its rows before new ones are appended
+        metadatas = [add_facets(self._get_document(row)[1].metadata) for row in range(self._header["count"])]
+        codes = self._encode_facets(metadatas)
+        with open(self._file(_FACETS_FILE), "wb") as f:
+            f.write(codes.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _encode_facets(self, metadatas:List[dict]) -> np.ndarray:
+        # codes index the values in the header, -1 when a row has no value
+        fields = self._header.setdefault("facet_fields", list(FACET_FIELDS))
+        vocabulary = self._header.setdefault("facets", {field: [] for field in fields})
+        lookup = {field: {value: code for code, value in enumerate(vocabulary[field])} for field in fields}
+        codes = np.full((len(metadatas), len(fields)), -1, dtype=np.int32)
+        for row, metadata in enumerate(metadatas):
+            for column, field in enumerate(fields):
+                value = metadata.get(field)
+                if value is None or value == "":
+                    continue
+                value = str(value)
+                if value not in lookup[field]:
+                    lookup[field][value] = len(vocabulary[field])
+                    vocabulary[field].append(value)
+                codes[row, column] = lookup[field][value]
+        return codes
+
+    def vocabulary(self) -> dict:
+        """Returns the values of each facet field."""
+        self._refresh()
+        return self._header.get("facets", {})
+
+    def facets(self) -> dict:
+        """Returns the number of rows per value of each facet field."""
+        self._refresh()
+        if self._facet_codes is None:
+            return {}
+        result = {}
+        for column, field in enumerate(self._header["facet_fields"]):
+            codes = np.asarray(self._facet_codes[:, column])
+            counts = np.bincount(codes[codes >= 0], minlength=len(self._header["facets"][field]))
+            result[field] = {value: int(count) for value, count in zip(self._header["facets"][field], counts) if count}
+        return result
+
+    def filter_rows(self, clauses:List[dict]) -> Optional[np.ndarray]:
+        """
+        Returns the rows matching expanded filter clauses (see
+        metafilter.expand_filter), or None for all rows.
+        """
+        self._refresh()
+        if not clauses:
+            return None
+        if self._facet_codes is None:
+            if self._header["count"]:
+                raise ValueError("index %s was built without facets, rebuild it to filter" % self._path)
+            return np.empty(0, dtype=np.int64)
+
+        fields = self._header["facet_fields"]
+        mask = np.ones(self._header["count"], dtype=bool)
+        for clause in clauses:
+            clause_mask = np.zeros_like(mask)
+            for field, values in clause.items():
+                if field not in fields or not values:
+                    continue
+                lookup = {value: code for code, value in enumerate(self._header["facets"][field])}
+                codes = [lookup[value] for value in values if value in lookup]
+                if codes:
+                    clause_mask |= np.isin(self._facet_codes[:, fields.index(field)], codes)
+            mask &= clause_mask
+        return np.flatnonzero(mask)
+
+    def _get_document(self, row:int) -> Tuple[str, Document]:
+        start = int(self._offsets[row])
+        if row + 1 < self._header["count"]:
+            end = int(self._offsets[row + 1])
+        else:
+            end = self._header["docs_bytes"]
+
+        record = json.loads(self._docs[start:end].decode("utf-8"))
+        return record["id"], Document(page_content=record["text"], metadata=record["metadata"])
+
+    def _embed_queries(self, queries:List[str]) -> np.ndarray:
+        if len(queries) == 1:
+            vectors = [self._embedding_function.embed_query(queries[0])]
+        else:
+            vectors = self._embedding_function.embed_documents(queries)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def scores(self, query_embeddings:np.ndarray, reference:bool=False, rows:Optional[np.ndarray]=None) -> np.ndarray:
+        """
+        Returns the cosine similarity of each query against every row.
+
+        Params:
+          query_embeddings  a (queries, dim) matrix
+          reference  score against the float32 copy instead of the quantized one
+          rows  only score these rows, the columns of the result follow them
+        """
+        self._refresh()
+        count = self._header["count"] if rows is None else len(rows)
+        queries = _normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        out = np.empty((queries.shape[0], count), dtype=np.float32)
+        if count == 0:
+            return out
+
+        if reference:
+            if not self._header["keep_float32"]:
+                raise ValueError("index was built without a float32 reference copy")
+            matrix = np.memmap(self._file(_REFERENCE_FILE), dtype=np.float32, mode="r", shape=(self._header["count"], self._header["dim"]))
+        else:
+            matrix = self._vectors
+
+        for start in range(0, count, _SEARCH_BLOCK_ROWS):
+            end = min(start + _SEARCH_BLOCK_ROWS, count)
+            block_rows = slice(start, end) if rows is None else rows[start:end]
+            block = np.asarray(matrix[block_rows], dtype=np.float32)
+            block_scores = block @ queries.T
+            if not reference and self._scales is not None:
+                block_scores *= self._scales[block_rows, None]
+            out[:, start:end] = block_scores.T
+        return out
+
+    def query(self, query_embeddings:np.ndarray, k:int=4, rows:Optional[np.ndarray]=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Runs an exact search for a batch of query embeddings, over the given
+        rows only if any, e.g., the rows of filter_rows().
+
+        Returns:
+          (rows, scores) both shaped (queries, k), best match first
+        """
+        deleted = self.deleted_rows()
+        if len(deleted):
+            rows = np.setdiff1d(np.arange(self._header["count"]) if rows is None else rows, deleted)
+        scores = self.scores(query_embeddings, rows=rows)
+        top = _top_k(scores, k)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        if rows is not None:
+            top = rows[top]
+        return top, top_scores
+
+    def get_embeddings(self, rows:np.ndarray) -> np.ndarray:
+        """Returns the stored (dequantized) embeddings of the given rows."""
+        self._refresh()
+        rows = np.asarray(rows, dtype=np.int64)
+        embeddings = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            embeddings *= np.asarray(self._scales[rows])[:, None]
+        return embeddings
+
+    def similarity_search_by_vector_with_embeddings(self, embedding:List[float], k:int=4, rows:Optional[np.ndarray]=None) -> Tuple[List[Document], np.ndarray, np.ndarray]:
+        """Returns the top-k documents with their scores and stored embeddings."""
+        rows, scores = self.query(np.asarray([embedding], dtype=np.float32), k, rows=rows)
+        docs = [self._get_document(int(row))[1] for row in rows[0]]
+        return docs, scores[0], self.get_embeddings(rows[0])
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding:List[float], k:int=4, rows:Optional[np.ndarray]=None, **kwargs:Any) -> List[Tuple[Document, float]]:
+        rows, scores = self.query(np.asarray([embedding], dtype=np.float32), k, rows=rows)
+        return [(self._get_document(int(row))[1], float(score)) for row, score in zip(rows[0], scores[0])]
+
+    def similarity_search_by_vector(self, embedding:List[float], k:int=4, **kwargs:Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k)]
+
+    def similarity_search_with_score(self, query:str, k:int=4, **kwargs:Any) -> List[Tuple[Document, float]]:
+        embedding = self._embed_queries([query])[0]
+        return self.similarity_search_by_vector_with_relevance_scores(embedding, k)
+
+    def similarity_search(self, query:str, k:int=4, **kwargs:Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # scores are already cosine similarities
+        return lambda score: score
+
+    def recall(self, query_embeddings:np.ndarray, k:int=4) -> float:
+        """
+        Returns recall@k of the quantized matrix against exact float32 search.
+
+        Params:
+          query_embeddings  a (queries, dim) matrix
+          k  the number of results compared per query
+        """
+        exact = _top_k(self.scores(query_embeddings, reference=True), k)
+        approx = _top_k(self.scores(query_embeddings), k)
+
+        hits = 0
+        total = 0
+        for exact_row, approx_row in zip(exact, approx):
+            hits += len(set(exact_row.tolist()) & set(approx_row.tolist()))
+            total += len(exact_row)
+        if total == 0:
+            return 1.0
+        return hits / total
+
+    @classmethod
+    def from_texts(cls, texts:List[str], embedding:Embeddings, metadatas:Optional[List[dict]]=None, ids:Optional[List[str]]=None, persist_directory:Optional[str]=None, collection_name:Optional[str]=None, dtype:str="float16", **kwargs:Any) -> "FlatIndex":
+        index = cls(embedding_function=embedding, persist_directory=persist_directory, collection_name=collection_name, dtype=dtype)
+        index.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+        return index
+
+
+############################
+# Report recall against float32
+############################
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='flatindex',
+        description='Report recall of a quantized flat index against float32 search')
+
+    parser.add_argument('--queries', help='file with one query per line (default: sample stored vectors)')
+    parser.add_argument('--sample', type=int, default=200, help='number of stored vectors to sample as queries')
+    parser.add_argument('--k', type=int, default=4, help='number of results compared per query')
+    parser.add_argument('db_path', help='vectordb path')
+    parser.add_argument('collection', nargs='?', default='langchain', help='collection name')
+    args = parser.parse_args()
+
+    embedding = None
+    if args.queries:
+        from langchain_community.embeddings import GPT4AllEmbeddings
+        embedding = GPT4AllEmbeddings()
+
+    index = FlatIndex(embedding_function=embedding, persist_directory=args.db_path, collection_name=args.collection)
+    if index.count == 0:
+        print("index %s is empty" % args.db_path)
+        return
+    if not index._header["keep_float32"]:
+        print("index %s has no float32 copy, build it with --flat_keep_float32" % args.db_path)
+        return
+
+    if args.queries:
+        with open(args.queries, "r") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        query_embeddings = index._embed_queries(questions)
+    else:
+        dim = index._header["dim"]
+        reference = np.memmap(index._file(_REFERENCE_FILE), dtype=np.float32, mode="r", shape=(index.count, dim))
+        rows = np.random.default_rng(0).choice(index.count, size=min(args.sample, index.count), replace=False)
+        query_embeddings = np.asarray(reference[np.sort(rows)])
+
+    report = {
+        "dtype": index.dtype,
+        "count": index.count,
+        "queries": len(query_embeddings),
+        "k": args.k,
+        "recall": index.recall(query_embeddings, k=args.k),
+    }
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
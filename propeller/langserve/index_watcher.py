@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the logic to hot-swap published vector database versions in a running server."""
+
+import os
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from artifact import current_version, fetch_artifact, reference_fetched, remove_fetched, rollback
+from hnsw import search_k
+from vectordb_reader import SearchModeRetriever
+
+
+class _LoadedIndex:
+    def __init__(self, version:str, vectorstore:Any):
+        self.version = version
+        self.vectorstore = vectorstore
+        self.retriever = vectorstore.as_retriever()
+
+
+class IndexWatcher:
+    """
+    This class watches the CURRENT pointer of a published artifact (see
+    artifact.publish_artifact). When it changes, the new version is verified,
+    unpacked, loaded and warmed in a background thread, then swapped in with
+    a single reference assignment, so requests see either the old or the new
+    index and never wait for a load. The previously active version is kept
+    loaded so a rollback is an instant swap back.
+
+    Several processes, e.g., the forked workers of a server, can watch with
+    the same cache_root: a version is unpacked once, and a version is only
+    removed from the cache when no running watcher uses it.
+
+    Params:
+      publish_root  the folder holding published artifacts
+      name  the artifact name
+      cache_root  the folder where versions are unpacked
+      make_vectorstore  builds a reader (with as_retriever()) for an unpacked path
+      warm_queries  questions run against a new version before it is swapped in
+    """
+
+    def __init__(self, publish_root:str, name:str, cache_root:str, make_vectorstore:Callable[[str], Any], interval:float=30.0, warm_queries:Optional[List[str]]=None):
+        self._publish_root = publish_root
+        self._name = name
+        self._cache_root = cache_root
+        self._make_vectorstore = make_vectorstore
+        self._interval = interval
+        if warm_queries:
+            self._warm_queries = warm_queries
+        else:
+            self._warm_queries = ["When does the class meet?"]
+
+        self._lock = threading.Lock()
+        self._active = None
+        self._previous = None
+        self._failed = set()
+        self._thread = None
+        self._stop = threading.Event()
+        # the process whose versions are recorded, set by watch()
+        self._owner = None
+
+    @property
+    def version(self) -> Optional[str]:
+        active = self._active
+        return active.version if active else None
+
+    @property
+    def previous_version(self) -> Optional[str]:
+        previous = self._previous
+        return previous.version if previous else None
+
+    def current_retriever(self) -> BaseRetriever:
+        active = self._active
+        if not active:
+            raise RuntimeError("no index version of %s is loaded" % self._name)
+        return active.retriever
+
+    def facets(self) -> dict:
+        """Returns the facets of the active version, see VectorDBReader.facets."""
+        active = self._active
+        if not active:
+            raise RuntimeError("no index version of %s is loaded" % self._name)
+        return active.vectorstore.facets()
+
+    def as_retriever(self, k:Optional[int]=None, search_type:str="similarity", **kwargs:Any) -> "HotSwapRetriever":
+        """Return a retriever that always uses the active version, see VectorDBReader.as_retriever."""
+        return HotSwapRetriever(watcher=self, k=search_k(k), search_type=search_type, **kwargs)
+
+    def _kept_versions(self) -> List[str]:
+        return [index.version for index in (self._active, self._previous) if index]
+
+    def _reference(self, versions:List[str]) -> None:
+        # a watcher forked with its parent's versions records them under its
+        # own pid once it watches; the parent does not serve
+        if self._owner == os.getpid():
+            reference_fetched(self._cache_root, self._name, versions)
+
+    def _load(self, version:str) -> _LoadedIndex:
+        # recorded first, so another watcher does not remove it while it loads
+        self._reference(self._kept_versions() + [version])
+        path = fetch_artifact(self._publish_root, self._name, version, self._cache_root)
+        loaded = _LoadedIndex(version, self._make_vectorstore(path))
+
+        warm_start = time.perf_counter()
+        for query in self._warm_queries:
+            loaded.retriever.invoke(query)
+        print("> loaded %s version %s, warmed in %.2fs" % (self._name, version, time.perf_counter() - warm_start))
+        return loaded
+
+    def _swap(self, loaded:_LoadedIndex) -> None:
+        with self._lock:
+            retired = self._previous
+            self._previous = self._active
+            self._active = loaded
+
+        print("> serving %s version %s" % (self._name, loaded.version))
+        keep = self._kept_versions()
+        if retired and retired.version not in keep:
+            if hasattr(retired.vectorstore, "close"):
+                retired.vectorstore.close()
+        self._reference(keep)
+        remove_fetched(self._cache_root, self._name, keep)
+
+    def check(self) -> None:
+        """Loads and swaps in the published version if it changed."""
+        version = current_version(self._publish_root, self._name)
+        if not version or version == self.version or version in self._failed:
+            return
+
+        if version == self.previous_version:
+            # rolled back to the version that is still loaded
+            self._swap_back()
+            return
+
+        try:
+            loaded = self._load(version)
+        except Exception as e:
+            print("> failed to load %s version %s - %s" % (self._name, version, e))
+            self._failed.add(version)
+            self._reference(self._kept_versions())
+            return
+
+        self._swap(loaded)
+
+    def rollback(self) -> Optional[str]:
+        """
+        Points the artifact's CURRENT file at the previously active version,
+        or at the version published before the current one when this watcher
+        has none, and follows it. Every other watcher of the artifact, e.g.,
+        in the other workers, follows CURRENT on its next check.
+        """
+        try:
+            version = rollback(self._publish_root, self._name, self.previous_version)
+        except ValueError as e:
+            print("> cannot roll back %s - %s" % (self._name, e))
+            return None
+
+        self._failed.discard(version)
+        self.check()
+        return self.version
+
+    def _swap_back(self) -> Optional[str]:
+        with self._lock:
+            if not self._previous:
+                return None
+            self._active, self._previous = self._previous, self._active
+
+        print("> rolled back %s to version %s" % (self._name, self._active.version))
+        return self._active.version
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            try:
+                self.check()
+            except Exception as e:
+                print("> index watcher error - %s" % e)
+
+    def start(self) -> None:
+        """Loads the published version, then keeps watching in a background thread."""
+        self.check()
+        self.watch()
+
+    def watch(self) -> None:
+        """
+        Keeps watching in a background thread, without loading first. Call
+        it in the process that serves, e.g., after the workers are forked.
+        """
+        self._owner = os.getpid()
+        self._reference(self._kept_versions())
+        self._thread = threading.Thread(target=self._run, name="index-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class HotSwapRetriever(SearchModeRetriever):
+    """
+    Retriever that delegates each query to the active version of an
+    IndexWatcher, with this retriever's search options.
+    """
+
+    watcher: IndexWatcher
+
+    def _get_relevant_documents(self, query:str, *, run_manager:CallbackManagerForRetrieverRun) -> List[Document]:
+        # resolve the version once so a swap mid-request cannot mix indexes
+        retriever = self.watcher.current_retriever().copy(update=self.search_options())
+        return retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
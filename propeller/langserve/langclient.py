@@ -1,17 +1,13 @@
-from langchain_core.output_parsers import StrOutputParser
-from langchain.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-)
 from langchain.callbacks.manager import CallbackManager
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain_community.llms import Ollama
+from langchain_community.embeddings import GPT4AllEmbeddings
 
 from langchain.memory import ConversationBufferMemory
 from langserve import add_routes
 import sys
 import os
+import time
 
 from langserve import CustomUserType
 
@@ -19,11 +15,20 @@ from importlib import metadata
 from typing import Annotated
 
 from fastapi import Depends, FastAPI, Request, Response
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.runnables.config import run_in_executor
 from sse_starlette import EventSourceResponse
 
 from langserve import APIHandler
-from vectordb_reader import VectorDBReader
+from vectordb_reader import VectorDBReader, MultiCollectionReader, configurable_search
+from index_watcher import IndexWatcher
+from answer_chain import make_answer_chain
+from answer_table import AnswerTable
+from compression import ContextCompressor, PrefillObserver
+from embed_batcher import EmbeddingBatcher
+from llm_scheduler import PRIORITY_HEADER, TENANT_HEADER, TOKEN_HEADER, parse_settings
+from prompts import format_context
+from semantic_cache import SemanticCache, directory_version
+import prefork
 
 from langchain.globals import set_debug
 
@@ -35,57 +40,156 @@ VECTORSTORE = sys.argv[3]
 COLLECTION = sys.argv[4]
 OLLAMA_HOST = sys.argv[5]
 MODEL = sys.argv[6]
+VECTORSTORE_BACKEND = os.environ.get("VECTORSTORE_BACKEND", "chroma")
+COLLECTION_TIMEOUT = float(os.environ.get("COLLECTION_TIMEOUT", "5"))
+INDEX_ROOT = os.environ.get("INDEX_ROOT", "")
+INDEX_NAME = os.environ.get("INDEX_NAME", COLLECTION)
+INDEX_POLL_INTERVAL = float(os.environ.get("INDEX_POLL_INTERVAL", "30"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WARM_QUERY = os.environ.get("WARM_QUERY", "When does the class meet?")
+SEARCH_TYPE = os.environ.get("SEARCH_TYPE", "similarity")
+SCORE_THRESHOLD = float(os.environ["SCORE_THRESHOLD"]) if os.environ.get("SCORE_THRESHOLD") else None
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+ANSWER_TABLE = os.environ.get("ANSWER_TABLE", "")
+LLM_TENANT = os.environ.get("LLM_TENANT", COLLECTION)
+LLM_PRIORITY = os.environ.get("LLM_PRIORITY", "")
+LLM_SCHEDULER_TOKEN = os.environ.get("LLM_SCHEDULER_TOKEN", "")
+USER_HEADER = os.environ.get("USER_HEADER", "")
+PRIORITY_USERS = parse_settings(os.environ.get("PRIORITY_USERS", ""), str)
+TRUSTED_PRIORITY_HEADER = os.environ.get("TRUSTED_PRIORITY_HEADER", "")
+COMPRESS_TOKENS = int(os.environ.get("COMPRESS_TOKENS", "0"))
+COMPRESS_MIN_SIMILARITY = float(os.environ["COMPRESS_MIN_SIMILARITY"]) if os.environ.get("COMPRESS_MIN_SIMILARITY") else None
+PREFILL_TOKENS_PER_SECOND = float(os.environ.get("PREFILL_TOKENS_PER_SECOND", "100"))
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("EMBED_BATCH_WINDOW_MS", "0"))
+EMBED_BATCH_MAX = int(os.environ.get("EMBED_BATCH_MAX", "32"))
+EMBED_BATCH_TIMEOUT = float(os.environ.get("EMBED_BATCH_TIMEOUT", "60"))
+
+# run metadata holding the priority lane of a request
+PRIORITY_METADATA = "priority"
 
 print("vectorstore: %s, ollama_host: %s" % (VECTORSTORE, OLLAMA_HOST))
 
 
 def format_documents(docs):
-    out_docs = "\n".join(doc.page_content for doc in docs)
+    out_docs = format_context(docs)
     print(out_docs)
     return out_docs
 
-"""You are a teaching assistant. Answer the student's question using information only and only from the context passage that is between triple quotes. When you answer the question, quote the text that you used to base your answer off. If you can't answer it, then say “I can't answer this question”.Context:
-```"""
 
-# Prompt
-# prompt = ChatPromptTemplate.from_messages([
-#     SystemMessagePromptTemplate.from_template(
-#         "Using the following documents, help answer questions as a teacher would help a student. Remember to only answer the question they asked: {context}"
-#     ),
-#     HumanMessagePromptTemplate.from_template("{question}"),
-# ])
+class Question(CustomUserType):
+    question: str
+    context: list
 
-prompt = ChatPromptTemplate.from_messages([
-    SystemMessagePromptTemplate.from_template(
-        """"You are a teaching assistant. Answer the student's question using information only and only from the context passage that is between triple quotes. When you answer the question, quote the text that you used to base your answer off. If you can't answer it, then say “I can't answer this question”.
 
-        Context:
-        ```{context}```"""
-    ),
-    HumanMessagePromptTemplate.from_template("Question: {question}"),
-])
+class ScheduledOllama(Ollama):
+    """
+    Ollama that sends the tenant and the priority lane of its generations to
+    an llm_scheduler.py gateway. The lane of a generation is the "priority"
+    metadata of its run, see request_priority(), else priority.
+    """
 
+    priority: str = ""
 
-class Question(CustomUserType):
-    question: str
-    context: list
+    def _scheduled(self, run_manager) -> "ScheduledOllama":
+        lane = (run_manager.metadata.get(PRIORITY_METADATA) if run_manager else None) or self.priority
+        headers = {name: value for name, value in (self.headers or {}).items() if name != PRIORITY_HEADER}
+        if lane:
+            headers[PRIORITY_HEADER] = lane
+        return self.copy(update={"headers": headers})
+
+    def _generate(self, prompts, stop=None, images=None, run_manager=None, **kwargs):
+        return super(ScheduledOllama, self._scheduled(run_manager))._generate(prompts, stop=stop, images=images, run_manager=run_manager, **kwargs)
+
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        yield from super(ScheduledOllama, self._scheduled(run_manager))._stream(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    # the async client of Ollama sends no headers and cannot stream, so the
+    # async generations run the sync client in a thread
+    async def _agenerate(self, prompts, stop=None, images=None, run_manager=None, **kwargs):
+        return await run_in_executor(None, self._generate, prompts, stop, images, run_manager.get_sync() if run_manager else None, **kwargs)
+
+    async def _astream(self, prompt, stop=None, run_manager=None, **kwargs):
+        chunks = self._stream(prompt, stop=stop, run_manager=run_manager.get_sync() if run_manager else None, **kwargs)
+        try:
+            while True:
+                chunk = await run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            chunks.close()
+
+
+def request_priority(config, request):
+    # the lane of a request only comes from what its client cannot choose:
+    # the PRIORITY_USERS lane of the user an authenticating proxy names in
+    # USER_HEADER, else the TRUSTED_PRIORITY_HEADER that proxy sets, else
+    # LLM_PRIORITY; whatever the client sent is overwritten
+    lane = None
+    if USER_HEADER and request.headers.get(USER_HEADER):
+        lane = PRIORITY_USERS.get(request.headers[USER_HEADER])
+    if not lane and TRUSTED_PRIORITY_HEADER:
+        lane = request.headers.get(TRUSTED_PRIORITY_HEADER)
+    config["metadata"] = {**(config.get("metadata") or {}), PRIORITY_METADATA: lane or LLM_PRIORITY}
+    return config
 
+embedding = GPT4AllEmbeddings()
+if EMBED_BATCH_WINDOW_MS > 0:
+    # questions of concurrent requests are embedded together
+    embedding = EmbeddingBatcher(embedding, window_ms=EMBED_BATCH_WINDOW_MS, max_batch=EMBED_BATCH_MAX, timeout=EMBED_BATCH_TIMEOUT)
 
-llm = Ollama(
+# keeps the sentences of the retrieved documents closest to the question, see README.md
+compressor = ContextCompressor(embedding, max_tokens=COMPRESS_TOKENS, min_similarity=COMPRESS_MIN_SIMILARITY, prefill_tokens_per_second=PREFILL_TOKENS_PER_SECOND) if COMPRESS_TOKENS > 0 else None
+
+llm_callbacks = [StreamingStdOutCallbackHandler()]
+if compressor:
+    llm_callbacks.append(PrefillObserver(compressor))
+
+# tenant and lane of the generations when OLLAMA_HOST is an llm_scheduler.py
+# gateway, the lane is set per request by request_priority()
+llm_headers = {TENANT_HEADER: LLM_TENANT}
+if LLM_SCHEDULER_TOKEN:
+    llm_headers[TOKEN_HEADER] = LLM_SCHEDULER_TOKEN
+llm = ScheduledOllama(
     base_url="http://%s:11434" % OLLAMA_HOST,
     model=MODEL,
-    callback_manager=CallbackManager([StreamingStdOutCallbackHandler()])
+    headers=llm_headers,
+    priority=LLM_PRIORITY,
+    callback_manager=CallbackManager(llm_callbacks)
 )
 
-vectorstore = VectorDBReader(db_path=VECTORSTORE, collection_name=COLLECTION)
-retriever = vectorstore.as_retriever()
+def make_vectorstore(db_path):
+    if "," in COLLECTION:
+        # search several course collections, e.g., a whole degree program
+        collections = [collection.strip() for collection in COLLECTION.split(",") if collection.strip()]
+        return MultiCollectionReader(db_path=db_path, collection_names=collections, backend=VECTORSTORE_BACKEND, timeout=COLLECTION_TIMEOUT, embedding=embedding)
+    return VectorDBReader(db_path=db_path, collection_name=COLLECTION, backend=VECTORSTORE_BACKEND, embedding=embedding)
 
-chain = (
-    {"context": retriever | format_documents, "question": RunnablePassthrough()}
-    | prompt
-    | llm
-    | StrOutputParser()
-)
+if INDEX_ROOT:
+    # serve published versions from INDEX_ROOT, unpacked under VECTORSTORE
+    vectorstore = IndexWatcher(publish_root=INDEX_ROOT, name=INDEX_NAME, cache_root=VECTORSTORE, make_vectorstore=make_vectorstore, interval=INDEX_POLL_INTERVAL, warm_queries=[WARM_QUERY] if WARM_QUERY else None)
+    # load before the workers are forked, each worker then watches on its own
+    vectorstore.check()
+else:
+    vectorstore = make_vectorstore(VECTORSTORE)
+# the search type and options can be overridden per request through the
+# "configurable" config, see README.md
+retriever = configurable_search(vectorstore.as_retriever(search_type=SEARCH_TYPE, score_threshold=SCORE_THRESHOLD))
+
+def served_index_version(collection):
+    # answers cached for an older index are dropped
+    if INDEX_ROOT:
+        return vectorstore.version
+    return directory_version(VECTORSTORE)
+
+answer_cache = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_SIZE, version=served_index_version) if SEMANTIC_CACHE_SIZE > 0 else None
+# answers precomputed by precompute_answers.py, only used while their index version and model are served
+answer_table = AnswerTable(ANSWER_TABLE, threshold=SEMANTIC_CACHE_THRESHOLD, index_version=lambda: served_index_version(COLLECTION), model=MODEL) if ANSWER_TABLE else None
+
+# the retriever and the llm stay steps of the chain, so the "configurable"
+# config of a request reaches them, see answer_chain.py
+chain = make_answer_chain(retriever, llm, embedding=embedding, answer_cache=answer_cache, answer_table=answer_table, collection=COLLECTION, compressor=compressor, format_documents=format_documents)
 
 app = FastAPI(
     title="LangChain Server",
@@ -93,12 +197,53 @@ app = FastAPI(
     description="Spin up a simple api server using Langchain's Runnable interfaces",
 )
 
-add_routes(app, chain, path="/langserve")
+add_routes(app, chain, path="/langserve", per_req_config_modifier=request_priority)
 
-if __name__ == "__main__":
-    import uvicorn
+@app.get("/facets")
+def facets():
+    # the values a request can filter on, see README.md
+    return vectorstore.facets()
 
-    uvicorn.run(app, host=HOST, port=PORT)
+if isinstance(embedding, EmbeddingBatcher):
+    @app.get("/embeddings")
+    def embedding_stats():
+        return embedding.stats()
+
+if compressor:
+    @app.get("/compression")
+    def compression_stats():
+        return compressor.stats()
+
+if answer_cache:
+    @app.get("/cache")
+    def cache_stats():
+        return answer_cache.stats()
+
+if answer_table:
+    @app.get("/answers")
+    def answer_table_info():
+        return answer_table.info()
+
+if INDEX_ROOT:
+    @app.get("/index")
+    def index_version():
+        return {"name": INDEX_NAME, "version": vectorstore.version, "previous": vectorstore.previous_version}
+
+    @app.post("/index/rollback")
+    def index_rollback():
+        return {"name": INDEX_NAME, "version": vectorstore.rollback()}
+
+if __name__ == "__main__":
+    if WARM_QUERY and not INDEX_ROOT:
+        # Chroma loads the HNSW index of a collection on its first query, so
+        # query it here: the workers then share the loaded index instead of
+        # each loading its own copy (IndexWatcher warms the versions it loads)
+        warm_start = time.perf_counter()
+        retriever.invoke(WARM_QUERY)
+        print("> warmed in %.2fs" % (time.perf_counter() - warm_start))
+    # the embedding model and the index are loaded above, so the WORKERS
+    # processes forked here share them
+    prefork.serve(app, host=HOST, port=PORT, workers=WORKERS, after_fork=vectorstore.watch if INDEX_ROOT else None)
 
 
 ##########
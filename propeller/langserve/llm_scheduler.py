@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""This module holds the fair scheduler of LLM generations shared by several courses, and the Ollama gateway that applies it."""
+
+import argparse
+import asyncio
+import collections
+import hmac
+import os
+import time
+from typing import Deque, Dict, List, Optional
+
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+# request headers naming the tenant and priority lane of a generation
+TENANT_HEADER = "X-Tenant"
+PRIORITY_HEADER = "X-Priority"
+# request header of the shared token of the servers allowed to use the gateway
+TOKEN_HEADER = "X-Scheduler-Token"
+DEFAULT_TENANT = "default"
+DEFAULT_LANES = ["instructor", "student"]
+# Ollama endpoints that run a generation, others are passed through
+_GENERATION_PATHS = ("api/generate", "api/chat")
+# wait times kept per tenant for the metrics
+_WAIT_SAMPLES = 1000
+
+
+class _Waiter:
+    def __init__(self, tag:float):
+        self.tag = tag
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+
+class _Tenant:
+    def __init__(self, weight:float, cap:Optional[int], lanes:List[str]):
+        self.weight = weight
+        self.cap = cap
+        self.queues: Dict[str, Deque[_Waiter]] = {lane: collections.deque() for lane in lanes}
+        self.last_tag = 0.0
+        self.running = 0
+        self.served = 0
+        self.waits: Deque[float] = collections.deque(maxlen=_WAIT_SAMPLES)
+
+
+class FairScheduler:
+    """
+    This class decides which waiting generation runs next when at most
+    max_concurrency can run at once, e.g., the parallel requests of one
+    Ollama backend.
+
+    Generations of a higher priority lane (earlier in lanes) always go
+    first. Within a lane, tenants, e.g., courses, share the backend by
+    weighted fair queuing: each request gets a virtual finish tag advanced by
+    1/weight from its tenant's previous one, and the smallest tag runs next,
+    so a tenant with weight 2 gets twice the generations of a tenant with
+    weight 1 while both wait, and a surge of one tenant does not delay the
+    others beyond their share. A tenant never runs more than its cap at once.
+
+    Params:
+      max_concurrency  generations running at once
+      weights  weight per tenant, default_weight for others
+      caps  maximum running generations per tenant, default_cap for others (None: no cap)
+      lanes  priority lanes, highest first; generations without a lane get the lowest
+    """
+
+    def __init__(self, max_concurrency:int=1, weights:Optional[Dict[str, float]]=None, caps:Optional[Dict[str, int]]=None, default_weight:float=1.0, default_cap:Optional[int]=None, lanes:Optional[List[str]]=None):
+        self._max_concurrency = max_concurrency
+        self._weights = weights or {}
+        self._caps = caps or {}
+        self._default_weight = default_weight
+        self._default_cap = default_cap
+        self._lanes = lanes or DEFAULT_LANES
+        self._tenants: Dict[str, _Tenant] = {}
+        self._virtual_time = 0.0
+        self._running = 0
+
+    def _tenant(self, name:str) -> _Tenant:
+        if name not in self._tenants:
+            self._tenants[name] = _Tenant(self._weights.get(name, self._default_weight), self._caps.get(name, self._default_cap), self._lanes)
+        return self._tenants[name]
+
+    def _lane(self, lane:Optional[str]) -> str:
+        if not lane:
+            return self._lanes[-1]
+        if lane not in self._lanes:
+            raise ValueError("unknown priority lane %s, expected one of %s" % (lane, ", ".join(self._lanes)))
+        return lane
+
+    def _dispatch(self) -> None:
+        while self._running < self._max_concurrency:
+            chosen = None
+            for lane in self._lanes:
+                for tenant in self._tenants.values():
+                    queue = tenant.queues[lane]
+                    if not queue or (tenant.cap is not None and tenant.running >= tenant.cap):
+                        continue
+                    if chosen is None or queue[0].tag < chosen[1][0].tag:
+                        chosen = (tenant, queue)
+                if chosen:
+                    break
+            if not chosen:
+                return
+
+            tenant, queue = chosen
+            waiter = queue.popleft()
+            tenant.running += 1
+            tenant.served += 1
+            tenant.waits.append(time.monotonic() - waiter.enqueued)
+            self._running += 1
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            waiter.future.set_result(None)
+
+    async def acquire(self, tenant_name:str, lane:Optional[str]=None) -> None:
+        """Waits until a generation of the tenant may run; release() it when done."""
+        lane = self._lane(lane)
+        tenant = self._tenant(tenant_name)
+        # an idle tenant does not bank credit: tags start at the current virtual time
+        tag = max(self._virtual_time, tenant.last_tag) + 1.0 / tenant.weight
+        tenant.last_tag = tag
+        waiter = _Waiter(tag)
+        queue = tenant.queues[lane]
+        queue.append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # granted just before the cancel
+                self.release(tenant_name)
+            elif waiter in queue:
+                queue.remove(waiter)
+            raise
+
+    def release(self, tenant_name:str) -> None:
+        tenant = self._tenants[tenant_name]
+        tenant.running -= 1
+        self._running -= 1
+        self._dispatch()
+
+    def metrics(self) -> dict:
+        tenants = {}
+        for name, tenant in self._tenants.items():
+            waits = np.asarray(tenant.waits) if tenant.waits else np.zeros(1)
+            tenants[name] = {
+                "weight": tenant.weight,
+                "cap": tenant.cap,
+                "running": tenant.running,
+                "queued": {lane: len(queue) for lane, queue in tenant.queues.items()},
+                "served": tenant.served,
+                "wait_p50_seconds": float(np.percentile(waits, 50)),
+                "wait_p99_seconds": float(np.percentile(waits, 99)),
+                "wait_max_seconds": float(waits.max()),
+            }
+        return {"max_concurrency": self._max_concurrency, "running": self._running, "lanes": self._lanes, "tenants": tenants}
+
+
+def parse_settings(text:str, value_type:type) -> dict:
+    """Parses "NAME=value,NAME=value" settings, e.g., tenant weights."""
+    settings = {}
+    for item in text.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            settings[name.strip()] = value_type(value.strip())
+    return settings
+
+
+def make_gateway(upstream:str, scheduler:FairScheduler, token:str="") -> FastAPI:
+    """
+    Returns an app serving the Ollama API at upstream, with every generation
+    scheduled by the tenant and lane of its X-Tenant and X-Priority headers.
+    A generation of a lane the scheduler does not have is refused with 400.
+
+    The headers are trusted as sent: the gateway must only be reachable by
+    the servers, or given a token, which every request must then send in
+    X-Scheduler-Token (401 otherwise).
+    """
+    app = FastAPI(title="LLM Scheduler", description="Fair scheduling of Ollama generations per tenant")
+    client = httpx.AsyncClient(base_url=upstream, timeout=httpx.Timeout(None))
+
+    def authenticate(request:Request) -> None:
+        if token and not hmac.compare_digest(request.headers.get(TOKEN_HEADER, "").encode("utf-8"), token.encode("utf-8")):
+            raise HTTPException(status_code=401, detail="missing or wrong %s" % TOKEN_HEADER)
+
+    @app.get("/scheduler/metrics")
+    def scheduler_metrics(request:Request):
+        authenticate(request)
+        return scheduler.metrics()
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "DELETE", "HEAD"])
+    async def proxy(path:str, request:Request):
+        authenticate(request)
+        body = await request.body()
+        headers = {"Content-Type": request.headers.get("Content-Type", "application/json")}
+        upstream_request = client.build_request(request.method, "/" + path, params=request.query_params, content=body, headers=headers)
+        if path not in _GENERATION_PATHS:
+            response = await client.send(upstream_request)
+            return Response(content=response.content, status_code=response.status_code, media_type=response.headers.get("Content-Type"))
+
+        tenant = request.headers.get(TENANT_HEADER, DEFAULT_TENANT)
+        try:
+            await scheduler.acquire(tenant, request.headers.get(PRIORITY_HEADER))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        released = []
+        def release():
+            if not released:
+                released.append(True)
+                scheduler.release(tenant)
+
+        try:
+            response = await client.send(upstream_request, stream=True)
+        except Exception:
+            release()
+            raise
+
+        async def finish():
+            # stops the generation upstream and returns its connection to the pool
+            await response.aclose()
+            release()
+
+        async def stream():
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+            finally:
+                await finish()
+
+        # the background task also finishes when the client left before the body was sent
+        return StreamingResponse(stream(), status_code=response.status_code, media_type=response.headers.get("Content-Type"), background=BackgroundTask(finish))
+
+    return app
+
+
+############################
+# Serve the Ollama gateway
+############################
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='llm_scheduler',
+        description='Serve an Ollama backend with per-tenant fair scheduling and priority lanes')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=11434, help='port to listen on, Ollama\'s by default')
+    parser.add_argument('--upstream', default='http://ollama:11434', help='Ollama backend')
+    parser.add_argument('--concurrency', type=int, default=1, help='generations run at once, e.g., OLLAMA_NUM_PARALLEL')
+    parser.add_argument('--weights', default='', help='tenant weights, e.g., RNR355=2,CYVERSE=1')
+    parser.add_argument('--caps', default='', help='running generations per tenant, e.g., RNR355=1')
+    parser.add_argument('--default_cap', type=int, help='running generations of other tenants')
+    parser.add_argument('--lanes', default=','.join(DEFAULT_LANES), help='priority lanes, highest first')
+    parser.add_argument('--token', default=os.environ.get('LLM_SCHEDULER_TOKEN', ''), help='token requests must send in X-Scheduler-Token (default: LLM_SCHEDULER_TOKEN)')
+    args = parser.parse_args()
+
+    scheduler = FairScheduler(
+        max_concurrency=args.concurrency,
+        weights=parse_settings(args.weights, float),
+        caps=parse_settings(args.caps, int),
+        default_cap=args.default_cap,
+        lanes=[lane.strip() for lane in args.lanes.split(",") if lane.strip()],
+    )
+    uvicorn.run(make_gateway(args.upstream, scheduler, token=args.token), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""This module holds the batch job that precomputes answers to frequent questions after an index build."""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import numpy as np
+
+from langchain_community.embeddings import GPT4AllEmbeddings
+from langchain_community.llms import Ollama
+from langchain_core.output_parsers import StrOutputParser
+
+from answer_table import normalize_question, write_answer_table
+from artifact import current_version, fetch_artifact
+from compression import ContextCompressor
+from prompts import format_context, prompt
+from semantic_cache import directory_version, doc_id
+from vectordb_reader import MultiCollectionReader, VectorDBReader
+
+# answer of the prompt when the context does not hold one
+_NO_ANSWER = "can't answer this question"
+
+
+def load_questions(path:str, top:int=0) -> List[Tuple[str, int]]:
+    """
+    Reads questions, either one per line or, for logged questions, one JSON
+    object per line ({"question": ..., "count": ...}). Questions that only
+    differ in case and punctuation are merged. Returns (question, count)
+    pairs, most frequent first.
+    """
+    counts = {}
+    questions = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                question = record["question"]
+                count = int(record.get("count", 1))
+            else:
+                question = line
+                count = 1
+            key = normalize_question(question)
+            questions.setdefault(key, question)
+            counts[key] = counts.get(key, 0) + count
+
+    keys = sorted(counts, key=counts.get, reverse=True)
+    if top:
+        keys = keys[:top]
+    return [(questions[key], counts[key]) for key in keys]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='precompute_answers',
+        description='Precompute answers to frequent questions for langclient.py')
+    parser.add_argument('--questions', required=True, help='questions, one per line or {"question", "count"} json objects')
+    parser.add_argument('--output', required=True, help='answer table to write, served with ANSWER_TABLE')
+    parser.add_argument('--top', type=int, default=0, help='only answer the most frequent questions')
+    parser.add_argument('--workers', type=int, default=4, help='questions answered in parallel')
+    parser.add_argument('--ollama_host', default='localhost', help='ollama host')
+    parser.add_argument('--model', required=True, help='ollama model, the MODEL langclient.py serves')
+    parser.add_argument('--backend', choices=['chroma', 'flat'], default='chroma', help='vector store backend')
+    parser.add_argument('--k', type=int, help='documents retrieved per question (default SEARCH_K or 4)')
+    parser.add_argument('--search_type', default='similarity', help='search type, as SEARCH_TYPE of langclient.py')
+    parser.add_argument('--score_threshold', type=float, help='minimum relevance score, as SCORE_THRESHOLD of langclient.py')
+    parser.add_argument('--compress_tokens', type=int, default=0, help='compress the context to this many tokens, as COMPRESS_TOKENS of langclient.py')
+    parser.add_argument('--index_root', help='answer with the current published version of the index instead')
+    parser.add_argument('--index_name', help='artifact name in --index_root (default collection)')
+    parser.add_argument('--report', help='write the report to this json file')
+    parser.add_argument('db_path', help='vectordb path, or the unpack folder with --index_root')
+    parser.add_argument('collection', nargs='?', default='langchain', help='collection name, comma-separated for several')
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions, args.top)
+    print("> %d distinct questions" % len(questions))
+
+    db_path = args.db_path
+    # the table is only served with the index it was answered from
+    index_version = directory_version(db_path)
+    if args.index_root:
+        name = args.index_name or args.collection
+        index_version = current_version(args.index_root, name)
+        if not index_version:
+            raise ValueError("no published version of %s in %s" % (name, args.index_root))
+        db_path = fetch_artifact(args.index_root, name, index_version, args.db_path)
+
+    embedding = GPT4AllEmbeddings()
+    if "," in args.collection:
+        collections = [collection.strip() for collection in args.collection.split(",") if collection.strip()]
+        reader = MultiCollectionReader(db_path=db_path, collection_names=collections, backend=args.backend, embedding=embedding)
+    else:
+        reader = VectorDBReader(db_path=db_path, collection_name=args.collection, backend=args.backend, embedding=embedding)
+    retriever = reader.as_retriever(k=args.k, search_type=args.search_type, score_threshold=args.score_threshold)
+
+    llm = Ollama(base_url="http://%s:11434" % args.ollama_host, model=args.model)
+    generate = prompt | llm | StrOutputParser()
+    compressor = ContextCompressor(embedding, max_tokens=args.compress_tokens) if args.compress_tokens > 0 else None
+
+    def answer(question:str) -> dict:
+        start = time.perf_counter()
+        try:
+            docs = retriever.invoke(question)
+            context_docs = compressor.compress(question, docs)[0] if compressor else docs
+            text = generate.invoke({"context": format_context(context_docs), "question": question})
+        except Exception as e:
+            print("> failed to answer %r: %s" % (question, e))
+            return None
+        return {
+            "question": question,
+            "answer": text,
+            "doc_ids": [doc_id(doc) for doc in docs],
+            "context": [{"source": doc.metadata.get("source"), "page": doc.metadata.get("page"), "text": doc.page_content} for doc in docs],
+            "seconds": time.perf_counter() - start,
+        }
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(answer, [question for question, _ in questions]))
+    elapsed = time.perf_counter() - start
+
+    entries = []
+    total_count = sum(count for _, count in questions)
+    covered_count = 0
+    answered_count = 0
+    saved_seconds = 0.0
+    for (question, count), entry in zip(questions, results):
+        if not entry:
+            continue
+        entry["count"] = count
+        entries.append(entry)
+        covered_count += count
+        saved_seconds += entry["seconds"] * count
+        if _NO_ANSWER not in entry["answer"]:
+            answered_count += count
+
+    # embeddings let the server match paraphrases of the questions as well
+    for entry, vector in zip(entries, reader.embed_queries([entry["question"] for entry in entries])):
+        entry["embedding"] = [float(value) for value in vector]
+
+    write_answer_table(args.output, {
+        "collection": args.collection,
+        "index_version": index_version,
+        "model": args.model,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "answers": entries,
+    })
+
+    seconds = np.asarray([entry["seconds"] for entry in entries]) if entries else np.zeros(1)
+    report = {
+        "questions": len(questions),
+        "precomputed": len(entries),
+        "failed": len(questions) - len(entries),
+        # shares of the asked questions, weighted by count
+        "coverage": covered_count / total_count if total_count else 0.0,
+        "answered": answered_count / total_count if total_count else 0.0,
+        "answer_p50_seconds": float(np.percentile(seconds, 50)),
+        "answer_p99_seconds": float(np.percentile(seconds, 99)),
+        # generation time the served answers save if the questions are asked
+        # as often again
+        "saved_seconds": saved_seconds,
+        "elapsed_seconds": elapsed,
+    }
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
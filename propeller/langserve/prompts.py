@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the prompt of the answer chain, shared by the server and the answer precomputation job."""
+
+from typing import List
+
+from langchain.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    SystemMessagePromptTemplate,
+)
+from langchain_core.documents import Document
+
+# Prompt
+# prompt = ChatPromptTemplate.from_messages([
+#     SystemMessagePromptTemplate.from_template(
+#         "Using the following documents, help answer questions as a teacher would help a student. Remember to only answer the question they asked: {context}"
+#     ),
+#     HumanMessagePromptTemplate.from_template("{question}"),
+# ])
+
+prompt = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(
+        """"You are a teaching assistant. Answer the student's question using information only and only from the context passage that is between triple quotes. When you answer the question, quote the text that you used to base your answer off. If you can't answer it, then say “I can't answer this question”.
+
+        Context:
+        ```{context}```"""
+    ),
+    HumanMessagePromptTemplate.from_template("Question: {question}"),
+])
+
+
+def format_context(docs:List[Document]) -> str:
+    return "\n".join(doc.page_content for doc in docs)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the semantic answer cache that serves paraphrased questions without a new generation."""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from langchain_core.documents import Document
+
+
+def doc_id(doc:Document) -> str:
+    """Returns a stable id of a retrieved document, from its source, page and text."""
+    key = "%s\n%s\n%s" % (doc.metadata.get("source", ""), doc.metadata.get("page", ""), doc.page_content)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def directory_version(path:str) -> str:
+    """
+    Returns a token that changes whenever a file under path is written,
+    added or removed, e.g., when a vector database is re-indexed in place.
+    """
+    count = 0
+    latest = 0
+    size = 0
+    pending = [path]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            count += 1
+            latest = max(latest, stat.st_mtime_ns)
+            size += stat.st_size
+    return "%d-%d-%d" % (count, latest, size)
+
+
+class CachedAnswer:
+    def __init__(self, question:str, answer:str, doc_ids:List[str], similarity:float):
+        self.question = question
+        self.answer = answer
+        self.doc_ids = doc_ids
+        self.similarity = similarity
+
+
+class _CollectionCache:
+    def __init__(self, max_entries:int, dim:int, version:Any):
+        self.version = version
+        # unit-length question embeddings, one row per entry, so a lookup is
+        # a single matrix-vector product
+        self.embeddings = np.zeros((max_entries, dim), dtype=np.float32)
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.entries = [None] * max_entries
+        self.count = 0
+
+
+class SemanticCache:
+    """
+    This class caches generated answers per collection, keyed by the
+    question embedding. A question whose embedding has a cosine similarity
+    of at least threshold with a cached question gets the cached answer, so
+    paraphrases ("when is hw3 due" and "hw 3 deadline?") are answered without
+    retrieval or generation.
+
+    Each collection keeps at most max_entries answers; the least recently
+    used one is evicted first. When the version of a collection changes,
+    e.g., after it is re-indexed or a new index version is swapped in, its
+    answers are dropped.
+
+    Params:
+      threshold  minimum cosine similarity of a hit
+      max_entries  answers kept per collection
+      version  returns the current version of a collection, called at most every check_interval seconds
+      check_interval  seconds between version checks
+    """
+
+    def __init__(self, threshold:float=0.95, max_entries:int=1024, version:Optional[Callable[[str], Any]]=None, check_interval:float=5.0):
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._version = version
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._caches: Dict[str, _CollectionCache] = {}
+        self._versions: Dict[str, Any] = {}
+        self._checked: Dict[str, float] = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _current_version(self, collection:str) -> Any:
+        if not self._version:
+            return None
+        now = time.monotonic()
+        if collection not in self._checked or now - self._checked[collection] >= self._check_interval:
+            self._versions[collection] = self._version(collection)
+            self._checked[collection] = now
+        return self._versions[collection]
+
+    def _cache(self, collection:str, dim:int) -> _CollectionCache:
+        # call with the lock held
+        version = self._current_version(collection)
+        cache = self._caches.get(collection)
+        if cache is None or cache.version != version or cache.embeddings.shape[1] != dim:
+            if cache is not None:
+                print("> semantic cache of %s invalidated" % collection)
+            cache = _CollectionCache(self._max_entries, dim, version)
+            self._caches[collection] = cache
+        return cache
+
+    @staticmethod
+    def _normalize(embedding:List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, collection:str, embedding:List[float]) -> Optional[CachedAnswer]:
+        """Returns the cached answer of the most similar question above the threshold, if any."""
+        vector = self._normalize(embedding)
+        with self._lock:
+            cache = self._cache(collection, len(vector))
+            if cache.count:
+                similarities = cache.embeddings[:cache.count] @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self._threshold:
+                    self._clock += 1
+                    cache.last_used[best] = self._clock
+                    self.hits += 1
+                    question, answer, doc_ids = cache.entries[best]
+                    return CachedAnswer(question, answer, doc_ids, float(similarities[best]))
+            self.misses += 1
+            return None
+
+    def add(self, collection:str, embedding:List[float], question:str, answer:str, doc_ids:List[str]) -> None:
+        vector = self._normalize(embedding)
+        with self._lock:
+            cache = self._cache(collection, len(vector))
+            if cache.count < self._max_entries:
+                slot = cache.count
+                cache.count += 1
+            else:
+                slot = int(np.argmin(cache.last_used))
+            self._clock += 1
+            cache.embeddings[slot] = vector
+            cache.last_used[slot] = self._clock
+            cache.entries[slot] = (question, answer, doc_ids)
+
+    def clear(self, collection:Optional[str]=None) -> None:
+        with self._lock:
+            if collection:
+                self._caches.pop(collection, None)
+            else:
+                self._caches.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": {collection: cache.count for collection, cache in self._caches.items()},
+            }
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""Tests of the answer chain served through langserve, run with python3 -m pytest test_answer_chain.py."""
+
+import hashlib
+import json
+from typing import List, Optional, Tuple
+
+import numpy as np
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from langchain_community.llms.fake import FakeStreamingListLLM
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langserve import add_routes
+
+from answer_chain import make_answer_chain
+from semantic_cache import SemanticCache
+from vectordb_reader import SearchModeRetriever, configurable_search
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.queries = 0
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        return [np.random.default_rng(int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)).normal(size=16).tolist() for text in texts]
+
+    def embed_query(self, text:str) -> List[float]:
+        self.queries += 1
+        return self.embed_documents([text])[0]
+
+
+class FakeRetriever(SearchModeRetriever):
+    embedding: Embeddings
+    searches: list = []
+
+    def _embed_query(self, query:str) -> List[float]:
+        return self.embedding.embed_query(query)
+
+    def _search(self, query_embedding:List[float], k:int, include_embeddings:bool, filter:Optional[dict]) -> Tuple[List[Document], np.ndarray, Optional[np.ndarray]]:
+        self.searches.append({"k": k, "filter": filter})
+        docs = [Document(page_content="chunk %d" % i, metadata={"source": "syllabus.pdf"}) for i in range(k)]
+        return docs, np.linspace(1.0, 0.5, k, dtype=np.float32), None
+
+
+def make_client(answer_cache:Optional[SemanticCache]=None) -> Tuple[TestClient, CountingEmbeddings, FakeRetriever]:
+    embedding = CountingEmbeddings()
+    retriever = FakeRetriever(embedding=embedding, searches=[])
+    llm = FakeStreamingListLLM(responses=["answer %d" % i for i in range(10)])
+    chain = make_answer_chain(configurable_search(retriever), llm, embedding=embedding, answer_cache=answer_cache, collection="TEST")
+
+    app = FastAPI()
+    add_routes(app, chain, path="/langserve")
+    return TestClient(app), embedding, retriever
+
+
+def test_configurable_search_options_reach_the_retriever():
+    client, _, retriever = make_client(SemanticCache())
+    response = client.post("/langserve/invoke", json={"input": "When is the exam?", "config": {"configurable": {"k": 2, "filter": {"file_type": "pdf"}}}})
+
+    assert response.status_code == 200
+    assert retriever.searches == [{"k": 2, "filter": {"file_type": "pdf"}}]
+
+
+def test_config_schema_lists_search_options():
+    client, _, _ = make_client(SemanticCache())
+    properties = client.get("/langserve/config_schema").json()["definitions"]["Configurable"]["properties"]
+
+    assert {"search_type", "k", "filter"} <= set(properties)
+
+
+def test_cached_answer_embeds_question_once():
+    client, embedding, retriever = make_client(SemanticCache())
+    first = client.post("/langserve/invoke", json={"input": "When is the exam?"}).json()["output"]
+    assert embedding.queries == 1
+    assert len(retriever.searches) == 1
+
+    second = client.post("/langserve/invoke", json={"input": "When is the exam?"}).json()["output"]
+    assert second == first
+    assert embedding.queries == 2
+    assert len(retriever.searches) == 1
+
+
+def test_search_options_bypass_the_cache():
+    client, _, retriever = make_client(SemanticCache())
+    client.post("/langserve/invoke", json={"input": "When is the exam?"})
+    client.post("/langserve/invoke", json={"input": "When is the exam?", "config": {"configurable": {"k": 3}}})
+
+    assert [search["k"] for search in retriever.searches] == [4, 3]
+
+
+def test_streamed_answer_is_cached():
+    client, _, retriever = make_client(SemanticCache())
+    with client.stream("POST", "/langserve/stream", json={"input": "Where is the lab?"}) as response:
+        events = "".join(response.iter_text()).split("\r\n\r\n")
+    tokens = [json.loads(event.split("data: ", 1)[1]) for event in events if event.startswith("event: data")]
+    assert len(tokens) > 1
+    assert "".join(tokens) == "answer 0"
+
+    answer = client.post("/langserve/invoke", json={"input": "Where is the lab?"}).json()["output"]
+    assert answer == "answer 0"
+    assert len(retriever.searches) == 1
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""Measures memory and throughput of a server as its worker count grows."""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+from typing import Tuple
+
+import numpy as np
+
+
+def _children(pid:int) -> list:
+    children = []
+    for task in os.listdir("/proc/%d/task" % pid):
+        with open("/proc/%d/task/%s/children" % (pid, task), "r") as f:
+            children.extend(int(child) for child in f.read().split())
+    return children
+
+
+def _process_tree(pid:int) -> list:
+    pids = [pid]
+    for child in _children(pid):
+        pids.extend(_process_tree(child))
+    return pids
+
+
+def _memory_kb(pid:int) -> dict:
+    """Returns the RSS and PSS (shared pages split between their users) of a process in kB."""
+    memory = {"rss": 0, "pss": 0}
+    with open("/proc/%d/smaps_rollup" % pid, "r") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name.lower() in memory:
+                memory[name.lower()] = int(value.split()[0])
+    return memory
+
+
+def tree_memory_mb(pids:list) -> dict:
+    total = {"rss": 0, "pss": 0}
+    for root in pids:
+        for pid in _process_tree(root):
+            try:
+                memory = _memory_kb(pid)
+            except FileNotFoundError:
+                continue
+            total["rss"] += memory["rss"]
+            total["pss"] += memory["pss"]
+    return {"rss_mb": total["rss"] / 1024, "pss_mb": total["pss"] / 1024}
+
+
+def wait_for_port(port:int, timeout:float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.5)
+    raise TimeoutError("server on port %d did not start in %.0fs" % (port, timeout))
+
+
+def start_servers(command:str, port:int, workers:int, mode:str) -> Tuple[list, list]:
+    """
+    Starts the server under test. "prefork" runs one server with WORKERS
+    forked workers, "prefork_cold" the same without its warm-up query, so
+    each worker loads the index on its first request, and "separate" runs
+    one single-worker server per worker on consecutive ports, which loads
+    everything once per worker like uvicorn --workers does.
+    """
+    if mode in ("prefork", "prefork_cold"):
+        ports = [port]
+        counts = [workers]
+    else:
+        ports = [port + i for i in range(workers)]
+        counts = [1] * workers
+
+    processes = []
+    for server_port, count in zip(ports, counts):
+        env = dict(os.environ, WORKERS=str(count))
+        if mode == "prefork_cold":
+            env["WARM_QUERY"] = ""
+        processes.append(subprocess.Popen(command.format(port=server_port), shell=True, env=env, start_new_session=True))
+    return processes, ports
+
+
+def stop_servers(processes:list) -> None:
+    for process in processes:
+        os.killpg(process.pid, signal.SIGTERM)
+    for process in processes:
+        process.wait()
+
+
+def run_load(ports:list, path:str, body:bytes, concurrency:int, duration:float) -> dict:
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(index:int) -> None:
+        url = "http://127.0.0.1:%d%s" % (ports[index % len(ports)], path)
+        while time.monotonic() < deadline:
+            request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    response.read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "requests": int(latencies.size),
+        "errors": errors[0],
+        "requests_per_second": latencies.size / duration,
+        "p50_ms": float(np.percentile(latencies, 50)) if latencies.size else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if latencies.size else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='bench_workers',
+        description='Measure total RSS/PSS and throughput of a server for several worker counts')
+    parser.add_argument('--command', required=True, help='server command line, {port} is replaced by the port, e.g. "python3 retrievalserve.py ../gen_vectordb/vectordb 127.0.0.1 {port}"')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8], help='worker counts to try')
+    parser.add_argument('--mode', nargs='+', choices=['prefork', 'prefork_cold', 'separate'], default=['prefork', 'prefork_cold', 'separate'], help='serving modes to compare')
+    parser.add_argument('--port', type=int, default=8101, help='first port to use')
+    parser.add_argument('--path', default='/retrieval/batch_search', help='path to POST to')
+    parser.add_argument('--body', default='{"queries": ["When is the midterm exam?"], "include_text": false}', help='json request body')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load per point')
+    parser.add_argument('--startup_timeout', type=float, default=300, help='seconds to wait for the server to start')
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.mode:
+        for workers in args.workers:
+            processes, ports = start_servers(args.command, args.port, workers, mode)
+            try:
+                for port in ports:
+                    wait_for_port(port, args.startup_timeout)
+                # let the workers finish starting
+                time.sleep(2)
+                idle = tree_memory_mb([process.pid for process in processes])
+                load = run_load(ports, args.path, args.body.encode("utf-8"), args.concurrency, args.duration)
+                loaded = tree_memory_mb([process.pid for process in processes])
+            finally:
+                stop_servers(processes)
+
+            result = {
+                "mode": mode,
+                "workers": workers,
+                "idle_rss_mb": idle["rss_mb"],
+                "idle_pss_mb": idle["pss_mb"],
+                "rss_mb": loaded["rss_mb"],
+                "pss_mb": loaded["pss_mb"],
+            }
+            result.update(load)
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
+import os
 
 from langchain.chains import (
     LLMChain,
     ConversationalRetrievalChain
 )
+from langchain.chains.question_answering import load_qa_chain
 from langchain_core.output_parsers import StrOutputParser
 from langchain.prompts import (
     ChatPromptTemplate,
@@ -13,9 +15,8 @@ from langchain.callbacks.manager import CallbackManager
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain_community.llms import Ollama
 
-from langchain.memory import (
-    ConversationBufferMemory
-)
+from session_memory import SessionMemoryStore
+from condense import CondenseCache, CondenseQuestionChain
 
 
 # Prompt
@@ -35,13 +36,28 @@ llm = Ollama(
     callback_manager=CallbackManager([StreamingStdOutCallbackHandler()])
 )
 
-memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+# LLM that rewrites follow-up questions, can be a smaller, faster model
+condense_llm = Ollama(
+    model=os.environ.get("CONDENSE_MODEL", "mistral"),
+)
+
+# rewrites are shared by all sessions, see condense_cache.stats()
+condense_cache = CondenseCache(max_size=1024)
+
+# one bounded history per session, idle sessions are evicted
+# pass summary_llm=llm to fold dropped turns into a rolling summary
+memory_store = SessionMemoryStore(
+    max_token_limit=1000,
+    max_sessions=1000,
+    max_total_tokens=1000000,
+    ttl=3600,
+)
 
 # question from human
-def make_chain(retriever):
-    return ConversationalRetrievalChain.from_llm(
-        llm=llm,
+def make_chain(retriever, session_id:str="default"):
+    return ConversationalRetrievalChain(
         retriever=retriever,
-        memory=memory,
-        combine_docs_chain_kwargs={"prompt": prompt}
+        combine_docs_chain=load_qa_chain(llm, chain_type="stuff", prompt=prompt),
+        question_generator=CondenseQuestionChain.from_llm(condense_llm, cache=condense_cache),
+        memory=memory_store.get(session_id),
     )
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the question-condensing stage of the conversational chain."""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from langchain.chains.base import Chain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.llm import LLMChain
+from langchain_core.callbacks import CallbackManagerForChainRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.prompts import BasePromptTemplate
+
+# words that usually point back into the conversation
+_REFERENCE_WORDS = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|him|his|her|there|"
+    r"above|previous|earlier|same|former|latter|else|again)\b",
+    re.IGNORECASE,
+)
+# references that stay inside a course, e.g., "this class"
+_COURSE_REFERENCES = re.compile(
+    r"\b(this|that) (course|class|semester|term|week|module|syllabus)\b",
+    re.IGNORECASE,
+)
+# openings of follow-up questions, e.g., "and the midterm?"
+_FOLLOW_UP_OPENINGS = re.compile(
+    r"^\s*(and|but|or|so|also|then|what about|how about)\b",
+    re.IGNORECASE,
+)
+
+
+def is_self_contained(question:str, min_words:int=5) -> bool:
+    """Returns True when a question can be searched without the chat history."""
+    if len(question.split()) < min_words:
+        return False
+    if _FOLLOW_UP_OPENINGS.match(question):
+        return False
+    if _REFERENCE_WORDS.search(_COURSE_REFERENCES.sub("", question)):
+        return False
+    return True
+
+
+def _last_human_turn(chat_history:str) -> str:
+    for line in reversed(chat_history.splitlines()):
+        if line.startswith("Human:"):
+            return line[len("Human:"):].strip()
+    return ""
+
+
+class CondenseCache:
+    """
+    This class caches rewritten questions per (chat history, question) and
+    keeps the per-turn statistics of the condensing stage. One instance is
+    shared by the chains of all sessions.
+    """
+
+    def __init__(self, max_size:int=1024):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.turns = 0
+        self.skipped = 0
+        self.hits = 0
+        self.rewrites = 0
+        self.rewrite_seconds = 0.0
+
+    @staticmethod
+    def key(chat_history:str, question:str) -> str:
+        history_hash = hashlib.sha256(chat_history.encode("utf-8")).hexdigest()
+        return history_hash + ":" + question.strip().lower()
+
+    def get(self, key:str) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key:str, question:str) -> None:
+        with self._lock:
+            self._entries[key] = question
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def record(self, outcome:str, seconds:float=0.0) -> None:
+        """Counts a turn, outcome is "skipped", "hit" or "rewrite" (taking seconds)."""
+        # the chains of concurrent requests share the counters
+        with self._lock:
+            self.turns += 1
+            if outcome == "skipped":
+                self.skipped += 1
+            elif outcome == "hit":
+                self.hits += 1
+            else:
+                self.rewrites += 1
+                self.rewrite_seconds += seconds
+
+    def average_rewrite_seconds(self) -> float:
+        with self._lock:
+            if self.rewrites == 0:
+                return 0.0
+            return self.rewrite_seconds / self.rewrites
+
+    def stats(self) -> dict:
+        average = self.average_rewrite_seconds()
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "skipped": self.skipped,
+                "cache_hits": self.hits,
+                "rewrites": self.rewrites,
+                "average_rewrite_seconds": average,
+                "estimated_seconds_saved": (self.skipped + self.hits) * average,
+            }
+
+
+class CondenseQuestionChain(Chain):
+    """
+    Drop-in question_generator for ConversationalRetrievalChain. The LLM
+    rewrite of a follow-up question is skipped when the question is
+    self-contained (no references back into the conversation, or, with
+    embeddings, unrelated to the previous question), and rewrites are cached
+    per (chat history, question).
+    """
+
+    llm_chain: LLMChain
+    cache: CondenseCache
+    embeddings: Optional[Embeddings] = None
+    min_words: int = 5
+    # below this similarity to the previous question, a short question starts a new topic
+    topic_shift_threshold: float = 0.3
+
+    @property
+    def input_keys(self) -> List[str]:
+        return ["question", "chat_history"]
+
+    @property
+    def output_keys(self) -> List[str]:
+        return ["text"]
+
+    @classmethod
+    def from_llm(cls, llm:BaseLanguageModel, cache:CondenseCache, prompt:BasePromptTemplate=CONDENSE_QUESTION_PROMPT, **kwargs:Any) -> "CondenseQuestionChain":
+        return cls(llm_chain=LLMChain(llm=llm, prompt=prompt), cache=cache, **kwargs)
+
+    def _is_new_topic(self, question:str, chat_history:str) -> bool:
+        if not self.embeddings or _REFERENCE_WORDS.search(question):
+            return False
+
+        previous = _last_human_turn(chat_history)
+        if not previous:
+            return False
+
+        vectors = np.asarray(self.embeddings.embed_documents([question, previous]), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return float(vectors[0] @ vectors[1]) < self.topic_shift_threshold
+
+    def _call(self, inputs:Dict[str, Any], run_manager:Optional[CallbackManagerForChainRun]=None) -> Dict[str, str]:
+        question = inputs["question"]
+        chat_history = inputs["chat_history"]
+
+        if is_self_contained(question, self.min_words) or self._is_new_topic(question, chat_history):
+            self.cache.record("skipped")
+            print("> condense: skipped, saved ~%.2fs" % self.cache.average_rewrite_seconds())
+            return {"text": question}
+
+        key = CondenseCache.key(chat_history, question)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.record("hit")
+            print("> condense: cache hit, saved ~%.2fs" % self.cache.average_rewrite_seconds())
+            return {"text": cached}
+
+        callbacks = run_manager.get_child() if run_manager else None
+        start = time.perf_counter()
+        new_question = self.llm_chain.predict(question=question, chat_history=chat_history, callbacks=callbacks).strip()
+        elapsed = time.perf_counter() - start
+
+        self.cache.record("rewrite", elapsed)
+        self.cache.put(key, new_question)
+        print("> condense: rewrote question in %.2fs" % elapsed)
+        return {"text": new_question}
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the HNSW index settings of Chroma collections."""
+
+import os
+from typing import Optional
+
+from chromadb.segment import VectorReader
+
+HNSW_SPACES = ("l2", "cosine", "ip")
+DEFAULT_SEARCH_K = 4
+
+
+def hnsw_metadata(space:Optional[str]=None, m:Optional[int]=None, construction_ef:Optional[int]=None, search_ef:Optional[int]=None) -> dict:
+    """
+    Returns Chroma collection metadata holding the HNSW settings. Settings
+    that are not given are read from the HNSW_SPACE, HNSW_M,
+    HNSW_CONSTRUCTION_EF and HNSW_SEARCH_EF environment variables. Settings
+    set in neither place are left to Chroma's defaults.
+    """
+    values = {
+        "hnsw:space": space or os.environ.get("HNSW_SPACE"),
+        "hnsw:M": m or os.environ.get("HNSW_M"),
+        "hnsw:construction_ef": construction_ef or os.environ.get("HNSW_CONSTRUCTION_EF"),
+        "hnsw:search_ef": search_ef or os.environ.get("HNSW_SEARCH_EF"),
+    }
+
+    metadata = {}
+    for key, value in values.items():
+        if value is None or value == "":
+            continue
+
+        if key == "hnsw:space":
+            if value not in HNSW_SPACES:
+                raise ValueError("unsupported hnsw space %s" % value)
+            metadata[key] = value
+        else:
+            metadata[key] = int(value)
+    return metadata
+
+
+def search_k(k:Optional[int]=None) -> int:
+    """Returns the number of documents to retrieve, SEARCH_K by default."""
+    if k:
+        return k
+    return int(os.environ.get("SEARCH_K", DEFAULT_SEARCH_K))
+
+
+def set_search_ef(client, collection, search_ef:int) -> None:
+    """
+    Changes search_ef of an existing collection. Chroma copies the HNSW
+    settings into the vector segment when the collection is created and never
+    reads the collection metadata again, so the loaded segment is updated
+    directly.
+    """
+    segment = client._server._manager.get_segment(collection.id, VectorReader)
+    segment._params.search_ef = search_ef
+    if segment._index is not None:
+        segment._index.set_ef(search_ef)
+
+
+def add_hnsw_arguments(parser) -> None:
+    """Adds the HNSW settings to an argparse parser."""
+    parser.add_argument('--hnsw_space', choices=HNSW_SPACES, help='hnsw distance function (env HNSW_SPACE)')
+    parser.add_argument('--hnsw_m', type=int, help='hnsw max neighbours per node (env HNSW_M)')
+    parser.add_argument('--hnsw_construction_ef', type=int, help='hnsw candidate list size while indexing (env HNSW_CONSTRUCTION_EF)')
+    parser.add_argument('--hnsw_search_ef', type=int, help='hnsw candidate list size while searching (env HNSW_SEARCH_EF)')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the pre-fork multi-worker server."""
+
+import gc
+import os
+import signal
+import socket
+from typing import Any, Callable, Optional
+
+import uvicorn
+
+
+def _bind(host:str, port:int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(app:Any, host:str, port:int, workers:int=1, after_fork:Optional[Callable[[], None]]=None, log_level:str="info") -> None:
+    """
+    Serves an ASGI app with several worker processes forked from this one.
+
+    Everything loaded before serve() is called (the embedding model, the
+    vector index) is shared copy-on-write by the workers instead of being
+    loaded again in each of them, as uvicorn --workers does. The workers
+    accept connections on one shared socket. A worker that dies is forked
+    again from the loaded parent.
+
+    Params:
+      app  the ASGI app
+      workers  the number of worker processes, 1 serves in this process
+      after_fork  called in each worker before it serves, e.g., to start
+        background threads, which do not survive a fork
+    """
+    if workers <= 1:
+        if after_fork:
+            after_fork()
+        uvicorn.run(app, host=host, port=port, log_level=log_level)
+        return
+
+    sock = _bind(host, port)
+    # keep the loaded objects out of the collector, so it does not write to
+    # (and un-share) their pages in every worker
+    gc.collect()
+    gc.freeze()
+
+    def spawn() -> int:
+        pid = os.fork()
+        if pid:
+            return pid
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if after_fork:
+            after_fork()
+        server = uvicorn.Server(uvicorn.Config(app, log_level=log_level))
+        server.run(sockets=[sock])
+        os._exit(0)
+
+    stopping = False
+    children = set()
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        children.add(spawn())
+    print("> serving on %s:%d with %d pre-forked workers" % (host, port, workers))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+
+        children.discard(pid)
+        if not stopping:
+            print("> worker %d exited with status %d, restarting" % (pid, os.waitstatus_to_exitcode(status)))
+            children.add(spawn())
+
+    sock.close()
@@ -1,16 +1,38 @@
 #!/usr/bin/env python
 """Serves up the local RAG via langserve."""
-from fastapi import FastAPI
-from langserve import add_routes
-from vectordb import VectorDB
+import io
+import os
 import sys
+import time
+from typing import List, Optional
+
+import numpy as np
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
+from langserve import add_routes
+from pydantic import BaseModel
+
+from vectordb_reader import VectorDBReader, configurable_search
+from metafilter import expand_filter
+import prefork
 
 VECTORPATH = sys.argv[1]
 RAGHOST = sys.argv[2]
 RAGPORT = int(sys.argv[3])
+COLLECTION = os.environ.get("COLLECTION")
+VECTORSTORE_BACKEND = os.environ.get("VECTORSTORE_BACKEND", "chroma")
+# largest number of queries accepted by one /retrieval/batch_search call
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", "4096"))
+# queries searched together, bounds the (queries, rows) score matrix of the flat backend
+SEARCH_BLOCK_QUERIES = int(os.environ.get("SEARCH_BLOCK_QUERIES", "256"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+# question searched once before the workers are forked, empty to skip
+WARM_QUERY = os.environ.get("WARM_QUERY", "When does the class meet?")
 
-vectorstore = VectorDB(VECTORPATH)
-retriever = vectorstore.as_retriever()
+# read-only: no writer state or text splitter
+vectorstore = VectorDBReader(VECTORPATH, collection_name=COLLECTION, backend=VECTORSTORE_BACKEND)
+# a request can pass search options, e.g., {"configurable": {"filter": {"file_type": "pdf"}}}
+retriever = configurable_search(vectorstore.as_retriever())
 
 app = FastAPI(
     title="LangChain Server",
@@ -27,7 +49,87 @@ add_routes(
     path="/retrieval",
 )
 
-if __name__ == "__main__":
-    import uvicorn
 
-    uvicorn.run(app, host=RAGHOST, port=RAGPORT)
+class BatchQuery(BaseModel):
+    """
+    A batch of queries for /retrieval/batch_search.
+
+    format is "json", or "npz" for a numpy archive holding the "ids" and
+    "scores" (queries, k) arrays. include_text=False leaves the document
+    texts and metadata out of the JSON results. filter restricts the
+    search to the matching documents, see metafilter.expand_filter.
+    """
+    queries: List[str]
+    k: Optional[int] = None
+    filter: Optional[dict] = None
+    format: str = "json"
+    include_text: bool = True
+
+
+def _npz_response(ids:List[List[str]], scores:np.ndarray) -> Response:
+    buffer = io.BytesIO()
+    # fixed-width unicode keeps the archive loadable without pickle
+    np.savez(buffer, ids=np.array(ids, dtype=str).reshape(scores.shape), scores=scores)
+    return Response(content=buffer.getvalue(), media_type="application/octet-stream")
+
+
+@app.post("/retrieval/batch_search")
+def batch_search(batch:BatchQuery):
+    if batch.format not in ("json", "npz"):
+        raise HTTPException(status_code=400, detail="format must be json or npz")
+    if len(batch.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=413, detail="at most %d queries per batch" % MAX_BATCH_QUERIES)
+
+    try:
+        # checked before the embedding work
+        expand_filter(batch.filter or {}, {})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    start = time.perf_counter()
+    embeddings = vectorstore.embed_queries(batch.queries) if batch.queries else np.empty((0, 0), dtype=np.float32)
+    embed_seconds = time.perf_counter() - start
+
+    ids = []
+    docs = []
+    score_blocks = []
+    for block_start in range(0, len(batch.queries), SEARCH_BLOCK_QUERIES):
+        block_ids, block_docs, block_scores = vectorstore.search_by_vectors(embeddings[block_start:block_start + SEARCH_BLOCK_QUERIES], batch.k, batch.filter)
+        ids.extend(block_ids)
+        docs.extend(block_docs)
+        score_blocks.append(block_scores)
+    scores = np.concatenate(score_blocks) if score_blocks else np.empty((0, 0), dtype=np.float32)
+    print("> batch of %d queries: embedded in %.2fs, searched in %.2fs" % (len(batch.queries), embed_seconds, time.perf_counter() - start - embed_seconds))
+
+    if batch.format == "npz":
+        return _npz_response(ids, scores)
+
+    results = []
+    for query_ids, query_docs, query_scores in zip(ids, docs, scores.tolist()):
+        if batch.include_text:
+            results.append([
+                {"id": doc_id, "score": score, "text": doc.page_content, "metadata": doc.metadata}
+                for doc_id, doc, score in zip(query_ids, query_docs, query_scores)
+            ])
+        else:
+            results.append({"ids": query_ids, "scores": query_scores})
+    return {"results": results}
+
+
+@app.get("/retrieval/facets")
+def facets():
+    """Returns the number of chunks per source, section, file type and module, the values a filter can use."""
+    return vectorstore.facets()
+
+
+if __name__ == "__main__":
+    if WARM_QUERY:
+        # Chroma loads the HNSW index of a collection on its first query, so
+        # query it here: the workers then share the loaded index instead of
+        # each loading its own copy
+        start = time.perf_counter()
+        retriever.invoke(WARM_QUERY)
+        print("> warmed in %.2fs" % (time.perf_counter() - start))
+    # the embedding model and the index are loaded above, so the WORKERS
+    # processes forked here share them
+    prefork.serve(app, host=RAGHOST, port=RAGPORT, workers=WORKERS)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""This module holds the per-session conversation memory store."""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import tiktoken
+
+from langchain.chains.llm import LLMChain
+from langchain.memory import ConversationBufferMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import BaseMessage, SystemMessage, get_buffer_string
+
+
+def _tiktoken_len(text) -> int:
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+    tokens = tokenizer.encode(text)
+    return len(tokens)
+
+
+class BoundedConversationMemory(ConversationBufferMemory):
+    """
+    Conversation memory that keeps at most max_token_limit tokens of history.
+    The oldest turns are dropped first, or folded into a rolling summary when
+    summary_llm is set.
+    """
+
+    max_token_limit: int = 1000
+    summary_llm: Optional[BaseLanguageModel] = None
+    summary: str = ""
+    tokens: int = 0
+
+    @property
+    def buffer_as_messages(self) -> List[BaseMessage]:
+        if self.summary:
+            return [SystemMessage(content=self.summary)] + self.chat_memory.messages
+        return self.chat_memory.messages
+
+    @property
+    def buffer_as_str(self) -> str:
+        return get_buffer_string(
+            self.buffer_as_messages,
+            human_prefix=self.human_prefix,
+            ai_prefix=self.ai_prefix,
+        )
+
+    def token_count(self) -> int:
+        return _tiktoken_len(self.buffer_as_str)
+
+    def save_context(self, inputs, outputs) -> None:
+        super().save_context(inputs, outputs)
+        self.prune()
+
+    def prune(self) -> None:
+        messages = self.chat_memory.messages
+        pruned = []
+        # drop whole turns, always keeping the latest one
+        while len(messages) > 2 and self.token_count() > self.max_token_limit:
+            pruned.extend(messages[:2])
+            del messages[:2]
+
+        if pruned and self.summary_llm:
+            chain = LLMChain(llm=self.summary_llm, prompt=SUMMARY_PROMPT)
+            new_lines = get_buffer_string(pruned, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+            self.summary = chain.predict(summary=self.summary, new_lines=new_lines)
+
+        self.tokens = self.token_count()
+
+
+class SessionMemoryStore:
+    """
+    This class keeps one bounded conversation memory per session, so every
+    student has an isolated history. Sessions idle longer than ttl seconds
+    are dropped, and the least recently used sessions are evicted when there
+    are more than max_sessions or the histories hold more than
+    max_total_tokens tokens together.
+    """
+
+    def __init__(self, max_token_limit:int=1000, max_sessions:int=1000, max_total_tokens:int=1000000, ttl:float=3600.0, summary_llm:Optional[BaseLanguageModel]=None):
+        self._max_token_limit = max_token_limit
+        self._max_sessions = max_sessions
+        self._max_total_tokens = max_total_tokens
+        self._ttl = ttl
+        self._summary_llm = summary_llm
+
+        self._lock = threading.Lock()
+        # session id -> (last access time, memory), least recently used first
+        self._sessions = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id:str) -> BoundedConversationMemory:
+        """Returns the memory of a session, creating it if needed."""
+        with self._lock:
+            now = time.monotonic()
+            if session_id in self._sessions:
+                _, memory = self._sessions.pop(session_id)
+            else:
+                memory = BoundedConversationMemory(
+                    memory_key="chat_history",
+                    return_messages=True,
+                    output_key="answer",
+                    max_token_limit=self._max_token_limit,
+                    summary_llm=self._summary_llm,
+                )
+            self._sessions[session_id] = (now, memory)
+            self._evict(now)
+            return memory
+
+    def drop(self, session_id:str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict(self, now:float) -> None:
+        # expired sessions, oldest first
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if now - last_access <= self._ttl:
+                break
+            del self._sessions[session_id]
+
+        while len(self._sessions) > self._max_sessions:
+            self._sessions.popitem(last=False)
+
+        total_tokens = sum(memory.tokens for _, memory in self._sessions.values())
+        while len(self._sessions) > 1 and total_tokens > self._max_total_tokens:
+            _, (_, memory) = self._sessions.popitem(last=False)
+            total_tokens -= memory.tokens